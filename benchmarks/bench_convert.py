@@ -0,0 +1,91 @@
+'''
+Measures converting dumped SON into JSON compatible values, on wide
+documents (many fields and list items) and deep ones (nested embedded
+documents), against the recursive converter Marshaller used before.
+
+Run with::
+
+    python benchmarks/bench_convert.py [rows]
+'''
+import sys
+import timeit
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from mongoengine import (Document, EmbeddedDocument, StringField, IntField,
+                         DateTimeField, EmbeddedDocumentField, ListField)
+
+from flask_cuddlyrest.marshaller import convert, get_plan
+
+
+class Node(EmbeddedDocument):
+    name = StringField()
+    at = DateTimeField()
+    child = EmbeddedDocumentField('self')
+
+
+fields = dict(('extra%d' % i, StringField()) for i in range(20))
+fields.update(title=StringField(), created=DateTimeField(),
+              tags=ListField(StringField()), scores=ListField(IntField()),
+              nodes=ListField(EmbeddedDocumentField(Node)))
+Wide = type('Wide', (Document, ), fields)
+
+
+class Deep(Document):
+    root = EmbeddedDocumentField(Node)
+
+
+def recursive(value):
+    # The converter before it was made iterative and schema driven
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, list):
+        return [recursive(k) for k in value]
+    if isinstance(value, dict):
+        return dict((k, recursive(v)) for k, v in value.iteritems())
+    return value
+
+
+def make_wide(count):
+    rows = []
+    for i in range(count):
+        row = {'_id': ObjectId(), 'title': u'row %d' % i,
+               'created': datetime.now(), 'tags': [u't%d' % t
+                                                   for t in range(50)],
+               'scores': range(50),
+               'nodes': [{'name': u'n', 'at': datetime.now()}] * 5}
+        for e in range(20):
+            row['extra%d' % e] = u'extra'
+        rows.append(row)
+    return rows
+
+
+def make_deep(count, depth=200):
+    rows = []
+    for i in range(count):
+        node = {'name': u'leaf', 'at': datetime.now()}
+        for _ in range(depth):
+            node = {'name': u'node', 'child': node}
+        rows.append({'_id': ObjectId(), 'root': node})
+    return rows
+
+
+def main(count=200, repeat=5):
+    for name, rows, document_cls in (('wide', make_wide(count), Wide),
+                                     ('deep', make_deep(count), Deep)):
+        spec = get_plan(document_cls).spec
+        assert [convert(row, spec) for row in rows] == \
+            [recursive(row) for row in rows]
+        for label, func in (
+                ('recursive', lambda: [recursive(row) for row in rows]),
+                ('generic', lambda: [convert(row) for row in rows]),
+                ('schema', lambda: [convert(row, spec) for row in rows])):
+            best = min(timeit.repeat(func, number=1, repeat=repeat))
+            print('%-5s %-10s %8.2f us/row'
+                  % (name, label, best / count * 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
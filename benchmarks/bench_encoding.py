@@ -0,0 +1,61 @@
+'''
+Compares encode time and body size of large list responses for the
+encoders in flask_cuddlyrest.encoding against the old pretty printed
+bson.json_util output.
+
+Run with::
+
+    python benchmarks/bench_encoding.py [rows]
+'''
+import sys
+import timeit
+from datetime import datetime
+
+from bson import json_util
+from bson.objectid import ObjectId
+from mongoengine import (Document, EmbeddedDocument, StringField, IntField,
+                         DateTimeField, EmbeddedDocumentField, ListField)
+
+from flask_cuddlyrest.encoding import ENCODERS, get_encoder
+from flask_cuddlyrest.marshaller import Marshaller
+
+
+class Content(EmbeddedDocument):
+    text = StringField()
+    lang = StringField()
+
+
+class Row(Document):
+    title = StringField()
+    created = DateTimeField()
+    views = IntField()
+    content = EmbeddedDocumentField(Content)
+    tags = ListField(StringField())
+
+
+def make_body(count):
+    return [Marshaller(Row(id=ObjectId(), title='row %d' % i,
+                           created=datetime.now(), views=i,
+                           content=Content(text='some text ' * 5, lang='en'),
+                           tags=['a', 'b', 'c'])).dumps()
+            for i in range(count)]
+
+
+def main(count=10000, repeat=5):
+    body = make_body(count)
+    candidates = [('json_util indent=4',
+                   lambda data: json_util.dumps(data, indent=4))]
+    for name in sorted(ENCODERS):
+        try:
+            candidates.append((name, get_encoder(name)))
+        except ImportError:
+            print('%-20s not installed' % name)
+    for name, encode in candidates:
+        best = min(timeit.repeat(lambda: encode(body), number=1,
+                                 repeat=repeat))
+        print('%-20s %8.2f ms %10d bytes'
+              % (name, best * 1e3, len(encode(body))))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
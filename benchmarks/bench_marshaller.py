@@ -0,0 +1,81 @@
+'''
+Measures the per row cost of marshalling a list of documents.
+
+Run with::
+
+    python benchmarks/bench_marshaller.py [rows]
+
+The "uncached" figures drop the compiled marshal plan before every row,
+which is what building a Marshaller used to cost.
+'''
+import sys
+import timeit
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from mongoengine import (Document, EmbeddedDocument, StringField, IntField,
+                         DateTimeField, BinaryField, EmbeddedDocumentField,
+                         ListField)
+
+from flask_cuddlyrest.marshaller import Marshaller, invalidate_plan
+
+
+class Content(EmbeddedDocument):
+    text = StringField()
+    lang = StringField()
+
+
+class Row(Document):
+    title = StringField()
+    created = DateTimeField()
+    views = IntField()
+    payload = BinaryField()
+    content = EmbeddedDocumentField(Content)
+    tags = ListField(StringField())
+    extra1 = StringField()
+    extra2 = StringField()
+    extra3 = IntField()
+    extra4 = IntField()
+
+
+def make_rows(count):
+    return [Row(id=ObjectId(), title='row %d' % i, created=datetime.now(),
+                views=i, payload=b'x' * 16,
+                content=Content(text='text', lang='en'),
+                tags=['a', 'b', 'c'], extra1='e', extra2='f', extra3=i,
+                extra4=i)
+            for i in range(count)]
+
+
+def dump_cached(rows):
+    for row in rows:
+        Marshaller(row).dumps()
+
+
+def dump_uncached(rows):
+    for row in rows:
+        invalidate_plan(Row)
+        Marshaller(row).dumps()
+
+
+def construct_cached(rows):
+    for row in rows:
+        Marshaller(row)
+
+
+def construct_uncached(rows):
+    for row in rows:
+        invalidate_plan(Row)
+        Marshaller(row)
+
+
+def main(count=1000, repeat=5):
+    rows = make_rows(count)
+    for func in (construct_uncached, construct_cached,
+                 dump_uncached, dump_cached):
+        best = min(timeit.repeat(lambda: func(rows), number=1, repeat=repeat))
+        print('%-20s %8.2f us/row' % (func.__name__, best / count * 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
@@ -0,0 +1,73 @@
+'''
+Compares marshalling documents read from MongoDB the default way, hydrated
+into mongoengine documents, with the raw_reads way which marshals the SON
+pymongo returns.
+
+Run with::
+
+    python benchmarks/bench_raw.py [rows]
+
+Both paths start from the same SON rows, so the figures leave the query
+itself out and only show what hydration costs.
+'''
+import sys
+import timeit
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from mongoengine import (Document, EmbeddedDocument, StringField, IntField,
+                         DateTimeField, BinaryField, EmbeddedDocumentField,
+                         ListField, BooleanField)
+
+from flask_cuddlyrest.marshaller import Marshaller, RawDocument
+
+
+class Content(EmbeddedDocument):
+    text = StringField()
+    lang = StringField(default='en')
+
+
+class Row(Document):
+    title = StringField()
+    created = DateTimeField()
+    views = IntField()
+    payload = BinaryField()
+    content = EmbeddedDocumentField(Content)
+    tags = ListField(StringField())
+    published = BooleanField(default=False)
+    extra1 = StringField()
+    extra2 = StringField()
+    extra3 = IntField()
+
+
+def make_sons(count):
+    return [Row(id=ObjectId(), title=u'row %d' % i, created=datetime.now(),
+                views=i, payload=b'x' * 16, content=Content(text=u'text'),
+                tags=[u'a', u'b', u'c'], extra1=u'e', extra2=u'f',
+                extra3=i).to_mongo()
+            for i in range(count)]
+
+
+def hydrated(sons):
+    return [Marshaller(Row._from_son(son)).dumps() for son in sons]
+
+
+def raw(sons):
+    return [Marshaller(RawDocument(Row, son)).dumps() for son in sons]
+
+
+def main(count=1000, repeat=5):
+    sons = make_sons(count)
+    assert hydrated(sons) == raw(sons)
+    results = {}
+    for func in (hydrated, raw):
+        best = min(timeit.repeat(lambda: func(sons), number=1, repeat=repeat))
+        results[func.__name__] = best
+        print('%-10s %8.2f us/row %10.0f rows/s'
+              % (func.__name__, best / count * 1e6, count / best))
+    print('raw reads are %.1fx faster'
+          % (results['hydrated'] / results['raw']))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
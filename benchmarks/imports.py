@@ -0,0 +1,108 @@
+'''
+Time it takes to import the package, and what importing it pulls in.
+
+Run with::
+
+    python benchmarks/imports.py [--modules flask_cuddlyrest.marshaller,...]
+                                 [--repeat 5] [--budget 0.5] [--top 10]
+
+Every module is imported in fresh interpreters, --repeat times, and the
+fastest run is reported with the number of modules the import loaded and
+which of the heavy dependencies (flask-restful, werkzeug, docutils...) it
+brought in. Under Python 3.7 and later the --top modules taking the longest
+to import themselves are listed from ``python -X importtime``.
+
+With --budget (in seconds) the script exits with status 1 when an import
+takes longer.
+'''
+import argparse
+import json
+import subprocess
+import sys
+
+MODULES = ('flask_cuddlyrest', 'flask_cuddlyrest.marshaller',
+           'flask_cuddlyrest.api', 'flask_cuddlyrest.views')
+# Top level packages the light imports should not need
+HEAVY = ('flask', 'flask_restful', 'werkzeug', 'jinja2', 'docutils',
+         'pymongo', 'mongoengine')
+
+PROBE = '''
+import json, sys
+from timeit import default_timer
+before = set(sys.modules)
+start = default_timer()
+import %s
+seconds = default_timer() - start
+loaded = [name for name in set(sys.modules) - before if sys.modules[name]]
+sys.stdout.write(json.dumps({'seconds': seconds, 'loaded': loaded}))
+'''
+
+
+def probe(module, repeat):
+    '''
+    The fastest of `repeat` imports of `module` in a new interpreter, and
+    the modules that import loaded
+    '''
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c',
+                                          PROBE % module])
+        runs.append(json.loads(output.decode('utf-8')))
+    return min(runs, key=lambda run: run['seconds'])
+
+
+def import_times(module, top):
+    '''
+    The `top` modules which took the longest to import themselves when
+    importing `module`, from -X importtime
+    '''
+    process = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+        stderr=subprocess.PIPE, universal_newlines=True)
+    _, report = process.communicate()
+    times = []
+    for line in report.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        times.append((int(self_us), name.strip()))
+    return sorted(times, reverse=True)[:top]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Import time of the package modules')
+    parser.add_argument('--modules', default=','.join(MODULES),
+                        help='comma separated modules to import')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='imports of each module, the fastest counts')
+    parser.add_argument('--budget', type=float,
+                        help='the seconds an import may take at most')
+    parser.add_argument('--top', type=int, default=10,
+                        help='slowest modules to list with -X importtime')
+    args = parser.parse_args(argv)
+    over_budget = []
+    sys.stdout.write('%-30s %10s %8s  %s\n' % ('module', 'ms', 'modules',
+                                               'heavy dependencies'))
+    for module in args.modules.split(','):
+        result = probe(module, args.repeat)
+        heavy = sorted(set(name.split('.')[0] for name in result['loaded'])
+                       & set(HEAVY))
+        sys.stdout.write('%-30s %10.1f %8d  %s\n' % (
+            module, result['seconds'] * 1000, len(result['loaded']),
+            ', '.join(heavy) or '-'))
+        if args.budget is not None and result['seconds'] > args.budget:
+            over_budget.append(module)
+    if sys.version_info >= (3, 7) and args.top:
+        for module in args.modules.split(','):
+            sys.stdout.write('\nslowest imports of %s (self, ms):\n' % module)
+            for self_us, name in import_times(module, args.top):
+                sys.stdout.write('%10.1f  %s\n' % (self_us / 1000.0, name))
+    for module in over_budget:
+        sys.stdout.write('%s takes longer than %.3fs to import\n'
+                         % (module, args.budget))
+    return 1 if over_budget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
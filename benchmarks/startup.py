@@ -0,0 +1,83 @@
+'''
+Cost of registering many collections, and of dispatching requests once they
+are registered, runnable offline against mongomock.
+
+Run with::
+
+    python benchmarks/startup.py [--counts 10,100,500] [--requests 500]
+
+For each count, that many document classes (a few fields and a reference
+each) are generated and registered on a new app with register_many; the
+time per collection is reported, then the requests per second of
+GET /<name>/count spread over all the collections, which mostly measures
+routing and dispatch.
+'''
+import argparse
+import sys
+from timeit import default_timer
+
+from flask import Flask
+from mongoengine import (connect, Document, StringField, IntField,
+                         DateTimeField, ReferenceField)
+
+from flask_cuddlyrest import CuddlyRest
+
+COUNTS = (10, 100, 500)
+
+
+class Owner(Document):
+    name = StringField()
+
+
+def make_documents(count, run):
+    '''
+    `count` new document classes, named after `run` so that the classes of
+    different runs do not replace each other in the document registry
+    '''
+    return [type('Collection%d_%d' % (run, i), (Document, ), {
+        '__module__': __name__,
+        'meta': {'collection': 'collection_%d_%d' % (run, i)},
+        'title': StringField(),
+        'views': IntField(),
+        'created': DateTimeField(),
+        'owner': ReferenceField(Owner),
+    }) for i in range(count)]
+
+
+def measure(count, requests, run):
+    documents = make_documents(count, run)
+    app = Flask(__name__)
+    api = CuddlyRest(app=app)
+    start = default_timer()
+    names = api.register_many(documents)
+    registered = default_timer() - start
+    client = app.test_client()
+    urls = ['/%s/count' % names[i % count] for i in range(requests)]
+    start = default_timer()
+    for url in urls:
+        response = client.get(url)
+        assert response.status_code == 200, response.data
+    dispatched = default_timer() - start
+    return registered, requests / dispatched
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks of registering many collections')
+    parser.add_argument('--counts', default=','.join(map(str, COUNTS)),
+                        help='comma separated numbers of collections')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests to send once registered')
+    args = parser.parse_args(argv)
+    connect('cuddlyrest-bench', host='mongomock://localhost')
+    sys.stdout.write('%11s %12s %14s %10s\n' % (
+        'collections', 'register s', 'ms/collection', 'req/s'))
+    for run, count in enumerate(int(c) for c in args.counts.split(',')):
+        registered, rate = measure(count, args.requests, run)
+        sys.stdout.write('%11d %12.3f %14.3f %10.1f\n' % (
+            count, registered, registered * 1000 / count, rate))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,295 @@
+'''
+Throughput of the REST hot paths, runnable offline against mongomock.
+
+Run with::
+
+    python benchmarks/suite.py [--sizes 10,100,1000] [--min-time 1]
+                               [--only dumps,list_get]
+                               [--save baseline.json]
+                               [--compare baseline.json] [--threshold 0.1]
+
+Every case is run on collections of each size and reports operations per
+second, the median and 99th percentile latency of an operation, how many
+objects (tracked by the garbage collector) its result holds and how many
+queries it sends. The collections are posts with an
+embedded content, a binary payload, a reference to their author and a list
+of references to tags; one operation handles all the posts of a collection:
+
+    dumps      marshal the posts, fetching their references first
+    loads      unmarshal request bodies of posts, checking their references
+    encode     encode the marshalled posts with CuddlyRest.encode
+    list_get   GET /posts?limit=<size> through the Flask test client
+    raw_get    the same with raw_reads
+
+--save writes the results to a JSON file, --compare prints the change from
+such a baseline and exits with status 1 when a case got slower by more than
+the threshold (a fraction of its ops/s) or sends more queries. Figures are
+only comparable between runs on the same machine and interpreter.
+'''
+import argparse
+import gc
+import json
+import sys
+from datetime import datetime
+from timeit import default_timer
+
+import mongomock.collection
+from flask import Flask
+from mongoengine import (connect, Document, EmbeddedDocument, StringField,
+                         IntField, DateTimeField, BinaryField, ListField,
+                         EmbeddedDocumentField, ReferenceField)
+
+from flask_cuddlyrest import CuddlyRest
+from flask_cuddlyrest.marshaller import Marshaller
+from flask_cuddlyrest.references import IdentityMap
+
+SIZES = (10, 100, 1000)
+AUTHORS = 20
+TAGS = 50
+
+
+class Author(Document):
+    name = StringField()
+    email = StringField()
+
+
+class Tag(Document):
+    name = StringField()
+
+
+class Content(EmbeddedDocument):
+    text = StringField()
+    lang = StringField(default='en')
+
+
+class Post(Document):
+    title = StringField()
+    created = DateTimeField()
+    views = IntField()
+    payload = BinaryField()
+    content = EmbeddedDocumentField(Content)
+    author = ReferenceField(Author)
+    tags = ListField(ReferenceField(Tag))
+
+
+class Queries(object):
+    '''
+    Counts the find() calls made against the mongomock collections
+    '''
+    count = 0
+
+    def __enter__(self):
+        self.original = mongomock.collection.Collection.find
+        original, queries = self.original, self
+
+        def find(collection, *args, **kwargs):
+            queries.count += 1
+            return original(collection, *args, **kwargs)
+        mongomock.collection.Collection.find = find
+        return self
+
+    def __exit__(self, *exc_info):
+        mongomock.collection.Collection.find = self.original
+
+
+def populate(size):
+    for document in (Author, Tag, Post):
+        document.drop_collection()
+    authors = [Author(name=u'author %d' % i,
+                      email=u'author%d@example.com' % i).save()
+               for i in range(AUTHORS)]
+    tags = [Tag(name=u'tag %d' % i).save() for i in range(TAGS)]
+    Post.objects.insert([
+        Post(title=u'post %d' % i, created=datetime(2020, 1, 1), views=i,
+             payload=b'\x00\x01' * 32, content=Content(text=u'text ' * 20),
+             author=authors[i % AUTHORS],
+             tags=[tags[(i + j) % TAGS] for j in range(3)])
+        for i in range(size)])
+
+
+def make_app():
+    app = Flask(__name__)
+    api = CuddlyRest(app=app)
+    api.register(Post, 'posts')
+    api.register(Post, 'raw_posts', raw_reads=True)
+    return app, api
+
+
+def dumps_case(size, app, api):
+    posts = list(Post.objects)
+
+    def run():
+        identity_map = IdentityMap()
+        identity_map.prefetch(posts)
+        return [Marshaller(post, identity_map).dumps() for post in posts]
+    return run
+
+
+def loads_case(size, app, api):
+    bodies = [dict((k, v) for k, v in Marshaller(post).dumps().items()
+                   if k not in ('id', 'payload'))
+              for post in Post.objects]
+    for body in bodies:
+        body['author'] = body['author']['id']
+        body['tags'] = [tag['id'] for tag in body['tags']]
+
+    def run():
+        identity_map = IdentityMap()
+        identity_map.prefetch_json(Post, bodies)
+        return [Marshaller(Post(), identity_map).loads(body)
+                for body in bodies]
+    return run
+
+
+def encode_case(size, app, api):
+    data = [Marshaller(post).dumps() for post in Post.objects]
+    # Pushed once, setting up a request would take longer than encoding
+    context = app.test_request_context('/posts')
+    context.push()
+
+    def run():
+        return api.encode(data)
+    run.close = context.pop
+    return run
+
+
+def get_case(url):
+    def case(size, app, api):
+        client = app.test_client()
+        url_size = '%s?limit=%d' % (url, size)
+
+        def run():
+            response = client.get(url_size)
+            assert response.status_code == 200, response.data
+            return response
+        return run
+    return case
+
+
+CASES = [
+    ('dumps', dumps_case),
+    ('loads', loads_case),
+    ('encode', encode_case),
+    ('list_get', get_case('/posts')),
+    ('raw_get', get_case('/raw_posts')),
+]
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def objects(run):
+    '''
+    How many objects tracked by the garbage collector the result of `run`
+    holds: those it builds and keeps, e.g. the marshalled dicts
+    '''
+    gc.collect()
+    before = len(gc.get_objects())
+    result = run()
+    gc.collect()
+    count = len(gc.get_objects()) - before
+    del result
+    return count
+
+
+def measure(run, min_time, min_runs=5):
+    run()
+    with Queries() as queries:
+        run()
+    held = objects(run)
+    samples = []
+    gc.collect()
+    started = default_timer()
+    while len(samples) < min_runs or default_timer() - started < min_time:
+        start = default_timer()
+        run()
+        samples.append(default_timer() - start)
+    return {
+        'ops': len(samples) / sum(samples),
+        'p50': percentile(samples, 0.5),
+        'p99': percentile(samples, 0.99),
+        'runs': len(samples),
+        'queries': queries.count,
+        'objects': held,
+    }
+
+
+def run_suite(sizes=SIZES, only=None, min_time=1.0, out=sys.stdout):
+    connect('cuddlyrest-bench', host='mongomock://localhost')
+    app, api = make_app()
+    results = {}
+    out.write('%-9s %6s %10s %10s %10s %8s %9s\n' % (
+        'case', 'size', 'ops/s', 'p50 ms', 'p99 ms', 'queries', 'objects'))
+    for size in sizes:
+        populate(size)
+        for name, case in CASES:
+            if only and name not in only:
+                continue
+            run = case(size, app, api)
+            try:
+                result = measure(run, min_time)
+            finally:
+                # Cases holding on to something until they are measured
+                getattr(run, 'close', lambda: None)()
+            results['%s/%d' % (name, size)] = result
+            out.write('%-9s %6d %10.1f %10.3f %10.3f %8d %9d\n' % (
+                name, size, result['ops'], result['p50'] * 1000,
+                result['p99'] * 1000, result['queries'], result['objects']))
+    return results
+
+
+def compare(results, baseline, threshold=0.1, out=sys.stdout):
+    '''
+    Prints the change of every case from `baseline`, returns the names of
+    those which regressed
+    '''
+    regressions = []
+    out.write('\n%-15s %12s %12s %8s %9s\n' % (
+        'case', 'baseline', 'ops/s', 'change', 'queries'))
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        before, after = baseline[key], results[key]
+        change = after['ops'] / before['ops'] - 1
+        regressed = (change < -threshold or
+                     after['queries'] > before['queries'])
+        if regressed:
+            regressions.append(key)
+        out.write('%-15s %12.1f %12.1f %+7.1f%% %4d->%-4d%s\n' % (
+            key, before['ops'], after['ops'], change * 100,
+            before['queries'], after['queries'],
+            '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks of the REST hot paths')
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help='comma separated collection sizes')
+    parser.add_argument('--only', help='comma separated cases to run')
+    parser.add_argument('--min-time', type=float, default=1.0,
+                        help='seconds to run each case for, at least')
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--compare', help='compare with this saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='the ops/s drop reported as a regression')
+    args = parser.parse_args(argv)
+    results = run_suite([int(size) for size in args.sizes.split(',')],
+                        args.only and args.only.split(','), args.min_time)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': sys.version.split()[0],
+                       'results': results}, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,82 +1,53 @@
-from bson import json_util
-from flask import make_response
-from flask.ext.restful import Api
-from flask.ext.cuddlyrest.views import ListMongoResource, SingleMongoResource
-
-
-class CuddlyRest(Api):
-    
-    def __init__(self, **kwargs):
-        Api.__init__(self, **kwargs)
-        
-    def init_app(self, app):
-        self.app = app
-        self.representation('application/json')(self.json_encode)
-
-    def json_encode(self, data, code, headers=None):
-        resp = make_response(json_util.dumps(data, indent=4), code)
-        if headers:
-            resp.headers.extend(headers)
-        return resp
-
-    def register(self, collection, name):
-        collection_resource = SingleMongoResource(collection)
-        collection_list = ListMongoResource(collection)
-        self.add_resource(collection_resource, '/%s/<string:doc_id>'
-                          % name,
-                          endpoint=name + '_single',
-                          document=collection)
-        self.add_resource(collection_list, '/%s' % name,
-                          endpoint=name + '_multiple',
-                          document=collection)
-
-    def run(self, *args, **kwargs):
-        self.app.run(*args, **kwargs)
-
-    def add_resource(self, resource, *urls, **kwargs):
-        """Adds a resource to the api.
-
-        :param resource: the class name of your resource
-        :type resource: :class:`Resource`
-        :param urls: one or more url routes to match for the resource, standard
-                     flask routing rules apply.  Any url variables will be
-                     passed to the resource method as args.
-        :type urls: str
-
-        :param endpoint: endpoint name (defaults to
-            :meth:`Resource.__name__.lower`
-            Can be used to reference this route in :class:`fields.Url` fields
-        :type endpoint: str
-
-        Additional keyword arguments not specified above will be passed as-is
-        to :meth:`flask.Flask.add_url_rule`.
-
-        Examples::
-
-            api.add_resource(HelloWorld, '/', '/hello')
-            api.add_resource(Foo, '/foo', endpoint="foo")
-            api.add_resource(FooSpecial, '/special/foo', endpoint="foo")
-
-        """
-        endpoint = kwargs.pop('endpoint', None) or resource.__name__.lower()
-        self.endpoints.add(endpoint)
-
-        if endpoint in self.app.view_functions.keys():
-            previous_view_class = (self.app.view_functions[endpoint]
-                                   .__dict__['view_class'])
-
-            # if you override the endpoint with a different class, avoid the
-            # collision by raising an exception
-            if previous_view_class != resource:
-                raise ValueError(
-                    'This endpoint (%s) is already set to the class %s.'
-                    % (endpoint, previous_view_class.__name__))
-
-        resource.endpoint = endpoint
-        resource_func = self.output(resource.as_view(endpoint, **kwargs))
-
-        for decorator in self.decorators:
-            resource_func = decorator(resource_func)
-
-        for url in urls:
-            self.app.add_url_rule(self.prefix + url, view_func=resource_func)
+'''
+Flask-CuddlyRest serves MongoEngine documents as a REST api, see
+:class:`flask_cuddlyrest.api.CuddlyRest`.
+
+The names the package exports are imported from their modules when first
+looked up, so that importing one module (e.g. the marshaller, in a worker
+which never serves requests) does not import flask-restful, the views and
+all they depend on.
+'''
+import sys
+from importlib import import_module
+from types import ModuleType
+
+# The names exported by the package, by the module defining them
+EXPORTS = {
+    'api': ('CuddlyRest', 'Registration', 'collection_documents'),
+    'views': ('MongoResource', 'ListMongoResource', 'SingleMongoResource',
+              'CountMongoResource', 'AggregateMongoResource'),
+    'marshaller': ('Marshaller', ),
+}
+
+_origins = dict((name, module) for module, names in EXPORTS.items()
+                for name in names)
+
+
+class LazyModule(ModuleType):
+    '''
+    The package module, importing the module of an export on its first
+    lookup
+    '''
+    def __getattr__(self, name):
+        if name not in _origins:
+            raise AttributeError('module %r has no attribute %r'
+                                 % (self.__name__, name))
+        module = import_module('%s.%s' % (self.__name__, _origins[name]))
+        value = getattr(module, name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_origins))
+
+
+__all__ = sorted(_origins)
+
+# The package keeps the original module referenced: Python 2 clears the
+# globals of a module when it is collected, those the methods above use
+# included
+_module = sys.modules[__name__]
+_package = sys.modules[__name__] = LazyModule(__name__)
+_package.__dict__.update((name, value) for name, value in globals().items()
+                         if name.startswith('__'))
+_package._module = _module
@@ -0,0 +1,104 @@
+'''
+Counting and aggregating documents inside MongoDB, so that a summary of a
+collection does not load and marshal every document of it.
+'''
+from bson.dbref import DBRef
+from bson.objectid import ObjectId
+from mongoengine.errors import InvalidQueryError, LookUpError
+
+# The accumulators a request can ask for, each given a comma separated list
+# of (numeric) fields, e.g. ?sum=views,likes&avg=views
+ACCUMULATORS = ('sum', 'avg', 'min', 'max')
+
+
+def db_path(document_cls, path):
+    '''
+    The database path of the (dotted or __ separated) field `path`
+    '''
+    try:
+        return document_cls._translate_field_name(path.replace('__', '.'))
+    except LookUpError:
+        raise InvalidQueryError('Unknown field: %s' % path)
+
+
+def plain(value):
+    '''
+    `value` as it is marshalled in documents, ids become strings
+    '''
+    if isinstance(value, DBRef):
+        value = value.id
+    if isinstance(value, ObjectId):
+        return str(value)
+    return value
+
+
+def _names(value):
+    return [name for name in (value or '').split(',') if name]
+
+
+class Aggregation(object):
+    '''
+    Groups the documents of a query by the `group_by` fields, counting them
+    and applying the (accumulator, field) pairs of `accumulators` to each
+    group
+    '''
+    def __init__(self, group_by, accumulators):
+        self.group_by = group_by
+        self.accumulators = accumulators
+
+    @classmethod
+    def parse(cls, args):
+        '''
+        Pops the group_by and accumulator arguments out of the filter
+        arguments `args`
+        '''
+        group_by = _names(args.pop('group_by', None))
+        accumulators = [(op, name) for op in ACCUMULATORS
+                        for name in _names(args.pop(op, None))]
+        return cls(group_by, accumulators)
+
+    def key(self, op, name):
+        # Result field names can not contain dots
+        return '%s__%s' % (op, name.replace('.', '__'))
+
+    def pipeline(self, document_cls):
+        group_id = None
+        if self.group_by:
+            group_id = dict((name.replace('.', '__'),
+                             '$' + db_path(document_cls, name))
+                            for name in self.group_by)
+        group = {'_id': group_id, 'count': {'$sum': 1}}
+        for op, name in self.accumulators:
+            group[self.key(op, name)] = {
+                '$' + op: '$' + db_path(document_cls, name)}
+        return [{'$group': group}, {'$sort': {'_id': 1}}]
+
+    def row(self, result):
+        row = {'count': result['count']}
+        for name, value in (result['_id'] or {}).items():
+            row[name] = plain(value)
+        for op, name in self.accumulators:
+            row.setdefault(op, {})[name] = plain(
+                result[self.key(op, name)])
+        return row
+
+    def run(self, docs):
+        '''
+        Aggregates the queryset `docs`; returns one row per group, or the
+        single row of all documents when not grouping
+        '''
+        rows = [self.row(result) for result in docs.aggregate(
+            *self.pipeline(docs._document))]
+        if self.group_by:
+            return rows
+        return rows[0] if rows else {'count': 0}
+
+
+def distinct(docs, path):
+    '''
+    The distinct values of the field `path` in the queryset `docs`, without
+    dereferencing references
+    '''
+    collection = docs._document._get_collection()
+    return [plain(value) for value in collection.distinct(
+        db_path(docs._document, path), docs._query)]
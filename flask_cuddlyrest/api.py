@@ -0,0 +1,304 @@
+'''
+The api object: :class:`CuddlyRest` registers collections and serves them
+through the resources of :mod:`flask_cuddlyrest.views`.
+'''
+import inspect
+import threading
+from collections import Counter, OrderedDict, namedtuple
+
+from flask import make_response, request, g
+from flask_restful import Api, Resource
+from mongoengine import Document
+from mongoengine.fields import EmbeddedDocumentField
+from flask_cuddlyrest.views import (
+    ListMongoResource, SingleMongoResource, CountMongoResource,
+    AggregateMongoResource)
+from flask_cuddlyrest.encoding import get_encoder
+from flask_cuddlyrest.cache import ResponseCache, LRUCache
+from flask_cuddlyrest.marshaller import get_plan
+from flask_cuddlyrest.filters import get_filter_parser, TRUE_STRINGS
+from flask_cuddlyrest.references import hit_rates
+from flask_cuddlyrest.metrics import (
+    Metrics, install, start_timings, stop_timings, current_timings, timed)
+
+# The resources serving a registered collection, by endpoint suffix
+RESOURCES = (('single', '/%s/<string:doc_id>', SingleMongoResource),
+             ('multiple', '/%s', ListMongoResource),
+             ('count', '/%s/count', CountMongoResource),
+             ('aggregate', '/%s/aggregate', AggregateMongoResource))
+
+# A collection served by the api: its document class, its resources by
+# endpoint suffix and the document classes it references
+Registration = namedtuple('Registration', 'document resources references')
+
+
+def referenced_documents(document):
+    '''
+    The document classes the representation of `document` can inline: those
+    its references point to, directly, from its embedded documents or from
+    the documents referenced in turn
+    '''
+    referenced, seen, pending = set(), set(), [document]
+    while pending:
+        document_cls = pending.pop()
+        if document_cls in seen:
+            continue
+        seen.add(document_cls)
+        plan = get_plan(document_cls)
+        for name in plan.related_fields | plan.list_related_fields:
+            field = plan.fields[name]
+            target = getattr(field, 'field', field).document_type
+            referenced.add(target)
+            pending.append(target)
+        for field in plan.fields.values():
+            field = getattr(field, 'field', None) or field
+            if isinstance(field, EmbeddedDocumentField):
+                pending.append(field.document_type)
+    return frozenset(referenced)
+
+
+def collection_documents(module):
+    '''
+    The document classes defined in `module` which have a collection of
+    their own, leaving out the abstract ones and those stored in the
+    collection of a parent class
+    '''
+    def concrete(cls):
+        return (inspect.isclass(cls) and issubclass(cls, Document) and
+                cls is not Document and not cls._meta.get('abstract'))
+
+    return sorted((value for value in vars(module).values()
+                   if concrete(value) and
+                   value.__module__ == module.__name__ and
+                   not any(concrete(base) for base in value.__mro__[1:])),
+                  key=lambda document: document.__name__)
+
+
+class CuddlyRest(Api):
+    '''
+    :param encoder: name of the JSON encoder for response bodies, see
+        :func:`flask_cuddlyrest.encoding.get_encoder`
+    :param pretty: indent every response body, otherwise bodies are compact
+        unless the request asks for ?pretty=1
+    :param metrics: True, or a :class:`flask_cuddlyrest.metrics.Metrics`
+        to share with other apis, to record the duration, phases and
+        MongoDB commands of every request in :attr:`metrics`
+    :param server_timing: send the phases and MongoDB commands of every
+        request in a Server-Timing header
+    '''
+
+    def __init__(self, encoder='auto', pretty=False, metrics=None,
+                 server_timing=False, **kwargs):
+        self.encoder = get_encoder(encoder)
+        self.pretty = pretty
+        if metrics is True:
+            metrics = Metrics()
+        self.metrics = metrics or None
+        self.server_timing = server_timing
+        self.caches = []
+        self.registry = OrderedDict()
+        self.identity_map_counts = Counter()
+        self.stats_lock = threading.Lock()
+        Api.__init__(self, **kwargs)
+
+    def init_app(self, app):
+        self.app = app
+        # Every api of the app, the caches of each can hold responses a
+        # write through another makes stale
+        app.extensions.setdefault('cuddlyrest', []).append(self)
+        self.representation('application/json')(self.json_encode)
+        app.after_request(self.collect_stats)
+        if self.metrics is not None or self.server_timing:
+            install()
+            app.before_request(start_timings)
+            app.teardown_request(lambda exc: stop_timings())
+
+    def collect_stats(self, response):
+        '''
+        Adds the lookups of the request's identity map to the totals of
+        :meth:`identity_map_stats`, and its timings to the metrics
+        '''
+        identity_map = getattr(g, 'cuddlyrest_identity_map', None)
+        if identity_map is not None:
+            with self.stats_lock:
+                for name in ('hits', 'misses', 'dump_hits', 'dump_misses'):
+                    self.identity_map_counts[name] += getattr(identity_map,
+                                                              name)
+        timings = current_timings()
+        if timings is not None:
+            if self.server_timing:
+                response.headers['Server-Timing'] = timings.server_timing()
+            if self.metrics is not None:
+                self.metrics.observe(request.endpoint, request.method,
+                                     response.status_code, timings,
+                                     identity_map)
+        return response
+
+    def identity_map_stats(self):
+        '''
+        How often the requests served so far found referenced documents,
+        and their dumps, in their identity map
+        '''
+        with self.stats_lock:
+            return hit_rates(self.identity_map_counts)
+
+    def encode(self, data):
+        pretty = (self.pretty or
+                  request.args.get('pretty', '').lower() in TRUE_STRINGS)
+        with timed('encode'):
+            return self.encoder(data, pretty=pretty)
+
+    def json_encode(self, data, code, headers=None):
+        resp = make_response(self.encode(data), code)
+        if headers:
+            resp.headers.extend(headers)
+        return resp
+
+    def register(self, collection, name, **options):
+        '''
+        Serves `collection` under /`name`, extra keyword arguments override
+        the options of :class:`MongoResource` for this collection only.
+
+        The resources of a collection are built once, here, and serve all
+        its requests; its marshalling plan and filter parser are compiled
+        here too. What was registered is kept in :attr:`registry`, by name.
+
+        The allowed_filters and allowed_ordering options are checked against
+        the indexes of `collection` if the unindexed option is set, which
+        needs a connection to MongoDB.
+
+        The `cache` option takes a :class:`CacheBackend` (True for an
+        in-process :class:`LRUCache`) in which the GET responses of this
+        collection are cached until it, or a collection it references, is
+        written to.
+        '''
+        cache = options.get('cache')
+        if cache is not None and not isinstance(cache, ResponseCache):
+            if cache is True:
+                cache = LRUCache()
+            options['cache'] = ResponseCache(cache, name)
+        if name in self.registry:
+            raise ValueError('A collection is already registered as %s'
+                             % name)
+        resources = OrderedDict(
+            (suffix, resource_cls(collection, **options))
+            for suffix, _, resource_cls in RESOURCES)
+        for resource in resources.values():
+            resource.api = self
+        resources['multiple'].check_indexes()
+        get_filter_parser(collection)
+        registration = Registration(collection, resources,
+                                    referenced_documents(collection))
+        for suffix, url, _ in RESOURCES:
+            self.add_resource(resources[suffix], url % name,
+                              endpoint='%s_%s' % (name, suffix))
+        self.registry[name] = registration
+        if options.get('cache') is not None:
+            self.caches.append((registration, options['cache']))
+        return registration
+
+    def register_many(self, documents, **options):
+        '''
+        Registers each of `documents` under the name of its collection with
+        the same `options`. `documents` is an iterable of document classes
+        or of (document class, name) pairs, or a module whose document
+        classes are all registered (see :func:`collection_documents`).
+        Returns the names registered.
+        '''
+        if inspect.ismodule(documents):
+            documents = collection_documents(documents)
+        names = []
+        for document in documents:
+            if isinstance(document, tuple):
+                document, name = document
+            else:
+                name = document._get_collection_name()
+            self.register(document, name, **options)
+            names.append(name)
+        return names
+
+    def invalidate(self, document):
+        '''
+        Drops the cached responses of `document` and of the registered
+        collections referencing it
+        '''
+        for registration, cache in self.caches:
+            if (registration.document is document or
+                    document in registration.references):
+                cache.invalidate()
+
+    def run(self, *args, **kwargs):
+        self.app.run(*args, **kwargs)
+
+    def add_resource(self, resource, *urls, **kwargs):
+        """Adds a resource to the api.
+
+        :param resource: the class name of your resource, or an instance of
+                         it which then serves every request (it must not
+                         keep per request state)
+        :type resource: :class:`Resource`
+        :param urls: one or more url routes to match for the resource, standard
+                     flask routing rules apply.  Any url variables will be
+                     passed to the resource method as args.
+        :type urls: str
+
+        :param endpoint: endpoint name (defaults to
+            :meth:`Resource.__name__.lower`
+            Can be used to reference this route in :class:`fields.Url` fields
+        :type endpoint: str
+
+        Additional keyword arguments not specified above will be passed as-is
+        to :meth:`flask.Flask.add_url_rule`.
+
+        Examples::
+
+            api.add_resource(HelloWorld, '/', '/hello')
+            api.add_resource(Foo, '/foo', endpoint="foo")
+            api.add_resource(FooSpecial, '/special/foo', endpoint="foo")
+
+        """
+        resource_cls = resource
+        if isinstance(resource, Resource):
+            resource_cls = type(resource)
+        endpoint = (kwargs.pop('endpoint', None) or
+                    resource_cls.__name__.lower())
+        self.endpoints.add(endpoint)
+
+        if endpoint in self.app.view_functions:
+            previous_view_class = (self.app.view_functions[endpoint]
+                                   .__dict__['view_class'])
+
+            # if you override the endpoint with a different class, avoid the
+            # collision by raising an exception
+            if previous_view_class != resource_cls:
+                raise ValueError(
+                    'This endpoint (%s) is already set to the class %s.'
+                    % (endpoint, previous_view_class.__name__))
+
+        resource.endpoint = endpoint
+        if resource is resource_cls:
+            view = resource.as_view(endpoint, **kwargs)
+        else:
+            view = instance_view(resource, endpoint)
+        resource_func = self.output(view)
+
+        for decorator in self.decorators:
+            resource_func = decorator(resource_func)
+
+        for url in urls:
+            self.app.add_url_rule(self.prefix + url, view_func=resource_func)
+
+
+def instance_view(resource, endpoint):
+    '''
+    The view function dispatching the requests of `endpoint` to the
+    `resource` instance, as View.as_view does to a new instance each time
+    '''
+    def view(*args, **kwargs):
+        return resource.dispatch_request(*args, **kwargs)
+    view.view_class = type(resource)
+    view.__name__ = endpoint
+    view.__doc__ = type(resource).__doc__
+    view.__module__ = type(resource).__module__
+    view.methods = resource.methods
+    return view
@@ -0,0 +1,101 @@
+'''
+Caching of encoded GET responses.
+
+A :class:`ResponseCache` keeps the responses of one registered collection
+in a :class:`CacheBackend`; writes to the collection (or to a collection it
+references) invalidate it by moving it to a new generation, so backends
+never have to enumerate keys. :class:`LRUCache` is the in-process backend,
+other stores only need to implement get, set and delete.
+'''
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class CacheBackend(object):
+    '''
+    The interface of the stores a ResponseCache can use. Values are tuples
+    of strings, numbers and dicts, so they can be pickled or serialized.
+    '''
+    def get(self, key):
+        '''
+        Returns the value stored at `key`, or None
+        '''
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+
+class LRUCache(CacheBackend):
+    '''
+    An in-process backend keeping at most `maxsize` values, each for at most
+    `ttl` seconds if given
+    '''
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                expires, value = self.values.pop(key)
+            except KeyError:
+                return None
+            if expires is not None and expires < time.time():
+                return None
+            self.values[key] = expires, value
+            return value
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else time.time() + self.ttl
+        with self.lock:
+            self.values.pop(key, None)
+            self.values[key] = expires, value
+            while len(self.values) > self.maxsize:
+                self.values.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.values.pop(key, None)
+
+
+class ResponseCache(object):
+    '''
+    The cached responses of the collection registered as `namespace`
+    '''
+    def __init__(self, backend, namespace):
+        self.backend = backend
+        self.namespace = namespace
+        self.generation_key = '%s:generation' % namespace
+
+    def generation(self):
+        generation = self.backend.get(self.generation_key)
+        if generation is None:
+            generation = uuid.uuid4().hex
+            self.backend.set(self.generation_key, generation)
+        return generation
+
+    def key(self, request_key):
+        '''
+        The backend key of a request in the current generation
+        '''
+        return '%s:%s:%s' % (self.namespace, self.generation(), request_key)
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, response):
+        self.backend.set(key, response)
+
+    def invalidate(self):
+        '''
+        Forgets every response cached so far
+        '''
+        self.backend.set(self.generation_key, uuid.uuid4().hex)
@@ -0,0 +1,54 @@
+'''
+Running the independent reads of a request at the same time.
+
+Resources given an `executor` option send the queries of a request which do
+not depend on each other (the reference fetches of different collections,
+the count and the page of a list) concurrently, so the request waits for
+the slowest of them instead of their sum. Any object with the submit()
+method of :mod:`concurrent.futures` executors will do, or the
+:class:`ThreadPoolExecutor` below.
+'''
+from multiprocessing.pool import ThreadPool
+
+from flask_cuddlyrest.metrics import carry
+
+
+class Future(object):
+    def __init__(self, async_result):
+        self.async_result = async_result
+
+    def result(self, timeout=None):
+        return self.async_result.get(timeout)
+
+
+class ThreadPoolExecutor(object):
+    '''
+    A pool of at most `max_workers` threads running the functions given to
+    :meth:`submit`, for when the concurrent.futures backport is not
+    installed
+    '''
+    def __init__(self, max_workers=4):
+        self.pool = ThreadPool(max_workers)
+
+    def submit(self, function, *args, **kwargs):
+        return Future(self.pool.apply_async(function, args, kwargs))
+
+    def shutdown(self, wait=True):
+        self.pool.close()
+        if wait:
+            self.pool.join()
+
+
+def run_all(executor, functions):
+    '''
+    Calls `functions` and returns their results in order. With an
+    `executor` all but the first are submitted to it, the first one runs
+    in the current thread meanwhile; it can then use the executor itself
+    without waiting for a worker of its own.
+    '''
+    if executor is None or len(functions) < 2:
+        return [function() for function in functions]
+    futures = [executor.submit(carry(function))
+               for function in functions[1:]]
+    first = functions[0]()
+    return [first] + [future.result() for future in futures]
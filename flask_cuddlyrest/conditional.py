@@ -0,0 +1,76 @@
+'''
+Conditional requests: ETag and Last-Modified validators for documents, so
+polling clients get a 304 instead of the same body again and writers can
+make their changes conditional on the version they have seen.
+'''
+import hashlib
+
+from bson import BSON
+from flask import request, current_app
+from werkzeug.http import http_date, quote_etag
+
+
+def compute_etag(docs, identity_map=None, version_field=None,
+                 expansion=None):
+    '''
+    A strong ETag for the representation of `docs` (and of the documents
+    in `identity_map` they refer to, which `expansion` inlines) the current
+    request asks for. A model with a `version_field` is identified by its id
+    and version only.
+    '''
+    digest = hashlib.sha1(request.query_string)
+    for doc in docs:
+        if version_field:
+            digest.update(('%s:%s;' % (doc.pk, doc._data.get(version_field)))
+                          .encode('utf-8'))
+        else:
+            digest.update(BSON.encode(doc.to_mongo()))
+    if identity_map is not None and not version_field:
+        referenced = identity_map.referenced(docs, expansion)
+        for key in sorted(referenced):
+            digest.update(BSON.encode(referenced[key].to_mongo()))
+    return digest.hexdigest()
+
+
+def last_modified(docs, last_modified_field):
+    values = [doc._data.get(last_modified_field) for doc in docs]
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+def validator_headers(etag=None, modified=None):
+    headers = {}
+    if etag is not None:
+        headers['ETag'] = quote_etag(etag)
+    if modified is not None:
+        headers['Last-Modified'] = http_date(modified)
+    return headers
+
+
+def is_not_modified(etag=None, modified=None):
+    '''
+    Whether the client already has the current representation according to
+    If-None-Match, or failing that If-Modified-Since
+    '''
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if request.if_none_match:
+        return etag is not None and request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    if since is not None and modified is not None:
+        return modified.replace(microsecond=0, tzinfo=None) <= \
+            since.replace(tzinfo=None)
+    return False
+
+
+def precondition_failed(etag):
+    '''
+    Whether an If-Match header was sent which `etag` does not satisfy
+    '''
+    if 'If-Match' not in request.headers:
+        return False
+    return not request.if_match.contains(etag)
+
+
+def not_modified(headers):
+    return current_app.response_class(status=304, headers=headers)
@@ -0,0 +1,65 @@
+'''
+JSON encoders for response bodies.
+
+The marshaller already turns ObjectIds and datetimes into strings, so a
+plain JSON encoder is enough for most bodies; anything BSON specific that is
+left is handled by :func:`bson.json_util.default`.
+'''
+import json
+
+from bson import json_util
+
+
+def encode_json(data, pretty=False):
+    if pretty:
+        return json_util.dumps(data, indent=4)
+    return json.dumps(data, default=json_util.default, separators=(',', ':'))
+
+
+def encode_ujson(data, pretty=False):
+    import ujson
+    if pretty:
+        return encode_json(data, pretty)
+    try:
+        return ujson.dumps(data)
+    except (TypeError, OverflowError):
+        return encode_json(data)
+
+
+def encode_orjson(data, pretty=False):
+    import orjson
+    if pretty:
+        return encode_json(data, pretty)
+    try:
+        return orjson.dumps(data, default=json_util.default).decode('utf-8')
+    except TypeError:
+        # e.g. non string keys, which the stdlib encoder accepts
+        return encode_json(data)
+
+
+ENCODERS = {
+    'json': encode_json,
+    'ujson': encode_ujson,
+    'orjson': encode_orjson,
+}
+
+# The order in which 'auto' picks an installed encoder
+PREFERRED = ('orjson', 'ujson', 'json')
+
+
+def get_encoder(name='auto'):
+    '''
+    Returns the encoder function called `name`, 'auto' picks the fastest
+    installed one. Encoders are called as ``encode(data, pretty=False)``.
+    '''
+    if name == 'auto':
+        for name in PREFERRED:
+            try:
+                __import__(name)
+            except ImportError:
+                continue
+            break
+    if name not in ENCODERS:
+        raise ValueError('Unknown JSON encoder: %s' % name)
+    __import__(name)
+    return ENCODERS[name]
@@ -0,0 +1,229 @@
+'''
+Parsing the filter arguments of requests.
+
+Query arguments are strings; :class:`FilterParser` turns them into the
+values of the fields they filter on (numbers, dates, ObjectIds, booleans,
+comma separated lists for `__in`...) before mongoengine sees them, so that
+a bad value or an unknown field is a 400 instead of a query which fails in
+the driver or silently matches nothing. The parser of a document class is
+compiled once from its `_fields`, see :func:`get_filter_parser`, and keeps
+what it worked out about each filter argument name it is given.
+'''
+from decimal import Decimal, InvalidOperation
+from weakref import WeakKeyDictionary
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from mongoengine.errors import InvalidQueryError
+from mongoengine.fields import (
+    IntField, LongField, FloatField, DecimalField, BooleanField,
+    DateTimeField, ComplexDateTimeField, ObjectIdField, ReferenceField,
+    CachedReferenceField, EmbeddedDocumentField, ListField,
+    GenericReferenceField, GenericEmbeddedDocumentField, DictField, MapField)
+from mongoengine.queryset.transform import MATCH_OPERATORS
+
+TRUE_STRINGS = ('1', 'true', 'yes', 'on')
+FALSE_STRINGS = ('0', 'false', 'no', 'off')
+
+# Operators taking a comma separated list of values
+LIST_OPERATORS = frozenset(['in', 'nin', 'all'])
+# Operators comparing with the value of the field
+VALUE_OPERATORS = frozenset(['ne', 'gt', 'gte', 'lt', 'lte'])
+# The operators whose values are converted, None is equality. The values of
+# the others (string patterns, geo queries...) are left to mongoengine.
+CONVERTED_OPERATORS = (VALUE_OPERATORS | LIST_OPERATORS |
+                       frozenset([None, 'exists', 'size', 'mod']))
+
+# How many filter argument names a parser remembers, clients choose them
+MAX_SHAPES = 1024
+
+
+def to_bool(value):
+    if value.lower() in TRUE_STRINGS:
+        return True
+    if value.lower() in FALSE_STRINGS:
+        return False
+    raise ValueError(value)
+
+
+def to_object_id(value):
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        raise ValueError(value)
+
+
+def to_decimal(value):
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        raise ValueError(value)
+
+
+def datetime_converter(field):
+    def convert(value):
+        # isoformat(), as datetimes are dumped, is understood without
+        # dateutil once the T is a space
+        converted = field.to_mongo(value.replace('T', ' ').rstrip('Z'))
+        if converted is None:
+            raise ValueError(value)
+        return converted
+    return convert
+
+
+def reference_converter(field):
+    document_type = field.document_type
+    id_field = document_type._fields[document_type._meta['id_field']]
+    return converter(id_field)
+
+
+def converter(field):
+    '''
+    The function turning a query argument into a value of `field`, None to
+    leave it a string
+    '''
+    if isinstance(field, BooleanField):
+        return to_bool
+    if isinstance(field, (IntField, LongField)):
+        return int
+    if isinstance(field, FloatField):
+        return float
+    if isinstance(field, DecimalField):
+        return to_decimal
+    if isinstance(field, (DateTimeField, ComplexDateTimeField)):
+        return datetime_converter(field)
+    if isinstance(field, ObjectIdField):
+        return to_object_id
+    if isinstance(field, (ReferenceField, CachedReferenceField)):
+        return reference_converter(field)
+    if isinstance(field, ListField) and field.field is not None:
+        # A list matches the queries on its items
+        return converter(field.field)
+    return None
+
+
+def _embedded_type(field):
+    '''
+    The class of the embedded documents `field` holds, in lists or not,
+    None for other fields (references can not be queried inside)
+    '''
+    while isinstance(field, ListField) and field.field is not None:
+        field = field.field
+    if isinstance(field, EmbeddedDocumentField):
+        return field.document_type
+    return None
+
+
+class Shape(object):
+    '''
+    What a filter argument name, e.g. views__gt, stands for: the
+    conversion of its values
+    '''
+    def __init__(self, convert, operator):
+        self.convert = convert
+        self.operator = operator
+
+    def parse(self, name, value):
+        if value is None:
+            return [] if self.operator in LIST_OPERATORS else None
+        try:
+            if self.operator in LIST_OPERATORS:
+                return [self.convert(item) if self.convert else item
+                        for item in value.split(',')]
+            if self.operator == 'exists':
+                return to_bool(value)
+            if self.operator == 'size':
+                return int(value)
+            if self.operator == 'mod':
+                return [int(item) for item in value.split(',')]
+            if self.convert is not None:
+                return self.convert(value)
+        except ValueError:
+            raise InvalidQueryError('Invalid value for %s: %s'
+                                    % (name, value))
+        return value
+
+
+PASS_THROUGH = Shape(None, None)
+
+
+class FilterParser(object):
+    '''
+    Converts the filter arguments of the queries on `document_cls`
+    '''
+    def __init__(self, document_cls):
+        self.document_cls = document_cls
+        self.fields = document_cls._fields
+        self.field_count = len(self.fields)
+        self.shapes = {}
+
+    def is_current(self):
+        fields = self.document_cls._fields
+        return fields is self.fields and len(fields) == self.field_count
+
+    def shape(self, name):
+        '''
+        The Shape of the filter argument `name`, raises InvalidQueryError
+        when it does not name a field
+        '''
+        shape = self.shapes.get(name)
+        if shape is None:
+            shape = self.compile(name)
+            if len(self.shapes) < MAX_SHAPES:
+                self.shapes[name] = shape
+        return shape
+
+    def compile(self, name):
+        parts = name.split('__')
+        operators = []
+        while len(parts) > 1 and parts[-1] in MATCH_OPERATORS:
+            operators.insert(0, parts.pop())
+        if operators[:1] == ['not']:
+            operators.pop(0)
+        operator = operators[0] if operators else None
+        document_cls, field = self.document_cls, None
+        for index, part in enumerate(parts):
+            if field is not None:
+                if isinstance(field, ListField) and part.isdigit():
+                    # An index into the list, e.g. tags__0
+                    continue
+                document_cls = _embedded_type(field)
+                if document_cls is None:
+                    if isinstance(field, (DictField, MapField,
+                                          GenericEmbeddedDocumentField)):
+                        return PASS_THROUGH
+                    raise InvalidQueryError(
+                        'Can not query inside %s' % '__'.join(parts[:index]))
+            if part == 'pk':
+                part = document_cls._meta['id_field']
+            field = document_cls._fields.get(part)
+            if field is None:
+                if getattr(document_cls, '_dynamic', False):
+                    return PASS_THROUGH
+                raise InvalidQueryError('Unknown field: %s' % name)
+        if (operator not in CONVERTED_OPERATORS or
+                isinstance(field, GenericReferenceField)):
+            return Shape(None, operator)
+        return Shape(converter(field), operator)
+
+    def parse(self, args, passthrough=()):
+        '''
+        The filter arguments `args` (name to string, or None) with their
+        values converted, those in `passthrough` are left alone
+        '''
+        return dict((name, value if name in passthrough
+                     else self.shape(name).parse(name, value))
+                    for name, value in args.items())
+
+
+_parsers = WeakKeyDictionary()
+
+
+def get_filter_parser(document_cls):
+    '''
+    Returns the cached :class:`FilterParser` of `document_cls`
+    '''
+    parser = _parsers.get(document_cls)
+    if parser is None or not parser.is_current():
+        parser = _parsers[document_cls] = FilterParser(document_cls)
+    return parser
@@ -1,79 +1,952 @@
 from mongoengine.fields import (ReferenceField, EmbeddedDocumentField,
-                                BinaryField, ListField)
-from mongoengine.errors import ValidationError
+                                BinaryField, ListField, StringField,
+                                IntField, FloatField, BooleanField,
+                                DateTimeField, ObjectIdField)
+from mongoengine.errors import (ValidationError, DoesNotExist,
+                                InvalidQueryError)
 from datetime import datetime
 from bson.objectid import ObjectId
+from bson.dbref import DBRef
+from bson.son import SON
+from mongoengine.document import Document
+from weakref import WeakKeyDictionary
+import functools
 
 
-class Marshaller(object):
+class MarshalPlan(object):
     '''
-    This class is responsible for loading and dropping from and to json given
-    a :mongoengine.document.Document
+    The field layout of a document class as the Marshaller needs it.
+
+    Walking :attr:`_fields` is done once per class, see :func:`get_plan`.
     '''
-    def __init__(self, doc):
-        self.doc = doc
-        self.document_cls = doc.__class__
-        self.related_fields = []
-        self.list_related_fields = []
-        self.binary_fields = []
-        self.embedded_fields = []
-        for k, v in self.document_cls._fields.items():
+    def __init__(self, document_cls):
+        self.document_cls = document_cls
+        self.fields = document_cls._fields
+        self.field_count = len(self.fields)
+        self.related_fields = set()
+        self.list_related_fields = set()
+        self.binary_fields = {}
+        self.embedded_fields = set()
+        for k, v in self.fields.items():
             if isinstance(v, ReferenceField):
-                self.related_fields.append(k)
+                self.related_fields.add(k)
             if isinstance(v, BinaryField):
-                self.binary_fields.append(k)
+                self.binary_fields[k] = v
             if isinstance(v, EmbeddedDocumentField):
-                self.embedded_fields.append(k)
+                self.embedded_fields.add(k)
             if isinstance(v, ListField):
                 if isinstance(v.field, ReferenceField):
-                    self.list_related_fields.append(k)
+                    self.list_related_fields.add(k)
+        self._raw = None
+        self.spec = DocumentSpec(self)
+        self._specs = None
+
+    @property
+    def specs(self):
+        '''
+        The conversion specs of the keys of a dumped document, see
+        :func:`convert`
+        '''
+        if self._specs is None:
+            specs = {}
+            for name, field in self.fields.items():
+                specs[field.db_field] = field_spec(field)
+                if _is_reference(field):
+                    # dumps() puts referenced documents under the name
+                    specs[name] = specs[field.db_field]
+            id_field = self.document_cls._meta.get('id_field')
+            if id_field in self.fields:
+                specs['id'] = field_spec(self.fields[id_field])
+            self._specs = specs
+        return self._specs
+
+    @property
+    def raw(self):
+        '''
+        The :class:`RawSchema` of the document class, built on first use
+        '''
+        if self._raw is None:
+            self._raw = RawSchema(self.document_cls)
+        return self._raw
+
+    def is_current(self):
+        '''
+        False once the document class got a new set of fields
+        '''
+        fields = self.document_cls._fields
+        return fields is self.fields and len(fields) == self.field_count
+
+
+_plans = WeakKeyDictionary()
+
+
+def get_plan(document_cls):
+    '''
+    Returns the cached :class:`MarshalPlan` for `document_cls`, rebuilding
+    it if the class has changed since it was compiled
+    '''
+    plan = _plans.get(document_cls)
+    if plan is None or not plan.is_current():
+        plan = _plans[document_cls] = MarshalPlan(document_cls)
+    return plan
+
+
+def invalidate_plan(document_cls=None):
+    '''
+    Drops the cached plan of `document_cls`, or every plan if not given
+    '''
+    if document_cls is None:
+        _plans.clear()
+    else:
+        _plans.pop(document_cls, None)
+
+
+def to_pk(document_cls, value):
+    '''
+    Converts `value` to a primary key of `document_cls`, None if it can not
+    be one
+    '''
+    id_field = document_cls._fields[document_cls._meta['id_field']]
+    try:
+        pk = id_field.to_python(value)
+        id_field.validate(pk)
+    except ValidationError:
+        return None
+    return pk
+
+
+# Field classes whose values, when pymongo returns them with one of these
+# exact types, are what to_mongo(to_python(value)) would give back
+_RAW_TYPES = (
+    (StringField, (unicode, )),
+    (IntField, (int, long)),
+    (FloatField, (float, )),
+    (BooleanField, (bool, )),
+    (DateTimeField, (datetime, )),
+    (ObjectIdField, (ObjectId, )),
+)
+
+
+def _function(method):
+    return getattr(method, '__func__', method)
+
+
+def _raw_types(field):
+    for field_cls, types in _RAW_TYPES:
+        if (isinstance(field, field_cls) and
+                _function(type(field).to_python) ==
+                _function(field_cls.to_python) and
+                _function(type(field).to_mongo) ==
+                _function(field_cls.to_mongo)):
+            return types
+    return None
+
+
+class RawSchema(object):
+    '''
+    Turns the SON of a `document_cls` read with as_pymongo() into what
+    to_mongo() of the hydrated document would return: unknown keys are
+    dropped, defaults filled in and values converted field by field, most
+    of them by passing them through.
+
+    Models with inheritance, dynamic or self generating fields are not
+    `supported`, they have to be hydrated.
+    '''
+    def __init__(self, document_cls):
+        self.document_cls = document_cls
+        self.supported = not (document_cls._meta.get('allow_inheritance') or
+                              document_cls._dynamic or
+                              any(field._auto_gen for field in
+                                  document_cls._fields.values()))
+        self.fields = [(field, field.db_field, self.converter(field))
+                       for field in (document_cls._fields[name] for name in
+                                     document_cls._fields_ordered)]
+
+    def converter(self, field):
+        '''
+        The function converting a raw value of `field`
+        '''
+        def generic(value):
+            return field.to_mongo(field.to_python(value))
+        types = _raw_types(field)
+        if types is not None:
+            return lambda value: (value if type(value) in types
+                                  else generic(value))
+        if isinstance(field, EmbeddedDocumentField):
+            document_type = field.document_type
+
+            def embedded(value):
+                # Looked up when called, embedded documents can nest
+                schema = get_plan(document_type).raw
+                if not schema.supported or not isinstance(value, dict):
+                    return generic(value)
+                return schema.normalize(value)
+            return embedded
+        if isinstance(field, ListField) and field.field is not None:
+            item = self.converter(field.field)
+            return lambda value: ([item(v) for v in value]
+                                  if isinstance(value, list)
+                                  else generic(value))
+        return generic
+
+    def normalize(self, son, only_fields=None):
+        '''
+        The SON of `son` as its hydrated document would dump it; fields in
+        `only_fields` (the names passed to QuerySet.only) get no default
+        '''
+        data = SON()
+        data['_id'] = None
+        for field, db_field, convert in self.fields:
+            value = son.get(db_field)
+            if value is not None:
+                value = convert(value)
+            elif db_field in son and field.null:
+                # Other fields get their default for a stored null, like
+                # mongoengine does
+                pass
+            elif only_fields and db_field in only_fields:
+                value = None
+            else:
+                value = field.default
+                if callable(value):
+                    value = value()
+                if value is not None:
+                    value = field.to_mongo(value)
+            if value is not None or field.null:
+                data[db_field] = value
+        if data['_id'] is None:
+            del data['_id']
+        return data
+
+
+class RawData(object):
+    '''
+    The `_data` of a :class:`RawDocument`: field values by name, converted
+    to python on access
+    '''
+    def __init__(self, doc):
+        self.doc = doc
+        self.values = {}
+
+    def get(self, name, default=None):
+        if name in self.values:
+            return self.values[name]
+        field = self.doc.document_cls._fields.get(name)
+        if field is None:
+            return default
+        value = self.doc.mongo().get(field.db_field)
+        if value is not None:
+            value = field.to_python(value)
+        self.values[name] = value
+        return value
+
+
+class RawDocument(object):
+    '''
+    A document read with as_pymongo(), standing in for the hydrated
+    `document_cls` instance where it is only read and marshalled.
+    Reading a reference gives its DBRef, nothing is dereferenced.
+    '''
+    def __init__(self, document_cls, son, only_fields=None):
+        self.document_cls = document_cls
+        self.son = son
+        self.only_fields = only_fields
+        self._mongo = None
+        self._data = RawData(self)
+
+    def __getattr__(self, name):
+        if name in self.document_cls._fields:
+            return self._data.get(name)
+        raise AttributeError(name)
+
+    @property
+    def pk(self):
+        return self._data.get(self.document_cls._meta['id_field'])
+
+    def mongo(self):
+        if self._mongo is None:
+            self._mongo = get_plan(self.document_cls).raw.normalize(
+                self.son, self.only_fields)
+        return self._mongo
+
+    def to_mongo(self):
+        return SON(self.mongo())
+
+    def _get_collection_name(self):
+        return self.document_cls._get_collection_name()
+
+
+def reference_key(reference):
+    '''
+    The (collection, primary key) of a DBRef or a document
+    '''
+    if isinstance(reference, DBRef):
+        return reference.collection, reference.id
+    return reference._get_collection_name(), reference.pk
+
+
+def reference_id(reference):
+    '''
+    What a reference which is not expanded is dumped as
+    '''
+    if isinstance(reference, DBRef):
+        return reference.id
+    if isinstance(reference, (Document, RawDocument)):
+        return reference.pk
+    return reference
+
+
+def document_class(doc):
+    '''
+    The document class of `doc`, a document or a :class:`RawDocument`
+    '''
+    if isinstance(doc, RawDocument):
+        return doc.document_cls
+    return doc.__class__
+
+
+# Types which are left as they are, and converters of the other BSON types,
+# by exact type; subclasses are looked up once in _kinds
+_NATIVE_TYPES = frozenset([unicode, str, int, long, float, bool,
+                           type(None)])
+_SCALARS = {
+    datetime: datetime.isoformat,
+    ObjectId: str,
+}
+_DICT = 'dict'
+_LIST = 'list'
+_kinds = {dict: _DICT, SON: _DICT, list: _LIST}
+
+
+def _kind(value_type):
+    kind = _kinds.get(value_type)
+    if kind is None:
+        kind = value_type
+        if issubclass(value_type, dict):
+            kind = _DICT
+        elif issubclass(value_type, list):
+            kind = _LIST
+        else:
+            for scalar_type, scalar in _SCALARS.items():
+                if issubclass(value_type, scalar_type):
+                    kind = scalar
+        _kinds[value_type] = kind
+    return kind
+
+
+class Native(object):
+    '''
+    Spec of the values of a field which are JSON native already
+    '''
+    def step(self, value, stack):
+        if type(value) in _NATIVE_TYPES:
+            return value
+        return _generic_step(value, stack)
+
+
+class Scalar(object):
+    '''
+    Spec of the values of a field `function` converts, if given `types`
+    only values of those exact types
+    '''
+    def __init__(self, function, types=None):
+        self.function = function
+        self.types = types
+
+    def step(self, value, stack):
+        if self.types is None or type(value) in self.types:
+            return self.function(value)
+        return _generic_step(value, stack)
+
+
+class Reference(object):
+    '''
+    Spec of a reference, which dumps() replaced by the referenced document
+    dumped and converted by its own Marshaller, or by its id
+    '''
+    def step(self, value, stack):
+        if type(value) is dict:
+            return value
+        return _generic_step(value, stack)
+
+
+class ListSpec(object):
+    '''
+    Spec of a list whose items have the spec `item`; lists of native
+    values are kept as they are
+    '''
+    def __init__(self, item):
+        self.item = item
+
+    def step(self, value, stack):
+        if not isinstance(value, list):
+            return _generic_step(value, stack)
+        item = self.item
+        if item is _NATIVE and all(
+                type(v) in _NATIVE_TYPES for v in value):
+            # Nothing to convert, the list is not copied
+            return value
+        result = [None] * len(value)
+        for index, v in enumerate(value):
+            stack.append((result, index, v, item))
+        return result
+
+
+class DocumentSpec(object):
+    '''
+    Spec of the SON of the document class of `plan`, each of its keys is
+    converted according to the field it holds
+    '''
+    def __init__(self, plan):
+        self.plan = plan
+
+    def step(self, value, stack):
+        if not isinstance(value, dict):
+            return _generic_step(value, stack)
+        plan = self.plan
+        if not plan.is_current():
+            plan = self.plan = get_plan(plan.document_cls)
+        specs = plan._specs or plan.specs
+        result = {}
+        for k, v in value.iteritems():
+            spec = specs.get(k)
+            if spec is None:
+                if type(v) in _NATIVE_TYPES:
+                    result[k] = v
+                else:
+                    stack.append((result, k, v, None))
+            elif spec is _NATIVE and type(v) in _NATIVE_TYPES:
+                result[k] = v
+            else:
+                stack.append((result, k, v, spec))
+        return result
+
+
+_NATIVE = Native()
+_REFERENCE = Reference()
+
+
+def _generic_step(value, stack):
+    '''
+    Converts a value of unknown schema according to its type
+    '''
+    value_type = type(value)
+    if value_type in _NATIVE_TYPES:
+        return value
+    scalar = _SCALARS.get(value_type)
+    if scalar is not None:
+        return scalar(value)
+    kind = _kind(value_type)
+    if kind is _DICT:
+        result = {}
+        for k, v in value.iteritems():
+            if type(v) in _NATIVE_TYPES:
+                result[k] = v
+            else:
+                stack.append((result, k, v, None))
+        return result
+    if kind is _LIST:
+        result = [None] * len(value)
+        for index, v in enumerate(value):
+            stack.append((result, index, v, None))
+        return result
+    if kind is value_type:
+        # Left for the JSON encoder
+        return value
+    return kind(value)
+
+
+def field_spec(field):
+    '''
+    How the values `field` dumps are converted, None if it is not known
+    '''
+    if isinstance(field, BinaryField):
+        return Scalar(lambda value: str(field.to_python(value)))
+    if _is_reference(field) and not isinstance(field, ListField):
+        return _REFERENCE
+    if isinstance(field, EmbeddedDocumentField):
+        return get_plan(field.document_type).spec
+    if isinstance(field, ListField):
+        if field.field is None:
+            return None
+        item = field_spec(field.field)
+        return None if item is None else ListSpec(item)
+    types = _raw_types(field)
+    if types is None:
+        return None
+    if isinstance(field, (DateTimeField, ObjectIdField)):
+        return Scalar(_SCALARS[types[0]], types)
+    return _NATIVE
+
+
+def convert(value, spec=None):
+    '''
+    Converts the BSON compatible `value` into a JSON compatible one. The
+    spec of the field `value` comes from (see :func:`field_spec`) says
+    which parts can need converting, without one every value is looked at.
+
+    Containers are walked with an explicit stack so that deeply nested
+    documents do not run into the recursion limit.
+    '''
+    result = [None]
+    stack = [(result, 0, value, spec)]
+    pop = stack.pop
+    while stack:
+        target, key, value, spec = pop()
+        if spec is None:
+            target[key] = _generic_step(value, stack)
+        else:
+            target[key] = spec.step(value, stack)
+    return result[0]
+
+
+def _path_tree(paths):
+    tree = {}
+    for path in paths:
+        node = tree
+        names = path.split('.')
+        for name in names[:-1]:
+            child = node.get(name, {})
+            if child is None:
+                break
+            node = node.setdefault(name, child)
+        else:
+            node[names[-1]] = None
+    return tree
+
+
+class Projection(object):
+    '''
+    The fields of a document to dump, given as dotted paths which can reach
+    into embedded and referenced documents, e.g. ``author.email``.
+
+    `include` and `exclude` are trees of field names, a None leaf standing
+    for the whole field; an `include` of None means every field.
+    '''
+    def __init__(self, include=None, exclude=None):
+        self.include = include
+        self.exclude = exclude or {}
+
+    @classmethod
+    def parse(cls, fields=None, exclude=None):
+        '''
+        Builds a projection from comma separated paths, returns None if
+        neither restricts anything
+        '''
+        fields = [f.strip() for f in (fields or '').split(',') if f.strip()]
+        exclude = [f.strip() for f in (exclude or '').split(',')
+                   if f.strip()]
+        if not fields and not exclude:
+            return None
+        return cls(_path_tree(fields) if fields else None,
+                   _path_tree(exclude))
+
+    def key(self):
+        '''
+        A hashable value equal for equal projections
+        '''
+        def freeze(tree):
+            if tree is None:
+                return None
+            return tuple(sorted((name, freeze(subtree))
+                                for name, subtree in tree.items()))
+        return freeze(self.include), freeze(self.exclude)
+
+    def allows(self, name):
+        if name in self.exclude and self.exclude[name] is None:
+            return False
+        return self.include is None or name in self.include
+
+    def child(self, name):
+        '''
+        The projection of the embedded or referenced document `name`, None
+        if it is dumped whole
+        '''
+        include = None if self.include is None else self.include.get(name)
+        exclude = self.exclude.get(name)
+        if include is None and exclude is None:
+            return None
+        return self.__class__(include, exclude)
+
+    def validate(self, document_cls):
+        '''
+        Raises InvalidQueryError for paths that are not fields of
+        `document_cls`
+        '''
+        for tree in (self.include or {}, self.exclude):
+            for name in tree:
+                field = document_cls._fields.get(name)
+                if field is None:
+                    raise InvalidQueryError('Unknown field: %s' % name)
+                child = self.child(name)
+                target = _document_type(field)
+                if child is not None:
+                    if target is None:
+                        raise InvalidQueryError(
+                            '%s has no sub fields' % name)
+                    child.validate(target)
+
+    def mongo_paths(self, document_cls):
+        '''
+        Returns the paths to pass to QuerySet.only and QuerySet.exclude,
+        paths into referenced documents stop at the reference
+        '''
+        def paths(tree, exclude, document_cls, prefix=''):
+            result = []
+            for name, subtree in tree.items():
+                field = document_cls._fields[name]
+                target = _document_type(field)
+                if (subtree is None or target is None or
+                        _is_reference(field)):
+                    if not (exclude and subtree is not None):
+                        result.append(prefix + name)
+                else:
+                    result.extend(paths(subtree, exclude, target,
+                                        prefix + name + '.'))
+            return result
+        only = None
+        if self.include is not None:
+            only = paths(self.include, False, document_cls)
+        return only, paths(self.exclude, True, document_cls)
+
+    def apply(self, data, document_cls):
+        '''
+        Drops the fields the projection leaves out from the SON `data` of a
+        `document_cls`, references are left to their own Marshaller
+        '''
+        for name, field in document_cls._fields.items():
+            if name == 'id' or field.db_field not in data:
+                continue
+            if not self.allows(name):
+                del data[field.db_field]
+                continue
+            child = self.child(name)
+            target = _document_type(field)
+            if child is None or target is None or _is_reference(field):
+                continue
+            value = data[field.db_field]
+            for item in (value if isinstance(value, list) else [value]):
+                if isinstance(item, dict):
+                    child.apply(item, target)
+        return data
+
+
+def _expansion_tree(paths):
+    '''
+    The tree of the reference `paths`; unlike in a projection's, a path
+    going deeper than another extends it: author,author.company inlines the
+    author and its company
+    '''
+    tree = {}
+    for path in paths:
+        node = tree
+        names = path.split('.')
+        for name in names[:-1]:
+            node[name] = node.get(name) or {}
+            node = node[name]
+        node.setdefault(names[-1], None)
+    return tree
+
+
+class Expansion(object):
+    '''
+    Which references of a document are dumped inline, the others are
+    dumped as their id: those named in `tree` (a tree of field names like
+    Projection's, e.g. from ``author,author.company``), or else all of them
+    down to `depth` levels, or else all of them.
+    '''
+    def __init__(self, tree=None, depth=None):
+        self.tree = tree
+        self.depth = depth
+
+    @classmethod
+    def parse(cls, value):
+        '''
+        Builds an expansion from a number of levels, or comma separated
+        reference paths; '*' inlines everything and nothing (None, '')
+        inlines nothing
+        '''
+        if isinstance(value, (int, long)):
+            return cls(depth=value)
+        value = (value or '').strip()
+        if value == '*':
+            return cls()
+        if value.isdigit():
+            return cls(depth=int(value))
+        return cls(tree=_expansion_tree(
+            [path.strip() for path in value.split(',') if path.strip()]))
+
+    def allows(self, name):
+        if self.tree is not None:
+            return name in self.tree
+        return self.depth is None or self.depth > 0
+
+    def child(self, name):
+        '''
+        The expansion of the documents referenced by `name`
+        '''
+        if self.tree is not None:
+            return self.__class__(tree=self.tree.get(name) or {})
+        if self.depth is not None:
+            return self.__class__(depth=self.depth - 1)
+        return self
+
+    def key(self):
+        if self.tree is not None:
+            return 'tree', Projection(self.tree).key()
+        return 'depth', self.depth
+
+    def validate(self, document_cls):
+        '''
+        Raises InvalidQueryError for paths that are not references of
+        `document_cls`
+        '''
+        for name in self.tree or {}:
+            field = document_cls._fields.get(name)
+            if field is None or not _is_reference(field):
+                raise InvalidQueryError('Unknown reference: %s' % name)
+            self.child(name).validate(_document_type(field))
+
+
+def _is_reference(field):
+    return isinstance(getattr(field, 'field', field), ReferenceField)
+
+
+def _document_type(field):
+    '''
+    The document class of an embedded or reference field, or of the
+    elements of a list of those
+    '''
+    field = getattr(field, 'field', field)
+    if isinstance(field, (ReferenceField, EmbeddedDocumentField)):
+        return field.document_type
+    return None
+
+
+class ReferenceLoader(object):
+    '''
+    Collects the references met while loading json into a document, so
+    they can be fetched with one `$in` query per referenced document class.
+
+    With `check` set to False nothing is fetched and the references are
+    stored as :class:`bson.dbref.DBRef` without checking they exist.
+    '''
+    def __init__(self, check=True, identity_map=None):
+        self.check = check
+        self.identity_map = identity_map
+        self.pending = {}
+        self.errors = {}
+
+    def add(self, field_name, field, value, assign):
+        '''
+        Schedules `assign` to be called with the document `value` refers to
+        '''
+        document_cls = field.document_type
+        pk = to_pk(document_cls, value)
+        if pk is None:
+            self.errors.setdefault(field_name, []).append(value)
+            return
+        wanted = self.pending.setdefault(document_cls, {})
+        wanted.setdefault(pk, []).append((field_name, assign))
+
+    def fetch(self, document_cls, pks):
+        collection = document_cls._get_collection_name()
+        found = {}
+        if self.identity_map is not None:
+            for pk in pks:
+                doc = self.identity_map.get(DBRef(collection, pk))
+                if doc is not None:
+                    found[pk] = doc
+        missing = [pk for pk in pks if pk not in found]
+        if self.identity_map is not None:
+            self.identity_map.hits += len(found)
+            self.identity_map.misses += len(missing)
+        if missing:
+            for doc in document_cls.objects(pk__in=missing):
+                found[doc.pk] = doc
+                if self.identity_map is not None:
+                    self.identity_map.add(doc)
+        return found
+
+    def resolve(self):
+        for document_cls, wanted in self.pending.items():
+            if self.check:
+                found = self.fetch(document_cls, list(wanted))
+            else:
+                collection = document_cls._get_collection_name()
+                found = dict((pk, DBRef(collection, pk)) for pk in wanted)
+            for pk, assignments in wanted.items():
+                for field_name, assign in assignments:
+                    if pk in found:
+                        assign(found[pk])
+                    else:
+                        self.errors.setdefault(field_name, []).append(pk)
+        if self.errors:
+            raise ValidationError(
+                'Referenced documents do not exist',
+                errors=dict((field_name, 'Unknown reference(s): %s'
+                             % ', '.join(sorted(set(map(unicode, pks)))))
+                            for field_name, pks in self.errors.items()))
+
+
+class Marshaller(object):
+    '''
+    This class is responsible for loading and dropping from and to json given
+    a :mongoengine.document.Document
+    '''
+    def __init__(self, doc, identity_map=None, check_references=True,
+                 projection=None, expansion=None, ancestors=None):
+        self.doc = doc
+        self.document_cls = document_class(doc)
+        self.identity_map = identity_map
+        self.check_references = check_references
+        self.projection = projection
+        self.expansion = expansion or Expansion()
+        # The documents being dumped further up, a reference to one of them
+        # is a cycle
+        self.ancestors = ancestors
+        self.inlined = set()
+        self.cuts = set()
+        self.plan = get_plan(self.document_cls)
+        self.related_fields = self.plan.related_fields
+        self.list_related_fields = self.plan.list_related_fields
+        self.binary_fields = self.plan.binary_fields
+        self.embedded_fields = self.plan.embedded_fields
+
+    def related(self, field):
+        '''
+        Returns the document referenced by `field`, taken from the identity
+        map when it has been prefetched
+        '''
+        if self.identity_map is not None:
+            related = self.identity_map.get(self.doc._data.get(field))
+            if related is not None:
+                return related
+        try:
+            related = getattr(self.doc, field)
+        except DoesNotExist:
+            return self.doc._data.get(field)
+        if self.identity_map is not None and isinstance(related, Document):
+            self.identity_map.add(related)
+        return related
+
+    def related_list(self, field):
+        '''
+        Returns the documents referenced by the list `field`, taken from the
+        identity map when all of them have been prefetched
+        '''
+        if self.identity_map is not None:
+            related = [self.identity_map.get(v)
+                       for v in self.doc._data.get(field) or ()]
+            if None not in related:
+                return related
+        return getattr(self.doc, field)
 
     def dumps(self):
+        '''
+        Returns the document as JSON compatible data. References the
+        expansion leaves out, or which point back to a document being dumped
+        further up, are dumped as their id; :attr:`inlined` and :attr:`cuts`
+        then hold the keys of the documents dumped inline and of those cut
+        short.
+        '''
+        self.inlined = set()
+        self.cuts = set()
+        if self.ancestors is None:
+            self.ancestors = frozenset([reference_key(self.doc)])
         data = self.doc.to_mongo()
+        projection = self.projection
+        expansion = self.expansion
+        if projection is not None:
+            projection.apply(data, self.document_cls)
         for field in self.related_fields:
-            if getattr(self.doc, field):
-                data[field] = self.__class__(getattr(self.doc, field)).dumps()
+            if projection is not None and not projection.allows(field):
+                continue
+            if not expansion.allows(field):
+                data[field] = reference_id(self.doc._data.get(field))
+                continue
+            related = self.related(field)
+            if related:
+                data[field] = self.dump_related(related, field)
             else:
                 data[field] = None
         data['id'] = data['_id']
         del data['_id']
         for field in self.list_related_fields:
-            data[field] = [self.__class__(v).dumps() for v in
-                           getattr(self.doc, field)]
+            if projection is not None and not projection.allows(field):
+                continue
+            if not expansion.allows(field):
+                data[field] = [reference_id(v) for v in
+                               self.doc._data.get(field) or ()]
+                continue
+            data[field] = [self.dump_related(v, field)
+                           for v in self.related_list(field)]
         return self.convertor(data)
 
-    def convertor(self, value, parent=None, parent_key=None):
-        '''
-        Converts a BSON compatible JSON string into a REST compatible JSON
-        string
-        '''
-        if parent_key in self.binary_fields:
-            document_field = getattr(self.document_cls, parent_key)
-            if hasattr(document_field, 'to_python'):
-                return str(document_field.to_python(value))
-        if isinstance(value, BinaryField):
-            if hasattr(value, 'to_python'):
-                return value.to_python()
-        if isinstance(value, datetime):
-            return value.isoformat()
-        if isinstance(value, ObjectId):
-            return str(value)
-        if isinstance(value, list):
-            return [self.convertor(k) for k in value]
-        if isinstance(value, dict):
-            return dict((k, self.convertor(v, parent=value, parent_key=k))
-                        for k, v in value.iteritems())
+    def dump_related(self, related, field):
+        if isinstance(related, DBRef):
+            # A dangling reference, only its id is known
+            return related.id
+        key = reference_key(related)
+        if key in self.ancestors:
+            self.cuts.add(key)
+            return related.pk
+        projection = None
+        if self.projection is not None:
+            projection = self.projection.child(field)
+        expansion = self.expansion.child(field)
 
-        return value
+        def dump():
+            nested = self._nested(related, projection, expansion,
+                                  self.ancestors | set([key]))
+            data = nested.dumps()
+            return (data, frozenset(nested.inlined),
+                    frozenset(nested.cuts - set([key])))
+        if self.identity_map is None:
+            data, inlined, cuts = dump()
+        else:
+            data, inlined, cuts = self.identity_map.dump(
+                related, (projection and projection.key(), expansion.key()),
+                self.ancestors, dump)
+        self.inlined.add(key)
+        self.inlined.update(inlined)
+        self.cuts.update(cuts)
+        return data
+
+    def convertor(self, value):
+        '''
+        Converts the BSON compatible SON of a document of this class into a
+        REST compatible JSON structure
+        '''
+        return convert(value, self.plan.spec)
 
     def loads(self, json_data):
+        references = ReferenceLoader(self.check_references,
+                                     self.identity_map)
+        self._load(json_data, references)
+        references.resolve()
+        return self.doc
+
+    def _nested(self, doc, projection=None, expansion=None, ancestors=None):
+        return self.__class__(doc, self.identity_map, self.check_references,
+                              projection, expansion, ancestors)
+
+    def _load(self, json_data, references, prefix=''):
         for field_name, value in json_data.items():
-            field = getattr(self.document_cls, field_name)
+            field = self.plan.fields.get(field_name)
+            if field is None:
+                field = getattr(self.document_cls, field_name, None)
+                if field is None:
+                    raise ValidationError('Unknown field',
+                                          field_name=prefix + field_name)
 
             if field_name in self.related_fields:
-                related_doc = field.document_type
-                related_document_ref = related_doc.objects.get(pk=value)
-                setattr(self.doc, field_name, related_document_ref)
+                if value is None:
+                    setattr(self.doc, field_name, None)
+                else:
+                    references.add(
+                        prefix + field_name, field, value,
+                        functools.partial(setattr, self.doc, field_name))
             elif field_name in self.embedded_fields:
                 embedded_doc = field.document_type
 
@@ -81,7 +954,8 @@ class Marshaller(object):
                     d = None
                 elif isinstance(value, dict):
                     d = embedded_doc()
-                    self.__class__(d).loads(value)
+                    self._nested(d)._load(value, references,
+                                          prefix + field_name + '.')
                 else:
                     raise ValidationError(
                         field_name=field_name,
@@ -96,7 +970,8 @@ class Marshaller(object):
                     if isinstance(v, dict):
                         embedded_doc = field.field.document_type
                         d = embedded_doc()
-                        self.__class__(d).loads(v)
+                        self._nested(d)._load(v, references,
+                                              prefix + field_name + '.')
                         dct[k] = d
                     else:
                         dct[k] = v
@@ -104,6 +979,7 @@ class Marshaller(object):
             elif isinstance(value, list):
                 #Fallback for listfield
                 setattr(self.doc, field_name, [])
+                lst = getattr(self.doc, field_name)
                 try:
                     embedded_doc = field.field
                 except:
@@ -111,14 +987,16 @@ class Marshaller(object):
                 for child in value:
                     if isinstance(embedded_doc, EmbeddedDocumentField):
                         d = embedded_doc.document_type()
-                        self.__class__(d).loads(child)
-                        getattr(self.doc, field_name).append(d)
+                        self._nested(d)._load(child, references,
+                                              prefix + field_name + '.')
+                        lst.append(d)
                     elif isinstance(embedded_doc, ReferenceField):
-                        reference_doc = embedded_doc.document_type
-                        d = reference_doc.objects.get(pk=child)
-                        getattr(self.doc, field_name).append(d)
+                        lst.append(None)
+                        references.add(
+                            prefix + field_name, embedded_doc, child,
+                            functools.partial(lst.__setitem__, len(lst) - 1))
                     else:
-                        getattr(self.doc, field_name).append(child)
+                        lst.append(child)
             else:
                 setattr(self.doc, field_name, value)
         return self.doc
@@ -0,0 +1,297 @@
+'''
+Where the time of a request goes.
+
+While a request is served its :class:`Timings` collect the seconds spent in
+each phase (parsing the arguments, querying, resolving references,
+marshalling, encoding) through :func:`timed`, and the MongoDB commands it
+sent through the :class:`CommandCounter` command listener. CuddlyRest sends
+them back in a Server-Timing header and adds them to a :class:`Metrics`
+registry, histograms per endpoint which :meth:`Metrics.render` gives in the
+Prometheus text format.
+'''
+import bisect
+import functools
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from timeit import default_timer
+
+from pymongo import monitoring
+
+# The content type of Metrics.render()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds (in seconds) of the buckets of the timing histograms
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+                2.5, 5, 10)
+# Upper bounds of the buckets of the MongoDB commands per request histogram
+COMMAND_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+_local = threading.local()
+
+
+class Timings(object):
+    '''
+    The phases and MongoDB commands of one request
+    '''
+    def __init__(self):
+        self.start = default_timer()
+        self.phases = OrderedDict()
+        self.commands = 0
+        self.command_seconds = 0.0
+        # Phases can be timed from the threads of an executor
+        self.lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def command(self, seconds):
+        with self.lock:
+            self.commands += 1
+            self.command_seconds += seconds
+
+    def elapsed(self):
+        return default_timer() - self.start
+
+    def server_timing(self):
+        '''
+        The value of a Server-Timing header, durations in milliseconds
+        '''
+        metrics = ['%s;dur=%.3f' % (phase, seconds * 1000)
+                   for phase, seconds in self.phases.items()]
+        metrics.append('db;dur=%.3f;desc="%d commands"'
+                       % (self.command_seconds * 1000, self.commands))
+        metrics.append('total;dur=%.3f' % (self.elapsed() * 1000))
+        return ', '.join(metrics)
+
+
+def current_timings():
+    '''
+    The Timings of the request served by this thread, None if it is not
+    instrumented
+    '''
+    return getattr(_local, 'timings', None)
+
+
+def start_timings():
+    '''
+    Starts timing the request served by this thread
+    '''
+    _local.timings = Timings()
+
+
+def stop_timings():
+    '''
+    Stops timing the request served by this thread, returns its Timings
+    '''
+    timings = current_timings()
+    _local.timings = None
+    return timings
+
+
+@contextmanager
+def timed(phase):
+    '''
+    Adds the time spent in the with block to `phase` of the current request
+    '''
+    timings = current_timings()
+    if timings is None:
+        yield
+        return
+    start = default_timer()
+    try:
+        yield
+    finally:
+        timings.add(phase, default_timer() - start)
+
+
+def timing(phase, function):
+    '''
+    Wraps `function` so that the time of its calls is added to `phase`
+    '''
+    @functools.wraps(function)
+    def run(*args, **kwargs):
+        with timed(phase):
+            return function(*args, **kwargs)
+    return run
+
+
+def carry(function):
+    '''
+    Wraps `function` so that, called from another thread, what it does is
+    still accounted to the current request
+    '''
+    timings = current_timings()
+    if timings is None:
+        return function
+
+    def run():
+        _local.timings = timings
+        try:
+            return function()
+        finally:
+            _local.timings = None
+    return run
+
+
+class CommandCounter(monitoring.CommandListener):
+    '''
+    Counts the MongoDB commands of the instrumented requests and the time
+    they took. It is installed globally by :func:`install`, which only
+    reaches the clients created afterwards; give it in the `event_listeners`
+    of a client created earlier.
+    '''
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        timings = current_timings()
+        if timings is not None:
+            timings.command(event.duration_micros / 1e6)
+
+    failed = succeeded
+
+
+command_counter = CommandCounter()
+_installed = []
+
+
+def install():
+    '''
+    Registers :data:`command_counter` with pymongo, once
+    '''
+    if not _installed:
+        monitoring.register(command_counter)
+        _installed.append(command_counter)
+
+
+def _escape(value):
+    return (unicode(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for name, value in pairs)
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram(object):
+    '''
+    Observations counted in cumulative buckets per set of label values
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.series = {}
+
+    def observe(self, values, value):
+        series = self.series.get(values)
+        if series is None:
+            series = self.series[values] = [
+                [0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        for values in sorted(self.series):
+            counts, total = self.series[values]
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'), ),
+                                    counts):
+                cumulative += count
+                yield ('_bucket', _labels(self.labels, values,
+                                          [('le', _number(bound))]),
+                       cumulative)
+            yield '_sum', _labels(self.labels, values), total
+            yield '_count', _labels(self.labels, values), cumulative
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = {}
+
+    def inc(self, values, amount=1):
+        self.series[values] = self.series.get(values, 0) + amount
+
+    def samples(self):
+        for values in sorted(self.series):
+            yield '', _labels(self.labels, values), self.series[values]
+
+
+class Metrics(object):
+    '''
+    The registry of the instrumented requests of one or more CuddlyRest
+    apis, labelled by endpoint (e.g. posts_multiple) and method
+    '''
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.lock = threading.Lock()
+        self.requests = Histogram(
+            'cuddlyrest_request_duration_seconds',
+            'Time spent serving requests', ('endpoint', 'method'), buckets)
+        self.phases = Histogram(
+            'cuddlyrest_phase_duration_seconds',
+            'Time spent in each phase of requests',
+            ('endpoint', 'method', 'phase'), buckets)
+        self.commands = Histogram(
+            'cuddlyrest_mongo_commands', 'MongoDB commands sent per request',
+            ('endpoint', 'method'), COMMAND_BUCKETS)
+        self.responses = Counter(
+            'cuddlyrest_responses_total', 'Responses sent, by status code',
+            ('endpoint', 'method', 'code'))
+        self.identity_map = Counter(
+            'cuddlyrest_identity_map_lookups_total',
+            'Lookups of referenced documents (and their dumps) in the '
+            'identity map of requests', ('kind', 'result'))
+
+    def observe(self, endpoint, method, code, timings, identity_map=None):
+        '''
+        Records the request `timings` of `endpoint`
+        '''
+        labels = (endpoint or '', method)
+        with self.lock:
+            self.requests.observe(labels, timings.elapsed())
+            for phase, seconds in timings.phases.items():
+                self.phases.observe(labels + (phase, ), seconds)
+            self.commands.observe(labels, timings.commands)
+            self.responses.inc(labels + (str(code), ))
+            if identity_map is not None:
+                for kind, prefix in (('document', ''), ('dump', 'dump_')):
+                    for result, name in (('hit', 'hits'),
+                                         ('miss', 'misses')):
+                        self.identity_map.inc(
+                            (kind, result),
+                            getattr(identity_map, prefix + name))
+
+    def render(self):
+        '''
+        The metrics in the Prometheus text exposition format
+        '''
+        lines = []
+        with self.lock:
+            for metric in (self.requests, self.phases, self.commands,
+                           self.responses, self.identity_map):
+                lines.append('# HELP %s %s' % (metric.name, metric.help))
+                lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+                for suffix, labels, value in metric.samples():
+                    lines.append('%s%s%s %s' % (metric.name, suffix, labels,
+                                                _number(value)))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,99 @@
+'''
+Keyset pagination: instead of skipping documents, the next page starts
+right after the last document of the previous one, found with a range query
+on the order_by key and the primary key.
+'''
+import base64
+import binascii
+
+from bson import json_util
+from bson.dbref import DBRef
+from mongoengine.errors import InvalidQueryError
+from mongoengine.queryset.visitor import Q
+
+
+def split_order(order):
+    '''
+    Splits an order_by value like '-created' into ('created', -1)
+    '''
+    if not order:
+        return None, 1
+    if order[0] in '+-':
+        return order[1:], -1 if order[0] == '-' else 1
+    return order, 1
+
+
+def sort_keys(order):
+    '''
+    The order_by arguments sorting like `order` with ties broken by the
+    primary key, which keeps pages stable
+    '''
+    key, direction = split_order(order)
+    pk = 'pk' if direction > 0 else '-pk'
+    if key is None or key in ('id', 'pk'):
+        return (pk, )
+    return (order, pk)
+
+
+def _value(doc, path):
+    value = doc
+    for name in path.replace('__', '.').split('.'):
+        if value is None:
+            break
+        value = value._data.get(name)
+    if isinstance(value, DBRef):
+        return value.id
+    return value
+
+
+class Cursor(object):
+    '''
+    The position after a document in a list ordered by `order`
+    '''
+    def __init__(self, order, value, pk):
+        self.order = order
+        self.value = value
+        self.pk = pk
+
+    @classmethod
+    def after(cls, doc, order):
+        key, _ = split_order(order)
+        value = None if key in (None, 'id', 'pk') else _value(doc, key)
+        return cls(order, value, doc.pk)
+
+    @classmethod
+    def decode(cls, token):
+        try:
+            data = json_util.loads(base64.urlsafe_b64decode(str(token)))
+            return cls(data['order'], data['value'], data['pk'])
+        except (TypeError, ValueError, KeyError, binascii.Error):
+            raise InvalidQueryError('Invalid cursor')
+
+    def encode(self):
+        return base64.urlsafe_b64encode(json_util.dumps(
+            {'order': self.order, 'value': self.value, 'pk': self.pk}))
+
+    def query(self):
+        '''
+        A Q object matching the documents after this cursor
+        '''
+        key, direction = split_order(self.order)
+        op = '__gt' if direction > 0 else '__lt'
+        after_pk = Q(**{'pk' + op: self.pk})
+        if key is None or key in ('id', 'pk'):
+            return after_pk
+        key = key.replace('.', '__')
+        # Null and missing values sort before all others but no range
+        # matches them, they are paged through by primary key alone
+        is_null = Q(**{key: None})
+        if self.value is None:
+            after_null = is_null & after_pk
+            if direction > 0:
+                return after_null | Q(**{key + '__exists': True,
+                                         key + '__ne': None})
+            return after_null
+        after = (Q(**{key + op: self.value}) |
+                 (Q(**{key: self.value}) & after_pk))
+        if direction > 0:
+            return after
+        return after | is_null
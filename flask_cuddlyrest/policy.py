@@ -0,0 +1,171 @@
+'''
+Keeping requests to the queries MongoDB answers from an index.
+
+A resource can list the filter arguments (and their operators) and the
+order_by keys it accepts; :class:`QueryPolicy` rejects the others. The
+collection's indexes, see :class:`Indexes`, tell which queries would scan
+the collection or sort it in memory, so that those can be refused too.
+'''
+from mongoengine.errors import InvalidQueryError
+from mongoengine.queryset.transform import MATCH_OPERATORS
+
+from flask_cuddlyrest.aggregation import db_path
+from flask_cuddlyrest.pagination import split_order
+
+# The operator of filter arguments without one, e.g. ?title=First
+EQUALS = 'eq'
+
+# The operators an index helps with; the others (contains, iexact, ne...)
+# have MongoDB look at every document
+INDEXED_OPERATORS = frozenset([EQUALS, 'gt', 'gte', 'lt', 'lte', 'in', 'all',
+                               'startswith', 'exact'])
+
+
+def split_filter(document_cls, key):
+    '''
+    Splits the filter argument `key`, e.g. author__name__not__startswith,
+    into its database path and operator: ('author.name', 'not__startswith')
+    '''
+    parts = key.split('__')
+    operators = []
+    while len(parts) > 1 and parts[-1] in MATCH_OPERATORS:
+        operators.insert(0, parts.pop())
+    return (db_path(document_cls, '.'.join(parts)),
+            '__'.join(operators) or EQUALS)
+
+
+_indexes = {}
+
+
+class Indexes(object):
+    '''
+    The indexes of the collection of `document_cls`, as MongoDB reports them
+    '''
+    def __init__(self, document_cls):
+        info = document_cls._get_collection().index_information()
+        self.keys = dict((name, [key for key, _ in index['key']])
+                         for name, index in info.items())
+
+    @classmethod
+    def of(cls, document_cls):
+        '''
+        The Indexes of `document_cls`, read from MongoDB once
+        '''
+        name = document_cls._get_collection_name()
+        if name not in _indexes:
+            _indexes[name] = cls(document_cls)
+        return _indexes[name]
+
+    @classmethod
+    def forget(cls, document_cls=None):
+        if document_cls is None:
+            _indexes.clear()
+        else:
+            _indexes.pop(document_cls._get_collection_name(), None)
+
+    def filtering(self, path):
+        '''
+        The names of the indexes a query on `path` can use
+        '''
+        return sorted(name for name, keys in self.keys.items()
+                      if keys[0] == path)
+
+    def sorting(self, path, equalities=()):
+        '''
+        The names of the indexes which give the documents ordered by `path`
+        when the query matches the paths of `equalities` exactly
+        '''
+        names = []
+        for name, keys in self.keys.items():
+            for key in keys:
+                if key == path:
+                    names.append(name)
+                if key not in equalities:
+                    break
+        return sorted(names)
+
+
+class QueryPolicy(object):
+    '''
+    The filter arguments and order_by keys a resource accepts.
+
+    :param filters: the (dotted) fields requests may filter on, a dict
+        giving the operators allowed on each (:data:`EQUALS` for plain
+        equality), or None for any
+    :param ordering: the fields requests may order by, or None for any
+    '''
+    def __init__(self, document_cls, filters=None, ordering=None):
+        self.document_cls = document_cls
+        self.filters = None
+        if filters is not None:
+            if not isinstance(filters, dict):
+                filters = dict((name, None) for name in filters)
+            self.filters = dict(
+                (db_path(document_cls, name),
+                 None if operators is None else frozenset(operators))
+                for name, operators in filters.items())
+        self.ordering = None
+        if ordering is not None:
+            self.ordering = frozenset(
+                db_path(document_cls, split_order(key)[0])
+                for key in ordering)
+
+    def parse(self, filters, order=None):
+        '''
+        The (path, operator) pairs of the filter arguments `filters` and the
+        path of `order`, raises InvalidQueryError for those not allowed
+        '''
+        conditions = []
+        for key in filters:
+            path, operator = split_filter(self.document_cls, key)
+            if self.filters is not None:
+                if path not in self.filters:
+                    raise InvalidQueryError(
+                        'Filtering on %s is not allowed' % key)
+                allowed = self.filters[path]
+                if allowed is not None and operator not in allowed:
+                    raise InvalidQueryError(
+                        'The %s operator is not allowed on %s'
+                        % (operator, key))
+            conditions.append((path, operator))
+        key = split_order(order)[0]
+        sort = None
+        if key not in (None, 'id', 'pk'):
+            sort = db_path(self.document_cls, key)
+            if self.ordering is not None and sort not in self.ordering:
+                raise InvalidQueryError('Ordering by %s is not allowed' % key)
+        return conditions, sort
+
+    def unindexed(self, conditions, sort, indexes):
+        '''
+        Why a query with the (path, operator) `conditions` ordered by `sort`
+        can not be answered from `indexes`, None when it can
+        '''
+        if conditions and not any(
+                operator in INDEXED_OPERATORS and indexes.filtering(path)
+                for path, operator in conditions):
+            return 'no index for filtering on %s' % ', '.join(
+                sorted(set(path for path, _ in conditions)))
+        equalities = set(path for path, operator in conditions
+                         if operator == EQUALS)
+        if sort is not None and not indexes.sorting(sort, equalities):
+            return 'no index for ordering by %s' % sort
+        return None
+
+    def problems(self, indexes):
+        '''
+        What, of the allowed filters and ordering, `indexes` do not serve
+        '''
+        problems = []
+        for path, operators in sorted((self.filters or {}).items()):
+            if not indexes.filtering(path):
+                problems.append('no index for filtering on %s' % path)
+            for operator in sorted((operators or set()) -
+                                   INDEXED_OPERATORS):
+                problems.append('the %s operator on %s can not use an index'
+                                % (operator, path))
+        equalities = set(self.filters or ())
+        for path in sorted(self.ordering or ()):
+            if not indexes.sorting(path, equalities):
+                problems.append('no index for ordering by %s' % path)
+        return problems
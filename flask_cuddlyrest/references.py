@@ -0,0 +1,223 @@
+import functools
+
+from bson.dbref import DBRef
+from flask import g, has_app_context
+from mongoengine.document import Document
+
+from flask_cuddlyrest.marshaller import (
+    get_plan, document_class, reference_key, Expansion, to_pk)
+from flask_cuddlyrest.concurrency import run_all
+
+
+def hit_rates(counts):
+    '''
+    The hits and misses in `counts`, of references and of their dumps,
+    with the rate of hits
+    '''
+    stats = {}
+    for prefix in ('', 'dump_'):
+        hits = counts.get(prefix + 'hits', 0)
+        misses = counts.get(prefix + 'misses', 0)
+        stats[prefix + 'hits'] = hits
+        stats[prefix + 'misses'] = misses
+        stats[prefix + 'hit_rate'] = (float(hits) / (hits + misses)
+                                      if hits + misses else None)
+    return stats
+
+
+class IdentityMap(object):
+    '''
+    Holds referenced documents by collection and primary key so a page of
+    documents can have its references loaded in bulk instead of one query
+    per reference per row.
+
+    Given an `executor` (see :mod:`flask_cuddlyrest.concurrency`) the
+    queries of different collections are sent concurrently.
+
+    It also keeps what the referenced documents were dumped as, so a
+    document referenced by many rows is marshalled once. `hits` and
+    `misses` count the references found loaded and those which had to be
+    fetched, `dump_hits` and `dump_misses` the same for dumps.
+    '''
+    def __init__(self, executor=None):
+        self.documents = {}
+        self.dumped = {}
+        self.executor = executor
+        self.hits = self.misses = 0
+        self.dump_hits = self.dump_misses = 0
+
+    key = staticmethod(reference_key)
+
+    def get(self, reference):
+        '''
+        Returns the document a raw reference value (a DBRef or a document)
+        points to, or None if it has not been loaded
+        '''
+        if isinstance(reference, Document):
+            return reference
+        if isinstance(reference, DBRef):
+            return self.documents.get(self.key(reference))
+        return None
+
+    def add(self, doc):
+        self.documents[self.key(doc)] = doc
+
+    def dump(self, doc, variant, ancestors, dump):
+        '''
+        Returns what `doc` dumps as in the `variant` (of projection and
+        expansion) asked for, calling `dump` for it unless a previous dump
+        is valid below `ancestors`: one which was not cut short by a
+        document missing from them, and did not inline any of them.
+        `dump` returns the data with the keys inlined and cut.
+        '''
+        key = self.key(doc) + variant
+        for entry in self.dumped.get(key, ()):
+            data, inlined, cuts = entry
+            if cuts <= ancestors and not inlined & ancestors:
+                self.dump_hits += 1
+                return entry
+        self.dump_misses += 1
+        entry = dump()
+        self.dumped.setdefault(key, []).append(entry)
+        return entry
+
+    def forget(self, document_cls):
+        '''
+        Drops the documents of `document_cls`, which have been written to,
+        and every dump since they can be part of any
+        '''
+        collection = document_cls._get_collection_name()
+        for key in [key for key in self.documents if key[0] == collection]:
+            del self.documents[key]
+        self.dumped.clear()
+
+    def stats(self):
+        stats = hit_rates(self.__dict__)
+        stats['documents'] = len(self.documents)
+        return stats
+
+    def referenced(self, docs, expansion=None):
+        '''
+        The loaded documents `docs` refer to, directly or not, which
+        `expansion` inlines; by key
+        '''
+        return self._walk(docs, expansion, fetch=False)
+
+    def _walk(self, docs, expansion, fetch):
+        if expansion is None:
+            expansion = Expansion()
+        found = {}
+        visited = set()
+        pending = [(doc, expansion) for doc in docs]
+        while pending:
+            wanted = {}
+            children = []
+            for doc, expansion in pending:
+                plan = get_plan(document_class(doc))
+                fields = [(name, plan.fields[name], [doc._data.get(name)])
+                          for name in plan.related_fields]
+                fields.extend((name, plan.fields[name].field,
+                               doc._data.get(name) or ())
+                              for name in plan.list_related_fields)
+                for name, field, values in fields:
+                    if not expansion.allows(name):
+                        continue
+                    child = expansion.child(name)
+                    for value in values:
+                        if value is None:
+                            continue
+                        if fetch:
+                            self._want(wanted, field, value)
+                        children.append((value, child))
+            self._fetch(wanted)
+            pending = []
+            for value, child in children:
+                doc = self.get(value)
+                if doc is None:
+                    continue
+                key = self.key(doc)
+                found[key] = doc
+                if (key, child.key()) not in visited:
+                    visited.add((key, child.key()))
+                    pending.append((doc, child))
+        return found
+
+    def _want(self, wanted, field, value):
+        if not isinstance(value, DBRef):
+            return
+        document_cls = field.document_type
+        collection = document_cls._get_collection_name()
+        ids = wanted.setdefault(collection, (document_cls, set()))[1]
+        if self.key(value) in self.documents or value.id in ids:
+            self.hits += 1
+            return
+        self.misses += 1
+        ids.add(value.id)
+
+    def _want_json(self, wanted, field, value):
+        if value is None or isinstance(value, (dict, list)):
+            return
+        document_cls = field.document_type
+        pk = to_pk(document_cls, value)
+        if pk is None:
+            # Left for the Marshaller to report
+            return
+        self._want(wanted, field,
+                   DBRef(document_cls._get_collection_name(), pk))
+
+    @staticmethod
+    def _query(document_cls, ids):
+        return list(document_cls.objects(pk__in=list(ids)))
+
+    def _fetch(self, wanted):
+        fetched = []
+        for docs in run_all(self.executor, [
+                functools.partial(self._query, document_cls, ids)
+                for document_cls, ids in wanted.values() if ids]):
+            for doc in docs:
+                self.add(doc)
+                fetched.append(doc)
+        return fetched
+
+    def prefetch_json(self, document_cls, items):
+        '''
+        Loads the documents referenced by the json `items`, about to be
+        loaded into `document_cls` documents, with one `$in` query per
+        referenced collection
+        '''
+        plan = get_plan(document_cls)
+        wanted = {}
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            for field_name in plan.related_fields:
+                self._want_json(wanted, plan.fields[field_name],
+                                item.get(field_name))
+            for field_name in plan.list_related_fields:
+                field = plan.fields[field_name].field
+                values = item.get(field_name)
+                for value in values if isinstance(values, list) else ():
+                    self._want_json(wanted, field, value)
+        self._fetch(wanted)
+
+    def prefetch(self, docs, expansion=None):
+        '''
+        Loads every document referenced by `docs` which `expansion` (all of
+        them by default) inlines with one `$in` query per referenced
+        collection, then does the same for the references of the loaded
+        documents until nothing new is referenced.
+        '''
+        self._walk(docs, expansion, fetch=True)
+
+
+def request_identity_map(executor=None):
+    '''
+    The identity map of the current request, shared by everything loaded
+    and marshalled while serving it
+    '''
+    if not has_app_context():
+        return IdentityMap(executor)
+    identity_map = getattr(g, 'cuddlyrest_identity_map', None)
+    if identity_map is None:
+        identity_map = g.cuddlyrest_identity_map = IdentityMap(executor)
+    return identity_map
@@ -0,0 +1,144 @@
+'''
+Partial updates as MongoDB update operators.
+
+A PATCH body is an object with the fields to change, null removing a field.
+It can also hold $set, $unset, $inc and $push operators, e.g.::
+
+    {"title": "Renamed", "$inc": {"views": 1}, "$push": {"tags": "new"}}
+
+:class:`Update` checks such a body against the fields of the document class
+and loads its values the way those of a whole document are loaded, so that
+it can be applied with a single find_one_and_update.
+'''
+from mongoengine.errors import ValidationError
+from mongoengine.fields import IntField, LongField, FloatField, ListField
+
+from flask_cuddlyrest.marshaller import Marshaller
+
+OPERATORS = ('$set', '$unset', '$inc', '$push')
+# The fields $inc can change
+NUMERIC_FIELDS = (IntField, LongField, FloatField)
+
+
+class Update(object):
+    '''
+    The changes of a PATCH body: the values to set, the fields to unset,
+    the amounts to add and the items to append, by field name
+    '''
+    def __init__(self, document_cls):
+        self.document_cls = document_cls
+        self.sets = {}
+        self.unsets = set()
+        self.incs = {}
+        self.pushes = {}
+
+    @classmethod
+    def parse(cls, document_cls, body, identity_map=None,
+              check_references=True, readonly=()):
+        '''
+        Reads the PATCH `body`, raises a ValidationError listing what is
+        wrong with it; the fields of `readonly` (and the id) can not be
+        changed
+        '''
+        if not isinstance(body, dict):
+            raise ValidationError('Expected an object')
+        update = cls(document_cls)
+        changes = {'$set': {}, '$unset': {}, '$inc': {}, '$push': {}}
+        errors = {}
+        for key, value in body.items():
+            if not key.startswith('$'):
+                changes['$set' if value is not None else '$unset'][key] = value
+            elif key not in OPERATORS:
+                errors[key] = 'Unknown operator'
+            elif not isinstance(value, dict):
+                errors[key] = 'should be an object'
+            else:
+                changes[key].update(value)
+        fields = document_cls._fields
+        readonly = set(readonly) | set([document_cls._meta['id_field']])
+        seen = set()
+        for operator in OPERATORS:
+            for name, value in changes[operator].items():
+                field = fields.get(name)
+                if field is None:
+                    errors[name] = 'Unknown field'
+                elif name in readonly:
+                    errors[name] = 'can not be changed'
+                elif name in seen:
+                    errors[name] = 'changed more than once'
+                elif operator == '$unset' and field.required:
+                    errors[name] = 'Field is required'
+                elif operator == '$inc' and (
+                        not isinstance(field, NUMERIC_FIELDS) or
+                        isinstance(value, bool) or
+                        not isinstance(value, (int, long, float))):
+                    errors[name] = 'can not be incremented by %r' % (value, )
+                elif operator == '$push' and not isinstance(field,
+                                                            ListField):
+                    errors[name] = 'is not a list'
+                seen.add(name)
+        if errors:
+            raise ValidationError('Invalid update', errors=errors)
+        update.unsets.update(changes['$unset'])
+        update.incs.update(changes['$inc'])
+        pushes = dict((name, value['$each'] if isinstance(value, dict) and
+                       '$each' in value else [value])
+                      for name, value in changes['$push'].items())
+        doc = document_cls()
+        Marshaller(doc, identity_map, check_references).loads(
+            dict(changes['$set'], **pushes))
+        for name in list(changes['$set']) + list(pushes):
+            value = doc._data.get(name)
+            try:
+                if value is not None:
+                    fields[name]._validate(value)
+                elif fields[name].required:
+                    fields[name].error('Field is required')
+            except ValidationError as e:
+                errors[name] = e.message
+        if errors:
+            raise ValidationError('Invalid update', errors=errors)
+        update.sets.update((name, doc._data.get(name))
+                           for name in changes['$set'])
+        update.pushes.update((name, doc._data.get(name)) for name in pushes)
+        return update
+
+    def fields(self, *extra):
+        '''
+        The names of the fields changed, and of the `extra` ones given
+        '''
+        return sorted(set(self.sets) | self.unsets | set(self.incs) |
+                      set(self.pushes) | set(filter(None, extra)))
+
+    def mongo(self):
+        '''
+        The update operators of these changes
+        '''
+        fields = self.document_cls._fields
+        operators = {}
+        for name, value in self.sets.items():
+            operators.setdefault('$set', {})[fields[name].db_field] = (
+                fields[name].to_mongo(value) if value is not None else None)
+        for name in self.unsets:
+            operators.setdefault('$unset', {})[fields[name].db_field] = ''
+        for name, value in self.incs.items():
+            operators.setdefault('$inc', {})[fields[name].db_field] = value
+        for name, values in self.pushes.items():
+            operators.setdefault('$push', {})[fields[name].db_field] = {
+                '$each': fields[name].to_mongo(values)}
+        return operators
+
+    def apply(self, doc):
+        '''
+        Makes these changes to the document `doc`, for when it has to be
+        saved instead
+        '''
+        for name, value in self.sets.items():
+            setattr(doc, name, value)
+        for name in self.unsets:
+            setattr(doc, name, None)
+        for name, value in self.incs.items():
+            setattr(doc, name, (getattr(doc, name) or 0) + value)
+        for name, values in self.pushes.items():
+            setattr(doc, name, list(getattr(doc, name) or []) + values)
+        return doc
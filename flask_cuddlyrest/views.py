@@ -2,13 +2,95 @@
 This code is inspired by:
 https://github.com/brettlangdon/mongorest
 '''
-from flask.ext.restful import Resource
-from flask.ext.cuddlyrest.marshaller import Marshaller
-from flask import request, current_app
+from flask_restful import Resource
+from flask_cuddlyrest.marshaller import (
+    Marshaller, Projection, Expansion, RawDocument, get_plan, to_pk)
+from flask_cuddlyrest.references import (
+    IdentityMap, request_identity_map)
+from flask_cuddlyrest.pagination import Cursor, sort_keys
+from flask_cuddlyrest.aggregation import (
+    Aggregation, ACCUMULATORS, distinct)
+from flask_cuddlyrest.concurrency import run_all
+from flask_cuddlyrest.metrics import timed, timing
+from flask_cuddlyrest.policy import QueryPolicy, Indexes
+from flask_cuddlyrest.filters import get_filter_parser, TRUE_STRINGS
+from flask_cuddlyrest.updates import Update
+from flask_cuddlyrest.conditional import (
+    compute_etag, last_modified, validator_headers, is_not_modified,
+    precondition_failed, not_modified)
+from flask import request, current_app, stream_with_context
+from bson import json_util
+from werkzeug.urls import url_encode
+from werkzeug.http import unquote_etag, parse_date
 from mongoengine.queryset import DoesNotExist
-from mongoengine.errors import ValidationError, InvalidQueryError
+from mongoengine.errors import (ValidationError, InvalidQueryError,
+                                SaveConditionError)
+from mongoengine.fields import DateTimeField, FileField
+from mongoengine import signals
+from mongoengine.base import get_document
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError
 import traceback
 import functools
+import itertools
+import collections
+import warnings
+from datetime import datetime
+
+
+PRECONDITION_FAILED = {"error": "Precondition Failed"}, 412
+
+# Answers a request with Prefer: return=minimal
+MINIMAL = {'Preference-Applied': 'return=minimal'}
+
+QueryArgs = collections.namedtuple(
+    'QueryArgs',
+    'filters skip limit order projection cursor total expand explain')
+
+
+class UnindexedQueryWarning(UserWarning):
+    '''
+    Warns of allowed filters or ordering no index of the collection serves
+    '''
+
+
+def chunked(iterable, size):
+    # A generator, since iterating a QuerySetNoCache again rewinds it
+    iterator = (item for item in iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def field_errors(e):
+    errors = {}
+    if e.field_name:
+        errors[e.field_name] = unicode(e.message)
+    if e.errors:
+        errors.update({k: unicode(v) for k, v in e.errors.items()})
+    return errors
+
+
+def prefers_minimal():
+    '''
+    Whether the request asks for a minimal response to a write with
+    Prefer: return=minimal
+    '''
+    return any(preference.split(';')[0].strip().lower() == 'return=minimal'
+               for preference in request.headers.get('Prefer', '').split(','))
+
+
+def has_receivers(document_cls, *names):
+    '''
+    Whether any of the mongoengine signals `names` has receivers for
+    `document_cls`, writes bypassing the document methods skip them
+    '''
+    if not signals.signals_available:
+        return False
+    return any(getattr(signals, name).has_receivers_for(document_cls)
+               for name in names)
 
 
 def catch_all(function):
@@ -20,23 +102,117 @@ def catch_all(function):
             return 'Not Found', 404
         except InvalidQueryError as e:
             return {"error": unicode(e.message)}, 400
+        except SaveConditionError as e:
+            return PRECONDITION_FAILED
         except ValidationError as e:
-            errors = {}
-            if e.field_name:
-                errors[e.field_name] = unicode(e.message)
-            if e.errors:
-                errors.update({k: unicode(v) for k, v in e.errors.items()})
+            errors = field_errors(e)
+            if not errors:
+                # Not about a field, e.g. a body of the wrong type
+                return {"error": unicode(e.message)}, 400
             return {"field-errors": errors}, 400
         except Exception, e:
             return {"error": traceback.format_exc(e)}, 500
     return subst
 
 
+def cached(function):
+    '''
+    Serves GET requests from the resource's response cache, if it has one
+    '''
+    @functools.wraps(function)
+    def subst(self, *args, **kwargs):
+        if self.cache is None:
+            return function(self, *args, **kwargs)
+        key = self.cache.key('%s?%s' % (request.path, url_encode(
+            sorted(request.args.items(multi=True)))))
+        response = self.cache.get(key)
+        if response is None:
+            result = function(self, *args, **kwargs)
+            if not isinstance(result, tuple) or result[1] != 200:
+                return result
+            data, code, headers = (result + ({}, ))[:3]
+            response = self.encode(data), code, headers
+            self.cache.set(key, response)
+        body, code, headers = response
+        etag = headers.get('ETag') and unquote_etag(headers['ETag'])[0]
+        modified = (headers.get('Last-Modified') and
+                    parse_date(headers['Last-Modified']))
+        if is_not_modified(etag, modified):
+            return not_modified(headers)
+        return current_app.response_class(body, code, headers,
+                                          mimetype='application/json')
+    return subst
+
+
 class MongoResource(Resource):
+    '''
+    The class attributes below are options, they can be overridden in a
+    subclass or per collection through :meth:`CuddlyRest.register`.
+    '''
+    # Set to False to store references from request bodies without checking
+    # the referenced documents exist
+    check_references = True
+    # Stream list responses row by row instead of building them in memory
+    stream = False
+    # How many documents are marshalled (and have their references fetched)
+    # at once when streaming
+    stream_chunk_size = 100
+    # The limit of list requests which do not give one
+    page_size = None
+    # The largest limit a list request can ask for, set it to make unbounded
+    # lists impossible
+    max_page_size = None
+    # Send ETag (and Last-Modified) headers and honour If-None-Match,
+    # If-Modified-Since and If-Match
+    conditional = True
+    # A field changed by every write (an IntField is incremented, a
+    # DateTimeField set to the current time) which then stands for the
+    # document in ETags and makes writes conditional on it
+    version_field = None
+    # A DateTimeField with the time of the last change, sent as Last-Modified
+    last_modified_field = None
+    # A flask_cuddlyrest.cache.ResponseCache for GET responses, register
+    # builds it from a backend (or True for an in-process LRUCache)
+    cache = None
+    # How many documents bulk requests write per round-trip
+    bulk_chunk_size = 1000
+    # Read documents with as_pymongo() and marshal them without building
+    # mongoengine documents (ignored for models with inheritance or dynamic
+    # fields)
+    raw_reads = False
+    # An executor (see flask_cuddlyrest.concurrency) through which the
+    # independent reads of a request are sent concurrently
+    executor = None
+    # Which references are dumped inline when a request does not say with
+    # ?expand=: a number of levels, comma separated reference paths, or
+    # None for all of them. The others are dumped as their id.
+    expand = None
+    # The filter arguments requests may give: a list of (dotted) fields, or
+    # a dict from field to the operators allowed on it ('eq' for equality,
+    # None for any), None to allow any filter
+    allowed_filters = None
+    # The fields requests may order_by, None to allow any
+    allowed_ordering = None
+    # What to do about queries no index serves, which make MongoDB scan or
+    # sort the collection: None, 'warn' or 'reject'. allowed_filters and
+    # allowed_ordering are checked against the indexes when registered,
+    # every request is checked too.
+    unindexed = None
+    # Answer list requests given ?explain=1 with the query plan MongoDB
+    # picks instead of the documents
+    explain = False
 
-    def __init__(self, document):
+    def __init__(self, document, **options):
         super(MongoResource, self).__init__()
         self.document = document
+        # The CuddlyRest api serving the resource, set when it registers it
+        self.api = None
+        for name, value in options.items():
+            if not hasattr(MongoResource, name):
+                raise TypeError('Unknown resource option: %s' % name)
+            setattr(self, name, value)
+        if self.unindexed not in (None, 'warn', 'reject'):
+            raise ValueError('unindexed should be None, warn or reject')
 
     def mediatypes(self):
         '''
@@ -53,26 +229,299 @@ class MongoResource(Resource):
         resp = current_app.make_default_options_response()
         return {}, resp.status, resp.headers
 
+    def identity_map(self):
+        '''
+        The identity map of the current request
+        '''
+        return request_identity_map(self.executor)
+
+    def invalidate(self):
+        '''
+        Drops the cached responses a write to this collection makes stale,
+        in every api of the app
+        '''
+        self.identity_map().forget(self.document)
+        for api in current_app.extensions.get('cuddlyrest', ()):
+            api.invalidate(self.document)
+        if self.api is None and self.cache is not None:
+            self.cache.invalidate()
+
+    def encode(self, data):
+        '''
+        Encodes `data` the way the api serving the resource would
+        '''
+        if self.api is None:
+            return json_util.dumps(data)
+        return self.api.encode(data)
+
+    def validators(self, docs, identity_map=None, expansion=None):
+        '''
+        Returns the ETag and last modification time of the representation of
+        `docs`, None for what is not available
+        '''
+        if not self.conditional:
+            return None, None
+        with timed('etag'):
+            etag = compute_etag(docs, identity_map, self.version_field,
+                                expansion)
+            modified = None
+            if self.last_modified_field:
+                modified = last_modified(docs, self.last_modified_field)
+        return etag, modified
+
+    def if_match_failed(self, doc):
+        if not self.conditional or 'If-Match' not in request.headers:
+            return False
+        identity_map = None
+        expansion = self.get_expansion()
+        if not self.version_field:
+            identity_map = self.identity_map()
+            identity_map.prefetch([doc], expansion)
+        etag, _ = self.validators([doc], identity_map, expansion)
+        return precondition_failed(etag)
+
+    def version_update(self):
+        '''
+        The update operator and value which change the version field
+        '''
+        field = self.document._fields[self.version_field]
+        if isinstance(field, DateTimeField):
+            return '$set', {field.db_field: datetime.utcnow()}
+        return '$inc', {field.db_field: 1}
+
+    def parse_update(self, body, identity_map=None, document_cls=None):
+        '''
+        The :class:`Update` of a PATCH `body` to documents of
+        `document_cls` (the resource's by default), the version field can
+        not be changed by it
+        '''
+        readonly = [self.version_field] if self.version_field else []
+        return Update.parse(document_cls or self.document, body,
+                            identity_map or self.identity_map(),
+                            self.check_references, readonly)
+
+    def update_operators(self, update):
+        '''
+        The update operators of `update`, with the change of the version
+        field
+        '''
+        operators = update.mongo()
+        if self.version_field:
+            operator, change = self.version_update()
+            operators.setdefault(operator, {}).update(change)
+        return operators
+
+    def bump_version(self, doc):
+        '''
+        Changes the version field of `doc` before it is saved, returns the
+        save condition making sure nobody else changed it meanwhile
+        '''
+        if not self.version_field:
+            return None
+        current = doc._data.get(self.version_field)
+        if isinstance(self.document._fields[self.version_field],
+                      DateTimeField):
+            version = datetime.utcnow()
+        else:
+            version = (current or 0) + 1
+        setattr(doc, self.version_field, version)
+        return {self.version_field: current}
+
+    def deletes_fast(self):
+        '''
+        Whether documents can be deleted by a query without loading them:
+        nothing listens to their delete signals, no reference has a delete
+        rule (cascade, nullify...) on them and they have no GridFS files,
+        which Document.delete removes too
+        '''
+        return (not self.document._meta.get('delete_rules') and
+                not any(isinstance(field, FileField)
+                        for field in self.document._fields.values()) and
+                not has_receivers(self.document, 'pre_delete', 'post_delete'))
+
+    def delete_matching(self, docs):
+        '''
+        Deletes the documents of the queryset `docs`, returns how many
+        there were
+        '''
+        if not self.deletes_fast():
+            return docs.delete()
+        with timed('query'):
+            return docs._collection.delete_many(docs._query).deleted_count
+
+    def get_expansion(self):
+        '''
+        The :class:`Expansion` the request asks for with expand, or else
+        the resource's; None to inline every reference
+        '''
+        if 'expand' in request.args:
+            expand = Expansion.parse(request.args['expand'] or None)
+        elif self.expand is not None:
+            expand = Expansion.parse(self.expand)
+        else:
+            return None
+        expand.validate(self.document)
+        return expand
+
+    def get_document_args(self):
+        '''
+        The arguments of a request on a single document (a GET or a write),
+        which only say how it is represented: fields, exclude and expand.
+        The others are ignored, e.g. a ?_= cache buster.
+        '''
+        with timed('args'):
+            projection = Projection.parse(request.args.get('fields') or None,
+                                          request.args.get('exclude') or None)
+            if projection is not None:
+                projection.validate(self.document)
+            return QueryArgs({}, None, None, None, projection, None, False,
+                             self.get_expansion(), False)
+
     def get_filter_args(self):
         '''
         Any request arguments given will be passed directly to the mongorest
-        filter, except for limit and order_by
+        filter, except for limit, skip, order_by, pretty, and fields and
+        exclude which are comma separated lists of (dotted) field names to
+        return or leave out, cursor which is the token of the next page
+        given in the Link header of a limited list response, total which
+        asks for the number of matching documents in an X-Total-Count header,
+        expand which says which references to dump inline (see
+        :class:`Expansion`), and explain which asks for the query plan.
 
         For None fields just use fieldname=  (with no value)
         This allows us to query embedded documents via e.g.:
         embeddedname__embeddedfieldname
 
+        The values of the filters are converted to the type of their field
+        (see :class:`flask_cuddlyrest.filters.FilterParser`), filters on
+        unknown fields or with invalid values raise an InvalidQueryError.
+
         See the :mongoengine.queryset documentation for more complex examples.
         '''
-        args = dict([(k, v[0] or None) for k, v in request.args.viewitems()])
-        limit = args.pop('limit', None)
-        if limit:
-            limit = int(limit)
-        skip = args.pop('skip', None)
-        if skip:
-            skip = int(skip)
-        order = args.pop('order_by', None)
-        return args, skip, limit, order
+        with timed('args'):
+            args = dict([(k, v or None) for k, v in request.args.items()])
+            args.pop('pretty', None)
+            total = (args.pop('total', None) or '').lower() in TRUE_STRINGS
+            limit = args.pop('limit', None)
+            if limit:
+                limit = int(limit)
+            skip = args.pop('skip', None)
+            if skip:
+                skip = int(skip)
+            order = args.pop('order_by', None)
+            projection = Projection.parse(args.pop('fields', None),
+                                          args.pop('exclude', None))
+            if projection is not None:
+                projection.validate(self.document)
+            args.pop('expand', None)
+            expand = self.get_expansion()
+            explain = (args.pop('explain', None) or '').lower() in TRUE_STRINGS
+            if explain and not self.explain:
+                raise InvalidQueryError('explain is not enabled')
+            cursor = args.pop('cursor', None)
+            if cursor:
+                cursor = Cursor.decode(cursor)
+                if skip:
+                    raise InvalidQueryError(
+                        'skip can not be used with a cursor')
+                if order and order != cursor.order:
+                    raise InvalidQueryError(
+                        'order_by does not match the cursor')
+                order = cursor.order
+            args = get_filter_parser(self.document).parse(
+                args, self.reserved_args())
+        return QueryArgs(args, skip, limit, order, projection, cursor, total,
+                         expand, explain)
+
+    def reserved_args(self):
+        '''
+        The request arguments which are not filters, left to the resource
+        '''
+        return ()
+
+    def has_policy(self):
+        return (self.allowed_filters is not None or
+                self.allowed_ordering is not None)
+
+    def policy(self):
+        return QueryPolicy(self.document, self.allowed_filters,
+                           self.allowed_ordering)
+
+    def check_indexes(self):
+        '''
+        Warns of, or raises a ValueError for (see the unindexed option), the
+        allowed filters and ordering no index of the collection serves
+        '''
+        if not self.unindexed or not self.has_policy():
+            return
+        problems = self.policy().problems(Indexes.of(self.document))
+        if problems:
+            message = '%s: %s' % (self.document.__name__,
+                                  '; '.join(problems))
+            if self.unindexed == 'reject':
+                raise ValueError(message)
+            warnings.warn(message, UnindexedQueryWarning)
+
+    def check_query(self, filters, order=None):
+        '''
+        Raises InvalidQueryError for the filter arguments `filters` or the
+        `order` the resource does not allow, returns why no index serves
+        them (None if one does) when the unindexed option is set
+        '''
+        if not self.unindexed and not self.has_policy():
+            return None
+        policy = self.policy()
+        conditions, sort = policy.parse(filters, order)
+        if not self.unindexed:
+            return None
+        reason = policy.unindexed(conditions, sort,
+                                  Indexes.of(self.document))
+        if reason and self.unindexed == 'reject':
+            raise InvalidQueryError('Unindexed query: %s' % reason)
+        if reason:
+            current_app.logger.warning('Unindexed query %s: %s',
+                                       request.full_path, reason)
+        return reason
+
+    def get_queryset(self, projection=None):
+        '''
+        The documents of this resource, loading only the fields `projection`
+        needs from Mongo
+        '''
+        docs = self.document.objects
+        if projection is not None:
+            only, exclude = projection.mongo_paths(self.document)
+            if only is not None:
+                if self.reads_raw():
+                    # as_pymongo() leaves _id out unless asked for
+                    only.append('id')
+                docs = docs.only(*only)
+            if exclude:
+                docs = docs.exclude(*exclude)
+        return docs
+
+    def reads_raw(self):
+        return self.raw_reads and get_plan(self.document).raw.supported
+
+    def read(self, docs):
+        '''
+        Iterates the documents of the queryset `docs`, as RawDocuments when
+        reading raw
+        '''
+        if not self.reads_raw():
+            return docs
+        only_fields = docs.only_fields
+        return (RawDocument(self.document, son, only_fields)
+                for son in docs.as_pymongo())
+
+    def read_one(self, docs, **query):
+        '''
+        The single document of `docs` matching `query`, see :meth:`read`
+        '''
+        if not self.reads_raw():
+            return docs.get(**query)
+        return RawDocument(self.document, docs.as_pymongo().get(**query),
+                           docs.only_fields)
 
 
 class ListMongoResource(MongoResource):
@@ -81,29 +530,340 @@ class ListMongoResource(MongoResource):
 
     In general we support:
         - GET /: List all of this resource.
-        - POST /: Add a new one of this resource.
+        - POST /: Add a new one of this resource, or many given a list.
+        - PATCH /: Update the documents of a list of changes with ids, or
+          apply one change to the documents matching the filter arguments.
+        - DELETE /: Delete the documents of a list of ids, or the documents
+          matching the filter arguments.
+
+    Bulk requests answer with the status of every item, 207 if some failed.
     '''
     @catch_all
     def post(self):
         '''
         Add a new document
         '''
+        if isinstance(request.json, list):
+            return self.bulk_create(request.json)
         doc = self.document()
-        Marshaller(doc).loads(request.json)
+        marshaller = Marshaller(doc, self.identity_map(),
+                                self.check_references,
+                                expansion=self.get_expansion())
+        marshaller.loads(request.json)
         doc.save()
-        return Marshaller(doc).dumps(), 201
+        self.invalidate()
+        if prefers_minimal():
+            headers = dict(MINIMAL, Location='%s/%s' % (
+                request.base_url.rstrip('/'), doc.pk))
+            return current_app.response_class(status=201, headers=headers)
+        with timed('marshal'):
+            return marshaller.dumps(), 201
+
+    def bulk_load(self, docs, items, results):
+        '''
+        Loads the json `items` into `docs`, returns the (index, document)
+        pairs which are valid, the failures are recorded in `results`
+        '''
+        identity_map = self.identity_map()
+        if self.check_references:
+            identity_map.prefetch_json(self.document, items)
+        loaded = []
+        for index, (doc, item) in enumerate(zip(docs, items)):
+            if doc is None:
+                continue
+            if not isinstance(item, dict):
+                results[index] = {'status': 400,
+                                  'error': 'Item should be an object'}
+                continue
+            try:
+                Marshaller(doc, identity_map,
+                           self.check_references).loads(item)
+                doc.validate()
+            except ValidationError as e:
+                results[index] = {'status': 400,
+                                  'field-errors': field_errors(e)}
+                continue
+            loaded.append((index, doc))
+        return loaded
+
+    def bulk_write(self, write, loaded, results, status):
+        '''
+        Runs `write` on chunks of the (index, son) pairs in `loaded`. A chunk
+        is written in order, after a failure the rest of it is written again
+        so that one bad document does not abort the batch.
+        '''
+        for chunk in chunked(loaded, self.bulk_chunk_size):
+            while chunk:
+                try:
+                    write(chunk)
+                    written = len(chunk)
+                except BulkWriteError as e:
+                    error = e.details['writeErrors'][0]
+                    written = error['index']
+                    results[chunk[written][0]] = {
+                        'status': 409 if error.get('code') == 11000 else 400,
+                        'error': error.get('errmsg')}
+                for index, son in chunk[:written]:
+                    results[index] = {'status': status,
+                                      'id': str(son['_id'])}
+                chunk = chunk[written + 1:]
+
+    def bulk_response(self, results, status):
+        self.invalidate()
+        if all(result['status'] == status for result in results):
+            return results, status
+        return results, 207
+
+    def bulk_create(self, items):
+        results = [None] * len(items)
+        docs = [self.document() for _ in items]
+        loaded = [(index, doc.to_mongo())
+                  for index, doc in self.bulk_load(docs, items, results)]
+        collection = self.document._get_collection()
+        self.bulk_write(
+            lambda chunk: collection.insert_many([son for _, son in chunk]),
+            loaded, results, 201)
+        return self.bulk_response(results, 201)
+
+    def bulk_filter(self):
+        filters = self.get_filter_args().filters
+        if not filters:
+            raise InvalidQueryError(
+                'A filter is required to change documents in bulk')
+        self.check_query(filters)
+        return self.document.objects.filter(**filters)
 
     @catch_all
+    def patch(self):
+        '''
+        Updates documents in bulk: a list of changes by id, each applied
+        with an UpdateOne, or one change applied to the documents matching
+        the filter arguments with an update_many. Only the fields changed
+        are written, see :class:`flask_cuddlyrest.updates.Update`.
+        '''
+        if isinstance(request.json, dict):
+            operators = self.update_operators(
+                self.parse_update(request.json))
+            docs = self.bulk_filter()
+            with timed('query'):
+                if not operators:
+                    return {'updated': docs.count()}, 200
+                result = self.document._get_collection().update_many(
+                    docs._query, operators)
+            self.invalidate()
+            return {'updated': result.matched_count}, 200
+        if not isinstance(request.json, list):
+            raise ValidationError('Expected a list or an object')
+        items = request.json
+        results = [None] * len(items)
+        identity_map = self.identity_map()
+        if self.check_references:
+            identity_map.prefetch_json(self.document, [
+                item for item in items if isinstance(item, dict)])
+        queries, operators = {}, {}
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                results[index] = {'status': 400,
+                                  'error': 'Item should be an object'}
+                continue
+            pk = to_pk(self.document, item.get('id'))
+            if pk is None:
+                results[index] = {'status': 404, 'id': item.get('id')}
+                continue
+            try:
+                update = self.parse_update(
+                    dict((k, v) for k, v in item.items() if k != 'id'),
+                    identity_map)
+            except ValidationError as e:
+                results[index] = {'status': 400,
+                                  'field-errors': field_errors(e)}
+                continue
+            # The queryset's filter, with the _cls condition of inheritance
+            queries[index] = self.document.objects(pk=pk)._query
+            operators[index] = self.update_operators(update)
+        loaded = [(index, {'_id': queries[index]['_id']})
+                  for index in sorted(queries)]
+        collection = self.document._get_collection()
+        matched = []
+
+        def update_each(chunk):
+            writes = [UpdateOne(queries[index], operators[index])
+                      for index, _ in chunk if operators[index]]
+            if writes:
+                matched.append(collection.bulk_write(writes).matched_count)
+        self.bulk_write(update_each, loaded, results, 200)
+        if sum(matched) < len(loaded):
+            self.unmatched(collection, loaded, results)
+        return self.bulk_response(results, 200)
+
+    def unmatched(self, collection, loaded, results):
+        '''
+        Marks the updates of documents which do not exist as not found
+        '''
+        found = set(son['_id'] for son in collection.find(
+            {'_id': {'$in': [son['_id'] for _, son in loaded]}},
+            {'_id': 1}))
+        for index, son in loaded:
+            if son['_id'] not in found:
+                results[index] = {'status': 404, 'id': str(son['_id'])}
+
+    @catch_all
+    def delete(self):
+        '''
+        Deletes documents in bulk
+        '''
+        if isinstance(request.get_json(silent=True), list):
+            pks = [to_pk(self.document, pk) for pk in request.json]
+            docs = self.document.objects(
+                pk__in=[pk for pk in pks if pk is not None])
+            found = set(docs.scalar('pk'))
+            self.delete_matching(docs)
+            self.invalidate()
+            results = [{'status': 200 if pk in found else 404,
+                        'id': value} for pk, value in zip(pks, request.json)]
+            return self.bulk_response(results, 200)
+        deleted = self.delete_matching(self.bulk_filter())
+        self.invalidate()
+        return {'deleted': deleted}, 200
+
+    def stream_response(self, docs, projection=None, expansion=None):
+        '''
+        Marshals and encodes `docs` chunk by chunk while the response is
+        sent, so only `stream_chunk_size` documents are held at a time
+        '''
+        def generate():
+            separator = '['
+            for chunk in chunked(docs, self.stream_chunk_size):
+                # Not the request's, so that memory stays bounded
+                identity_map = IdentityMap(self.executor)
+                identity_map.prefetch(chunk, expansion)
+                rows = [self.encode(Marshaller(doc, identity_map,
+                                               projection=projection,
+                                               expansion=expansion).dumps())
+                        for doc in chunk]
+                yield separator + ','.join(rows)
+                separator = ','
+            yield '[]' if separator == '[' else ']'
+        return current_app.response_class(stream_with_context(generate()),
+                                          mimetype='application/json')
+
+    @catch_all
+    @cached
     def get(self):
-        filter_args, skip, limit, order = self.get_filter_args()
-        docs = self.document.objects.filter(**filter_args)
-        if order:
-            docs = docs.order_by(order)
-        if limit:
-            if not skip:
-                skip = 0
-            docs = docs[skip: skip + limit]
-        return [Marshaller(doc).dumps() for doc in docs], 200
+        args = self.get_filter_args()
+        unindexed = self.check_query(args.filters, args.order)
+        docs = self.get_queryset(args.projection).filter(**args.filters)
+        headers = {}
+        count = timing('count', docs.clone().count) if args.total else None
+        if args.cursor:
+            docs = docs.filter(args.cursor.query())
+        limit = self.page_limit(args.limit)
+        if not limit:
+            if args.order:
+                docs = docs.order_by(args.order)
+            if self.stream:
+                response = self.stream_response(
+                    self.read(docs.no_cache()), args.projection, args.expand)
+                if count is not None:
+                    response.headers['X-Total-Count'] = str(count())
+                return response
+        else:
+            skip = args.skip or 0
+            docs = docs.order_by(*sort_keys(args.order))[skip: skip + limit]
+        if args.explain:
+            return self.explained(docs, unindexed)
+
+        def load():
+            with timed('query'):
+                page = list(self.read(docs))
+            identity_map = self.identity_map()
+            with timed('references'):
+                identity_map.prefetch(page, args.expand)
+            return page, identity_map
+        if count is None:
+            docs, identity_map = load()
+        else:
+            (docs, identity_map), total = run_all(self.executor,
+                                                  [load, count])
+            headers['X-Total-Count'] = str(total)
+        etag, modified = self.validators(docs, identity_map, args.expand)
+        headers.update(validator_headers(etag, modified))
+        if is_not_modified(etag, modified):
+            return not_modified(headers)
+        if limit and len(docs) == limit:
+            cursor = Cursor.after(docs[-1], args.order)
+            headers['Link'] = '<%s>; rel="next"' % self.page_url(cursor)
+        with timed('marshal'):
+            rows = [Marshaller(doc, identity_map, projection=args.projection,
+                               expansion=args.expand).dumps()
+                    for doc in docs]
+        return rows, 200, headers
+
+    def explained(self, docs, unindexed=None):
+        '''
+        The query of the queryset `docs` and the plan MongoDB picks for it
+        '''
+        plan = docs.explain()
+        planner = plan.get('queryPlanner', plan)
+        return {'query': docs._query,
+                'sort': [list(key) for key in docs._ordering or ()],
+                'unindexed': unindexed,
+                'indexes': sorted(Indexes.of(self.document).keys),
+                'winning_plan': planner.get('winningPlan'),
+                'rejected_plans': len(planner.get('rejectedPlans', ()))}, 200
+
+    def page_limit(self, limit):
+        limit = limit or self.page_size
+        if self.max_page_size and (not limit or limit > self.max_page_size):
+            limit = self.max_page_size
+        return limit
+
+    def page_url(self, cursor):
+        args = request.args.copy()
+        args.pop('skip', None)
+        args['cursor'] = cursor.encode()
+        return '%s?%s' % (request.base_url, url_encode(args))
+
+
+class CountMongoResource(MongoResource):
+    '''
+    GET /basename/count answers {"count": n}, the number of documents
+    matching the filter arguments as counted by MongoDB.
+    '''
+    @catch_all
+    @cached
+    def get(self):
+        filters = self.get_filter_args().filters
+        self.check_query(filters)
+        with timed('query'):
+            count = self.document.objects.filter(**filters).count()
+        return {'count': count}, 200
+
+
+class AggregateMongoResource(MongoResource):
+    '''
+    GET /basename/aggregate summarizes the documents matching the filter
+    arguments inside MongoDB:
+        - ?group_by=a,b : one row per distinct (a, b) with its count
+        - ?sum=, ?avg=, ?min=, ?max= : comma separated fields to accumulate
+          in each row (or over all documents without group_by)
+        - ?distinct=a : the list of the distinct values of a instead
+    '''
+    def reserved_args(self):
+        return ('group_by', 'distinct') + ACCUMULATORS
+
+    @catch_all
+    @cached
+    def get(self):
+        filters = self.get_filter_args().filters
+        field = filters.pop('distinct', None)
+        aggregation = Aggregation.parse(filters)
+        self.check_query(filters)
+        docs = self.document.objects.filter(**filters)
+        with timed('query'):
+            if field:
+                return distinct(docs, field), 200
+            return aggregation.run(docs), 200
 
 
 class SingleMongoResource(MongoResource):
@@ -113,23 +873,183 @@ class SingleMongoResource(MongoResource):
     In general we support:
         - GET /:pk : Show a single resource
         - DELETE /:pk : Delete this resource
+        - PUT /:pk : Replace this resource
         - PATCH /:pk : Do a partial update on this resource
     '''
     @catch_all
     def delete(self, doc_id):
-        doc = self.document.objects.get(pk=doc_id)
-        doc.delete()
+        '''
+        Deletes the document with a single delete_one, unless it has to be
+        loaded: to check If-Match, or for its delete signals and rules
+        '''
+        if self.deletes_fast() and not (self.conditional and
+                                        'If-Match' in request.headers):
+            pk = to_pk(self.document, doc_id)
+            if pk is None:
+                raise DoesNotExist(doc_id)
+            # The queryset's filter, with the _cls condition of inheritance
+            query = self.document.objects(pk=pk)._query
+            with timed('query'):
+                result = self.document._get_collection().delete_one(query)
+            if not result.deleted_count:
+                raise DoesNotExist(doc_id)
+        else:
+            doc = self.document.objects.get(pk=doc_id)
+            if self.if_match_failed(doc):
+                return PRECONDITION_FAILED
+            doc.delete()
+        self.invalidate()
         return 'Deleted', 200
 
     @catch_all
+    @cached
     def get(self, doc_id):
-        doc = self.document.objects.get(pk=doc_id)
-        return Marshaller(doc).dumps(), 200
+        args = self.get_document_args()
+        with timed('query'):
+            doc = self.read_one(self.get_queryset(args.projection),
+                                pk=doc_id)
+        return self.respond(doc, args)
+
+    def respond(self, doc, args, conditional_get=True):
+        '''
+        The representation of `doc` with its ETag and Last-Modified, a 304
+        if the request has it already and `conditional_get` is set
+        '''
+        identity_map = self.identity_map()
+        with timed('references'):
+            identity_map.prefetch([doc], args.expand)
+        etag, modified = self.validators([doc], identity_map, args.expand)
+        headers = validator_headers(etag, modified)
+        if conditional_get and is_not_modified(etag, modified):
+            return not_modified(headers)
+        with timed('marshal'):
+            data = Marshaller(doc, identity_map, projection=args.projection,
+                              expansion=args.expand).dumps()
+        return data, 200, headers
+
+    def written(self, doc, args, fields=None):
+        '''
+        The response to a write of `doc`, which is up to date in memory:
+        its representation, or with Prefer: return=minimal only the id and
+        the `fields` changed, a 204 if not given. Minimal responses only
+        have an ETag with a version_field, it would take the referenced
+        documents otherwise.
+        '''
+        if not prefers_minimal():
+            return self.respond(doc, args, conditional_get=False)
+        headers = dict(MINIMAL)
+        if self.version_field:
+            headers.update(validator_headers(
+                *self.validators([doc], expansion=args.expand)))
+        if fields is None:
+            return current_app.response_class(status=204, headers=headers)
+        projection = Projection.parse(','.join(fields))
+        with timed('marshal'):
+            data = Marshaller(doc, projection=projection,
+                              expansion=Expansion(depth=0)).dumps()
+        return data, 200, headers
 
     @catch_all
     def put(self, doc_id):
+        '''
+        Replaces the document with the request body, the fields it leaves
+        out get their default value
+        '''
+        current = self.document.objects.get(pk=doc_id)
+        if self.if_match_failed(current):
+            return PRECONDITION_FAILED
+        # Of the stored class, which can be a subclass of self.document
+        doc = type(current)()
+        Marshaller(doc, self.identity_map(),
+                   self.check_references).loads(request.json)
+        doc.pk = current.pk
+        if self.version_field:
+            setattr(doc, self.version_field,
+                    current._data.get(self.version_field))
+        # Saved as an update of every field but the id, so that save()
+        # neither inserts the document again nor keeps the old fields
+        doc._created = False
+        doc._changed_fields = []
+        for name in doc._fields:
+            if name != doc._meta['id_field']:
+                doc._mark_as_changed(name)
+        doc.save(save_condition=dict(self.bump_version(doc) or {},
+                                     pk=doc.pk))
+        self.invalidate()
+        return self.written(doc, self.get_document_args())
+
+    @catch_all
+    def patch(self, doc_id):
+        '''
+        Changes the fields given in the request body, see
+        :class:`flask_cuddlyrest.updates.Update`, with a single atomic
+        find_one_and_update
+        '''
+        args = self.get_document_args()
+        pk = to_pk(self.document, doc_id)
+        if pk is None:
+            raise DoesNotExist(doc_id)
+        document_cls = self.stored_class(pk)
+        update = self.parse_update(request.json, document_cls=document_cls)
+        if has_receivers(document_cls, 'pre_save',
+                         'pre_save_post_validation', 'post_save'):
+            return self.patch_document(doc_id, update, args)
+        # The queryset's filter, with the _cls condition of inheritance
+        query = dict(self.document.objects(pk=pk)._query)
+        conditioned = False
+        if self.conditional and 'If-Match' in request.headers:
+            current = self.document.objects.get(pk=pk)
+            if self.if_match_failed(current):
+                return PRECONDITION_FAILED
+            if self.version_field:
+                field = self.document._fields[self.version_field]
+                version = current._data.get(self.version_field)
+                # None also matches the documents without a version yet
+                query[field.db_field] = (None if version is None
+                                         else field.to_mongo(version))
+                conditioned = True
+        operators = self.update_operators(update)
+        collection = self.document._get_collection()
+        with timed('query'):
+            if operators:
+                son = collection.find_one_and_update(
+                    query, operators, return_document=ReturnDocument.AFTER)
+            else:
+                son = collection.find_one(query)
+        if son is None:
+            if conditioned:
+                raise SaveConditionError(doc_id)
+            raise DoesNotExist(doc_id)
+        self.invalidate()
+        if self.reads_raw():
+            doc = RawDocument(self.document, son)
+        else:
+            doc = self.document._from_son(son)
+        return self.written(doc, args, update.fields(self.version_field))
+
+    def stored_class(self, pk):
+        '''
+        The class of the document `pk`: the subclass its _cls names when
+        the document class has subclasses, which takes a query
+        '''
+        if len(self.document._subclasses) < 2:
+            return self.document
+        with timed('query'):
+            son = self.document._get_collection().find_one(
+                self.document.objects(pk=pk)._query, {'_cls': 1})
+        if son is None:
+            raise DoesNotExist(pk)
+        return get_document(son.get('_cls', self.document._class_name))
+
+    def patch_document(self, doc_id, update, args):
+        '''
+        Applies `update` to the document and saves it, so that the save
+        signals of the document class are sent
+        '''
         doc = self.document.objects.get(pk=doc_id)
-        Marshaller(doc).loads(request.json)
-        doc.save()
-        return self.get(doc_id)
-    patch = put
+        if self.if_match_failed(doc):
+            return PRECONDITION_FAILED
+        update.apply(doc)
+        doc.save(save_condition=self.bump_version(doc))
+        self.invalidate()
+        return self.written(doc, args, update.fields(self.version_field))
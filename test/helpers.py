@@ -0,0 +1,97 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+import mongomock.collection
+from flask import Flask
+from mongoengine import connect
+
+from flask_cuddlyrest import CuddlyRest
+
+connect('cuddlyrest-test', host='mongomock://localhost')
+
+
+class QueryCounter(object):
+    '''
+    Counts the find() calls made against the mongomock collections
+    '''
+    def __init__(self):
+        self.count = 0
+        self.collections = []
+        self.calls = []
+
+    @contextmanager
+    def __call__(self):
+        original = mongomock.collection.Collection.find
+        counter = self
+
+        def find(collection, *args, **kwargs):
+            counter.count += 1
+            counter.collections.append(collection.name)
+            counter.calls.append((collection.name, args, kwargs))
+            return original(collection, *args, **kwargs)
+
+        mongomock.collection.Collection.find = find
+        try:
+            yield self
+        finally:
+            mongomock.collection.Collection.find = original
+
+
+def count_queries():
+    return QueryCounter()()
+
+
+class Latency(object):
+    '''
+    Makes every find() against the mongomock collections take `seconds`,
+    standing in for the round-trip to a remote server, and records how many
+    were in flight at once
+    '''
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def __call__(self):
+        original = mongomock.collection.Collection.find
+        latency = self
+
+        def find(collection, *args, **kwargs):
+            with latency.lock:
+                latency.in_flight += 1
+                latency.max_in_flight = max(latency.max_in_flight,
+                                            latency.in_flight)
+            try:
+                time.sleep(latency.seconds)
+                return original(collection, *args, **kwargs)
+            finally:
+                with latency.lock:
+                    latency.in_flight -= 1
+
+        mongomock.collection.Collection.find = find
+        try:
+            yield self
+        finally:
+            mongomock.collection.Collection.find = original
+
+
+def simulate_latency(seconds):
+    return Latency(seconds)()
+
+
+def make_api(*registrations, **api_options):
+    app = Flask(__name__)
+    app.testing = True
+    api = CuddlyRest(app=app, **api_options)
+    for registration in registrations:
+        options = registration[2] if len(registration) > 2 else {}
+        api.register(registration[0], registration[1], **options)
+    return app, api
+
+
+def get_json(response):
+    return json.loads(response.data)
@@ -0,0 +1,94 @@
+import unittest2
+from mongoengine import (Document, StringField, IntField, ReferenceField,
+                         EmbeddedDocument, EmbeddedDocumentField)
+
+from test.helpers import count_queries, make_api, get_json
+
+
+class Board(Document):
+    name = StringField()
+
+
+class Stats(EmbeddedDocument):
+    views = IntField()
+
+
+class Card(Document):
+    title = StringField()
+    board = ReferenceField(Board)
+    state = StringField()
+    points = IntField()
+    stats = EmbeddedDocumentField(Stats)
+
+
+class AggregationTest(unittest2.TestCase):
+
+    def setUp(self):
+        for document in (Board, Card):
+            document.drop_collection()
+        self.app, self.api = make_api((Card, 'cards'))
+        self.client = self.app.test_client()
+        self.boards = [Board(name='b%d' % i).save() for i in range(2)]
+        for i in range(6):
+            Card(title='c%d' % i, board=self.boards[i % 2],
+                 state='done' if i < 4 else 'open', points=i + 1,
+                 stats=Stats(views=i * 10)).save()
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.data)
+        return get_json(response)
+
+    def test_count(self):
+        with count_queries() as queries:
+            self.assertEqual(self.get('/cards/count'), {'count': 6})
+        # counted by the server, no documents loaded
+        self.assertEqual(queries.collections, ['card'])
+        self.assertEqual(self.get('/cards/count?state=open'), {'count': 2})
+        self.assertEqual(self.get('/cards/count?points__gte=4&state=done'),
+                         {'count': 1})
+
+    def test_single_resource_still_served(self):
+        card = Card.objects.first()
+        self.assertEqual(self.get('/cards/%s' % card.pk)['title'], 'c0')
+
+    def test_totals(self):
+        self.assertEqual(self.get('/cards/aggregate?sum=points&max=points'),
+                         {'count': 6, 'sum': {'points': 21},
+                          'max': {'points': 6}})
+        self.assertEqual(self.get('/cards/aggregate?state=none'),
+                         {'count': 0})
+
+    def test_group_by(self):
+        rows = self.get('/cards/aggregate?group_by=state'
+                        '&avg=stats.views&min=points')
+        self.assertEqual(rows, [
+            {'state': 'done', 'count': 4, 'avg': {'stats.views': 15},
+             'min': {'points': 1}},
+            {'state': 'open', 'count': 2, 'avg': {'stats.views': 45},
+             'min': {'points': 5}}])
+
+    def test_group_by_reference(self):
+        rows = self.get('/cards/aggregate?group_by=board,state'
+                        '&points__lt=5')
+        self.assertEqual(
+            sorted((row['board'], row['count']) for row in rows),
+            sorted((str(board.pk), 2) for board in self.boards))
+
+    def test_distinct(self):
+        self.assertEqual(sorted(self.get('/cards/aggregate?distinct=state')),
+                         ['done', 'open'])
+        self.assertEqual(
+            sorted(self.get('/cards/aggregate?distinct=board&state=open')),
+            sorted(str(board.pk) for board in self.boards))
+
+    def test_unknown_field(self):
+        response = self.client.get('/cards/aggregate?group_by=nope')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('nope', get_json(response)['error'])
+
+    def test_list_total(self):
+        response = self.client.get('/cards?state=done&limit=2&total=1')
+        self.assertEqual(len(get_json(response)), 2)
+        self.assertEqual(response.headers['X-Total-Count'], '4')
+        self.assertNotIn('X-Total-Count', self.client.get('/cards').headers)
@@ -0,0 +1,227 @@
+import json
+
+import mongomock.collection
+import unittest2
+from bson.objectid import ObjectId
+from mongoengine import (Document, StringField, IntField, ReferenceField,
+                         FileField, CASCADE)
+
+from test.helpers import count_queries, make_api, get_json
+
+
+class Maker(Document):
+    name = StringField()
+
+
+class Item(Document):
+    sku = StringField(required=True, unique=True)
+    count = IntField()
+    maker = ReferenceField(Maker)
+    version = IntField()
+
+
+class Brand(Document):
+    name = StringField()
+
+
+class Product(Document):
+    brand = ReferenceField(Brand, reverse_delete_rule=CASCADE)
+
+
+class Scan(Document):
+    name = StringField()
+    image = FileField()
+
+
+class Vehicle(Document):
+    meta = {'allow_inheritance': True}
+    name = StringField()
+
+
+class Car(Vehicle):
+    pass
+
+
+class Boat(Vehicle):
+    pass
+
+
+class BulkTest(unittest2.TestCase):
+
+    def setUp(self):
+        for document in (Maker, Item):
+            document.drop_collection()
+        Item.ensure_indexes()
+        self.maker = Maker(name='m').save()
+        self.app, self.api = make_api(
+            (Item, 'items', {'bulk_chunk_size': 3}))
+        self.client = self.app.test_client()
+
+    def send(self, method, data, url='/items'):
+        response = getattr(self.client, method)(
+            url, data=json.dumps(data), content_type='application/json')
+        return response.status_code, get_json(response)
+
+    def create(self, count):
+        return [Item(sku='s%d' % i, count=i).save() for i in range(count)]
+
+    def test_create(self):
+        items = [{'sku': 's%d' % i, 'maker': str(self.maker.pk)}
+                 for i in range(7)]
+        inserts = []
+        original = mongomock.collection.Collection.insert_many
+
+        def insert_many(collection, documents, *args, **kwargs):
+            inserts.append(len(documents))
+            return original(collection, documents, *args, **kwargs)
+        mongomock.collection.Collection.insert_many = insert_many
+        try:
+            with count_queries() as queries:
+                status, results = self.send('post', items)
+        finally:
+            mongomock.collection.Collection.insert_many = original
+        self.assertEqual(status, 201)
+        self.assertEqual(inserts, [3, 3, 1])
+        self.assertEqual(queries.collections, ['maker'])
+        self.assertEqual([r['status'] for r in results], [201] * 7)
+        self.assertEqual(sorted(r['id'] for r in results),
+                         sorted(str(i.pk) for i in Item.objects))
+        self.assertEqual(Item.objects.get(sku='s3').maker, self.maker)
+
+    def test_create_partial_failure(self):
+        items = [{'sku': 'a'},
+                 {'count': 1},
+                 {'sku': 'b', 'maker': str(ObjectId())},
+                 {'sku': 'a'},
+                 'nonsense',
+                 {'sku': 'c'},
+                 {'sku': 'd', 'nope': 1}]
+        status, results = self.send('post', items)
+        self.assertEqual(status, 207)
+        self.assertEqual([r['status'] for r in results],
+                         [201, 400, 400, 409, 400, 201, 400])
+        self.assertIn('sku', results[1]['field-errors'])
+        self.assertIn('maker', results[2]['field-errors'])
+        self.assertEqual(results[4]['error'], 'Item should be an object')
+        self.assertEqual(results[6]['field-errors'], {'nope': 'Unknown field'})
+        self.assertEqual(sorted(Item.objects.scalar('sku')), ['a', 'c'])
+
+    def test_patch_ids(self):
+        items = self.create(4)
+        changes = [{'id': str(items[0].pk), 'count': 10},
+                   {'id': str(items[1].pk), 'count': 'x'},
+                   {'id': str(ObjectId()), 'count': 1},
+                   {'id': str(items[3].pk), 'maker': str(self.maker.pk)}]
+        status, results = self.send('patch', changes)
+        self.assertEqual(status, 207)
+        self.assertEqual([r['status'] for r in results], [200, 400, 404, 200])
+        self.assertEqual(Item.objects.get(pk=items[0].pk).count, 10)
+        self.assertEqual(Item.objects.get(pk=items[1].pk).count, 1)
+        self.assertEqual(Item.objects.get(pk=items[3].pk).maker, self.maker)
+
+    def test_patch_keeps_other_fields(self):
+        items = self.create(2)
+        # Changed after the client read them, a bulk PATCH of other fields
+        # should not write the old values back
+        Item.objects(pk=items[0].pk).update(set__sku='changed')
+        status, results = self.send('patch', [
+            {'id': str(items[0].pk), 'count': 7}])
+        self.assertEqual((status, results[0]['status']), (200, 200))
+        item = Item.objects.get(pk=items[0].pk)
+        self.assertEqual((item.sku, item.count), ('changed', 7))
+
+    def test_patch_filter(self):
+        self.create(5)
+        status, result = self.send('patch', {'count': 0},
+                                   '/items?count__gte=2')
+        self.assertEqual((status, result), (200, {'updated': 3}))
+        self.assertEqual(sorted(Item.objects.scalar('count')),
+                         [0, 0, 0, 0, 1])
+        status, _ = self.send('patch', {'count': 0})
+        self.assertEqual(status, 400)
+        status, error = self.send('patch', 5)
+        self.assertEqual((status, error),
+                         (400, {'error': 'Expected a list or an object'}))
+
+    def test_patch_bumps_version(self):
+        self.app, self.api = make_api(
+            (Item, 'items', {'version_field': 'version'}))
+        self.client = self.app.test_client()
+        items = self.create(2)
+        Item.objects(pk=items[1].pk).update(set__version=5)
+        status, results = self.send('patch', [
+            {'id': str(item.pk), 'count': 7} for item in items])
+        self.assertEqual([r['status'] for r in results], [200, 200])
+        self.assertEqual(Item.objects.get(pk=items[1].pk).version, 6)
+
+    def test_delete(self):
+        items = self.create(4)
+        missing = str(ObjectId())
+        status, results = self.send(
+            'delete', [str(items[0].pk), missing, str(items[2].pk)])
+        self.assertEqual(status, 207)
+        self.assertEqual([r['status'] for r in results], [200, 404, 200])
+        self.assertEqual(results[1]['id'], missing)
+        self.assertEqual(sorted(Item.objects.scalar('sku')), ['s1', 's3'])
+        self.assertEqual(self.client.delete('/items').status_code, 400)
+        response = self.client.delete('/items?sku=s1')
+        self.assertEqual(get_json(response), {'deleted': 1})
+        self.assertEqual(list(Item.objects.scalar('sku')), ['s3'])
+
+
+class DeleteTest(unittest2.TestCase):
+
+    def setUp(self):
+        for document in (Item, Brand, Product, Scan, Vehicle):
+            document.drop_collection()
+        self.app, self.api = make_api((Item, 'items', {}),
+                                      (Brand, 'brands', {}),
+                                      (Scan, 'scans', {}), (Car, 'cars', {}))
+        self.client = self.app.test_client()
+
+    def test_delete_one(self):
+        items = [Item(sku='s%d' % i).save() for i in range(2)]
+        with count_queries() as queries:
+            response = self.client.delete('/items/%s' % items[0].pk)
+        self.assertEqual(response.status_code, 200)
+        # The delete_one itself, mongomock finds what it deletes
+        self.assertEqual(queries.count, 1)
+        self.assertEqual(list(Item.objects.scalar('sku')), ['s1'])
+        for url in ('/items/%s' % items[0].pk, '/items/nope'):
+            self.assertEqual(self.client.delete(url).status_code, 404)
+        self.assertEqual(Item.objects.count(), 1)
+
+    def test_delete_rules(self):
+        brands = [Brand(name='b%d' % i).save() for i in range(3)]
+        for brand in brands:
+            Product(brand=brand).save()
+        self.assertEqual(self.client.delete('/brands/%s' % brands[0].pk)
+                         .status_code, 200)
+        response = self.client.delete('/brands?name=b1')
+        self.assertEqual(get_json(response), {'deleted': 1})
+        self.assertEqual([product.brand.name for product in Product.objects],
+                         ['b2'])
+
+    def test_delete_files(self):
+        # Document.delete removes the GridFS files, which mongomock does not
+        # have: check the document goes through it
+        scan = Scan(name='s').save()
+        deleted = []
+
+        def delete(doc, **kwargs):
+            deleted.append(doc.pk)
+            Scan.objects(pk=doc.pk).delete()
+        Scan.delete = delete
+        try:
+            response = self.client.delete('/scans/%s' % scan.pk)
+        finally:
+            del Scan.delete
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(deleted, [scan.pk])
+        self.assertEqual(Scan.objects.count(), 0)
+
+    def test_delete_other_subclass(self):
+        boat = Boat(name='b').save()
+        response = self.client.delete('/cars/%s' % boat.pk)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(Vehicle.objects.count(), 1)
@@ -0,0 +1,148 @@
+import json
+import pickle
+import time
+
+import unittest2
+from mongoengine import Document, StringField, ReferenceField
+
+from flask_cuddlyrest import CuddlyRest
+from flask_cuddlyrest.cache import CacheBackend, LRUCache
+from test.helpers import count_queries, make_api, get_json
+
+
+class Company(Document):
+    name = StringField()
+
+
+class Owner(Document):
+    name = StringField()
+    company = ReferenceField(Company)
+
+
+class Pet(Document):
+    name = StringField()
+    owner = ReferenceField(Owner)
+
+
+class FakeStore(CacheBackend):
+    '''
+    Stands in for an external store, values only survive serialization
+    '''
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        value = self.values.get(key)
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key, value):
+        self.values[key] = pickle.dumps(value)
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+
+class LRUCacheTest(unittest2.TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=0.01)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+
+
+class ResponseCacheTest(unittest2.TestCase):
+    backend = staticmethod(lambda: True)
+
+    def setUp(self):
+        for document in (Company, Owner, Pet):
+            document.drop_collection()
+        self.company = Company(name='c').save()
+        self.owner = Owner(name='o', company=self.company).save()
+        self.pet = Pet(name='rex', owner=self.owner).save()
+        self.app, self.api = make_api(
+            (Pet, 'pets', {'cache': self.backend()}),
+            (Owner, 'owners'), (Company, 'companies'))
+        self.client = self.app.test_client()
+
+    def write(self, method, url, data=None):
+        response = getattr(self.client, method)(
+            url, data=json.dumps(data), content_type='application/json')
+        self.assertIn(response.status_code, (200, 201))
+
+    def assert_cached(self, url):
+        first = self.client.get(url)
+        with count_queries() as queries:
+            second = self.client.get(url)
+        self.assertEqual(queries.count, 0)
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(first.headers['ETag'], second.headers['ETag'])
+        return get_json(second)
+
+    def test_cached(self):
+        self.assert_cached('/pets')
+        self.assert_cached('/pets/%s' % self.pet.pk)
+        self.assert_cached('/pets?name=rex&pretty=1')
+
+    def test_not_modified_from_cache(self):
+        url = '/pets/%s' % self.pet.pk
+        etag = self.client.get(url).headers['ETag']
+        with count_queries() as queries:
+            response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(queries.count, 0)
+
+    def test_invalidated_by_writes(self):
+        url = '/pets/%s' % self.pet.pk
+        self.assert_cached('/pets')
+        self.write('post', '/pets', {'name': 'tom'})
+        self.assertEqual(len(self.assert_cached('/pets')), 2)
+        self.write('put', url, {'name': 'max'})
+        self.assertEqual(self.assert_cached(url)['name'], 'max')
+        self.write('delete', url)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_invalidated_by_referenced_writes(self):
+        url = '/pets/%s' % self.pet.pk
+        self.assert_cached(url)
+        self.write('put', '/owners/%s' % self.owner.pk, {'name': 'p'})
+        self.assertEqual(self.assert_cached(url)['owner']['name'], 'p')
+
+    def test_invalidated_by_nested_referenced_writes(self):
+        url = '/pets/%s' % self.pet.pk
+        self.assertEqual(self.assert_cached(url)['owner']['company']['name'],
+                         'c')
+        self.write('patch', '/companies/%s' % self.company.pk, {'name': 'd'})
+        self.assertEqual(self.assert_cached(url)['owner']['company']['name'],
+                         'd')
+
+    def test_apis_sharing_app(self):
+        other = CuddlyRest(app=self.app, prefix='/v2', pretty=True)
+        other.register(Owner, 'people', cache=True)
+        other.register(Pet, 'animals', stream=True)
+        url = '/pets/%s' % self.pet.pk
+        self.assert_cached(url)
+        self.assert_cached('/v2/people')
+        self.write('patch', url, {'name': 'max'})
+        self.assertEqual(self.assert_cached(url)['name'], 'max')
+        self.write('put', '/v2/people/%s' % self.owner.pk, {'name': 'p'})
+        self.assertEqual(self.assert_cached(url)['owner']['name'], 'p')
+        self.write('post', '/owners', {'name': 'q'})
+        self.assertEqual(len(self.assert_cached('/v2/people')), 2)
+        self.assertIn('\n', self.client.get('/v2/animals').data)
+        self.assertNotIn('\n', self.client.get('/pets').data)
+
+
+class ExternalResponseCacheTest(ResponseCacheTest):
+    backend = FakeStore
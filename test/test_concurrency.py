@@ -0,0 +1,94 @@
+import time
+
+import unittest2
+from mongoengine import Document, StringField, ReferenceField, ListField
+
+from flask_cuddlyrest.concurrency import ThreadPoolExecutor, run_all
+from test.helpers import simulate_latency, make_api, get_json
+
+LATENCY = 0.05
+
+
+class Owner(Document):
+    name = StringField()
+
+
+class Label(Document):
+    name = StringField()
+
+
+class Ticket(Document):
+    title = StringField()
+    owner = ReferenceField(Owner)
+    labels = ListField(ReferenceField(Label))
+
+
+class RunAllTest(unittest2.TestCase):
+
+    def test_results_in_order(self):
+        functions = [lambda i=i: i for i in range(5)]
+        self.assertEqual(run_all(None, functions), range(5))
+        executor = ThreadPoolExecutor(2)
+        self.assertEqual(run_all(executor, functions), range(5))
+        executor.shutdown()
+
+    def test_errors_raised(self):
+        def fail():
+            raise ValueError('boom')
+        executor = ThreadPoolExecutor(1)
+        self.assertRaises(ValueError, run_all, executor, [lambda: 1, fail])
+        executor.shutdown()
+
+
+class ConcurrentReadsTest(unittest2.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.executor = ThreadPoolExecutor(4)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.executor.shutdown()
+
+    def setUp(self):
+        for document in (Owner, Label, Ticket):
+            document.drop_collection()
+        labels = [Label(name='l%d' % i).save() for i in range(2)]
+        for i in range(4):
+            Ticket(title='t%d' % i, owner=Owner(name='o%d' % i).save(),
+                   labels=labels).save()
+
+    def timed_get(self, url, **options):
+        app, _ = make_api((Ticket, 'tickets', options))
+        client = app.test_client()
+        with simulate_latency(LATENCY) as latency:
+            start = time.time()
+            response = client.get(url)
+            elapsed = time.time() - start
+        self.assertEqual(response.status_code, 200)
+        tickets = get_json(response)
+        self.assertEqual(tickets[0]['owner']['name'], 'o0')
+        self.assertEqual(tickets[0]['labels'][1]['name'], 'l1')
+        return elapsed, latency.max_in_flight, response
+
+    def test_references_fetched_concurrently(self):
+        # tickets, then owners and labels
+        serial, in_flight, _ = self.timed_get('/tickets')
+        self.assertEqual(in_flight, 1)
+        self.assertGreaterEqual(serial, 3 * LATENCY)
+        concurrent, in_flight, _ = self.timed_get('/tickets',
+                                                  executor=self.executor)
+        self.assertEqual(in_flight, 2)
+        self.assertLess(concurrent, serial - LATENCY / 2)
+
+    def test_count_with_page(self):
+        # the count meanwhile the tickets, then owners and labels
+        url = '/tickets?limit=2&total=1'
+        serial, _, response = self.timed_get(url)
+        self.assertEqual(response.headers['X-Total-Count'], '4')
+        self.assertGreaterEqual(serial, 4 * LATENCY)
+        concurrent, in_flight, response = self.timed_get(
+            url, executor=self.executor)
+        self.assertEqual(response.headers['X-Total-Count'], '4')
+        self.assertGreater(in_flight, 1)
+        self.assertLess(concurrent, 3 * LATENCY)
@@ -0,0 +1,70 @@
+import json
+from datetime import datetime
+
+import unittest2
+from bson.objectid import ObjectId
+from mongoengine import Document, StringField
+
+from flask_cuddlyrest.encoding import get_encoder, ENCODERS
+from test.helpers import make_api
+
+
+class Note(Document):
+    text = StringField()
+
+
+class EncoderTest(unittest2.TestCase):
+
+    def installed(self):
+        for name in ENCODERS:
+            try:
+                yield get_encoder(name)
+            except ImportError:
+                pass
+
+    def test_compact(self):
+        for encode in self.installed():
+            self.assertEqual(encode({'a': [1, 2]}), '{"a":[1,2]}')
+
+    def test_pretty(self):
+        for encode in self.installed():
+            self.assertEqual(encode({'a': 1}, pretty=True),
+                             '{\n    "a": 1\n}')
+
+    def test_bson_values(self):
+        oid = ObjectId()
+        when = datetime(2014, 1, 2)
+        for encode in self.installed():
+            data = json.loads(encode({'id': oid, 'when': when}))
+            self.assertEqual(data['id'], {'$oid': str(oid)})
+            self.assertIn('$date', data['when'])
+
+    def test_auto(self):
+        self.assertIn(get_encoder(), ENCODERS.values())
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, get_encoder, 'nope')
+
+
+class ResponseEncodingTest(unittest2.TestCase):
+
+    def setUp(self):
+        Note.drop_collection()
+        Note(text='hello').save()
+
+    def get(self, url, **api_options):
+        app, api = make_api((Note, 'notes'), **api_options)
+        return app.test_client().get(url).data
+
+    def test_compact_by_default(self):
+        body = self.get('/notes')
+        self.assertNotIn('\n', body)
+        self.assertEqual(json.loads(body)[0]['text'], 'hello')
+
+    def test_pretty_argument(self):
+        body = self.get('/notes?pretty=1')
+        self.assertIn('\n    ', body)
+        self.assertEqual(json.loads(body)[0]['text'], 'hello')
+
+    def test_pretty_option(self):
+        self.assertIn('\n    ', self.get('/notes', pretty=True))
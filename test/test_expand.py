@@ -0,0 +1,110 @@
+import unittest2
+from mongoengine import Document, StringField, ReferenceField, ListField
+
+from test.helpers import count_queries, make_api, get_json
+
+
+class Company(Document):
+    name = StringField()
+
+
+class Employee(Document):
+    name = StringField()
+    company = ReferenceField(Company)
+    manager = ReferenceField('self')
+    peers = ListField(ReferenceField('self'))
+
+
+class ExpandTest(unittest2.TestCase):
+
+    def setUp(self):
+        for document in (Company, Employee):
+            document.drop_collection()
+        self.company = Company(name='acme').save()
+        self.boss = Employee(name='boss', company=self.company).save()
+        self.alice = Employee(name='alice', company=self.company,
+                              manager=self.boss).save()
+        self.bob = Employee(name='bob', company=self.company,
+                            manager=self.boss, peers=[self.alice]).save()
+        # a cycle: alice and bob are each other's peer
+        self.alice.peers = [self.bob]
+        self.alice.save()
+        self.make_client()
+
+    def make_client(self, **options):
+        self.app, self.api = make_api((Employee, 'employees', options))
+        self.client = self.app.test_client()
+
+    def get(self, url, status=200):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status, response.data)
+        return get_json(response)
+
+    def test_cycles_dumped_as_ids(self):
+        alice = self.get('/employees/%s' % self.alice.pk)
+        bob = alice['peers'][0]
+        self.assertEqual(bob['name'], 'bob')
+        self.assertEqual(bob['manager']['company']['name'], 'acme')
+        self.assertEqual(bob['peers'], [str(self.alice.pk)])
+        employees = self.get('/employees?order_by=name')
+        self.assertEqual(employees[1]['name'], 'bob')
+        self.assertEqual(employees[1]['peers'][0]['name'], 'alice')
+        self.assertEqual(employees[1]['peers'][0]['peers'],
+                         [str(self.bob.pk)])
+        self.assertEqual(employees[0]['peers'][0]['peers'],
+                         [str(self.alice.pk)])
+
+    def test_expand_nothing(self):
+        for url in ('/employees?expand=', '/employees?expand=0'):
+            with count_queries() as queries:
+                employees = self.get(url + '&order_by=name')
+            self.assertEqual(queries.collections, ['employee'])
+            self.assertEqual(employees[0]['company'], str(self.company.pk))
+            self.assertEqual(employees[0]['manager'], str(self.boss.pk))
+            self.assertEqual(employees[0]['peers'], [str(self.bob.pk)])
+
+    def test_expand_depth(self):
+        alice = self.get('/employees/%s?expand=1' % self.alice.pk)
+        self.assertEqual(alice['manager']['name'], 'boss')
+        self.assertEqual(alice['manager']['company'], str(self.company.pk))
+        alice = self.get('/employees/%s?expand=2' % self.alice.pk)
+        self.assertEqual(alice['manager']['company']['name'], 'acme')
+
+    def test_expand_paths(self):
+        with count_queries() as queries:
+            bob = self.get('/employees/%s?expand=manager.company'
+                           % self.bob.pk)
+        # bob, his manager, then the manager's company
+        self.assertEqual(queries.collections,
+                         ['employee', 'employee', 'company'])
+        self.assertEqual(bob['manager']['company']['name'], 'acme')
+        self.assertEqual(bob['manager']['peers'], [])
+        self.assertEqual(bob['company'], str(self.company.pk))
+        self.assertEqual(bob['peers'], [str(self.alice.pk)])
+
+    def test_overlapping_paths(self):
+        for expand in ('manager,manager.company', 'manager.company,manager'):
+            bob = self.get('/employees/%s?expand=%s' % (self.bob.pk, expand))
+            self.assertEqual(bob['manager']['name'], 'boss')
+            self.assertEqual(bob['manager']['company']['name'], 'acme')
+            self.assertEqual(bob['company'], str(self.company.pk))
+
+    def test_unknown_path(self):
+        for expand in ('name', 'nope', 'manager.name'):
+            self.get('/employees?expand=%s' % expand, status=400)
+
+    def test_resource_default(self):
+        self.make_client(expand='company')
+        alice = self.get('/employees/%s' % self.alice.pk)
+        self.assertEqual(alice['company']['name'], 'acme')
+        self.assertEqual(alice['manager'], str(self.boss.pk))
+        alice = self.get('/employees/%s?expand=*' % self.alice.pk)
+        self.assertEqual(alice['manager']['name'], 'boss')
+
+    def test_etag_depends_on_expansion(self):
+        url = '/employees/%s' % self.alice.pk
+        etag = self.client.get(url + '?expand=0').headers['ETag']
+        self.company.name = 'other'
+        self.company.save()
+        self.assertEqual(self.client.get(url + '?expand=0').headers['ETag'],
+                         etag)
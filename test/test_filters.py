@@ -0,0 +1,134 @@
+from datetime import datetime
+from decimal import Decimal
+
+import unittest2
+from bson.objectid import ObjectId
+from mongoengine import (Document, EmbeddedDocument, StringField, IntField,
+                         FloatField, DecimalField, BooleanField,
+                         DateTimeField, ReferenceField, ListField,
+                         EmbeddedDocumentField, DictField)
+from mongoengine.errors import InvalidQueryError
+
+from flask_cuddlyrest import filters
+from flask_cuddlyrest.filters import get_filter_parser
+from test.helpers import count_queries, make_api, get_json
+
+
+class Sensor(Document):
+    name = StringField()
+
+
+class Location(EmbeddedDocument):
+    floor = IntField()
+    room = StringField()
+
+
+class Sample(EmbeddedDocument):
+    value = FloatField()
+
+
+class Reading(Document):
+    count = IntField()
+    ratio = FloatField()
+    price = DecimalField()
+    ok = BooleanField()
+    at = DateTimeField()
+    sensor = ReferenceField(Sensor)
+    labels = ListField(StringField())
+    values = ListField(IntField())
+    location = EmbeddedDocumentField(Location)
+    samples = ListField(EmbeddedDocumentField(Sample))
+    extra = DictField()
+
+
+class FilterParserTest(unittest2.TestCase):
+
+    def setUp(self):
+        self.parser = get_filter_parser(Reading)
+
+    def parse(self, **args):
+        return self.parser.parse(args)
+
+    def test_values_converted(self):
+        pk = ObjectId()
+        self.assertEqual(self.parse(
+            count='3', ratio='0.5', price='1.10', ok='false',
+            at='2020-01-02T03:04:05', sensor=str(pk), id=str(pk),
+            labels='a', values__gt='2', location__floor='1',
+            samples__value__lte='2.5', extra__anything='1'), dict(
+            count=3, ratio=0.5, price=Decimal('1.10'), ok=False,
+            at=datetime(2020, 1, 2, 3, 4, 5), sensor=pk, id=pk,
+            labels='a', values__gt=2, location__floor=1,
+            samples__value__lte=2.5, extra__anything='1'))
+
+    def test_operators(self):
+        self.assertEqual(self.parse(
+            count__in='1,2', count__not__in='3', pk__nin=None, ok__exists='1',
+            values__size='2', count__mod='2,0', labels__all='a,b',
+            location__room__istartswith='1', count__ne=None, values__0='4'),
+            dict(count__in=[1, 2], count__not__in=[3], pk__nin=[],
+                 ok__exists=True, values__size=2, count__mod=[2, 0],
+                 labels__all=['a', 'b'], location__room__istartswith='1',
+                 count__ne=None, values__0=4))
+
+    def test_invalid(self):
+        for name, value in (('count', 'x'), ('count__in', '1,x'),
+                            ('sensor', 'nope'), ('ok', 'maybe'),
+                            ('at__gt', 'yesterday'), ('price', 'x')):
+            with self.assertRaises(InvalidQueryError) as raised:
+                self.parse(**{name: value})
+            self.assertIn(name, str(raised.exception))
+        for name in ('nope', 'location__nope', 'sensor__name',
+                     'count__gt__nope'):
+            self.assertRaises(InvalidQueryError, self.parse, **{name: '1'})
+
+    def test_shapes_cached(self):
+        shape = self.parser.shape('count__gt')
+        self.assertIs(self.parser.shape('count__gt'), shape)
+        self.assertIs(get_filter_parser(Reading), self.parser)
+        original = filters.MAX_SHAPES
+        filters.MAX_SHAPES = len(self.parser.shapes)
+        try:
+            self.parser.shape('ratio__lt')
+            self.assertNotIn('ratio__lt', self.parser.shapes)
+        finally:
+            filters.MAX_SHAPES = original
+
+
+class FilterRequestTest(unittest2.TestCase):
+
+    def setUp(self):
+        for document in (Sensor, Reading):
+            document.drop_collection()
+        self.sensor = Sensor(name='s').save()
+        for i in range(4):
+            Reading(count=i, at=datetime(2020, 1, i + 1), ok=i % 2 == 0,
+                    sensor=self.sensor).save()
+        app, api = make_api((Reading, 'readings'))
+        self.client = app.test_client()
+
+    def get(self, url, status=200):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status, response.data)
+        return get_json(response)
+
+    def counts(self, query):
+        return sorted(reading['count']
+                      for reading in self.get('/readings?' + query))
+
+    def test_converted(self):
+        self.assertEqual(self.counts('count__in=1,3'), [1, 3])
+        self.assertEqual(self.counts('at__gte=2020-01-03T00:00:00'), [2, 3])
+        self.assertEqual(self.counts('ok=true'), [0, 2])
+        self.assertEqual(self.counts('sensor=%s&count__lt=2'
+                                     % self.sensor.pk), [0, 1])
+        self.assertEqual(self.get('/readings/count?count__gt=1'),
+                         {'count': 2})
+
+    def test_rejected_before_querying(self):
+        for query in ('count=x', 'nope=1', 'sensor=1', 'at=someday'):
+            with count_queries() as queries:
+                error = self.get('/readings?' + query, 400)
+            self.assertEqual(queries.count, 0)
+            self.assertIn('error', error)
+        self.get('/readings/count?count__in=a', 400)
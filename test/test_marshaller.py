@@ -1,10 +1,19 @@
 from mongoengine.errors import ValidationError
+import sys
 import unittest2
 from contextlib import contextmanager
 from mongoengine import (
-    EmbeddedDocument, Document, EmbeddedDocumentField, StringField, DictField)
+    EmbeddedDocument, Document, EmbeddedDocumentField, StringField, DictField,
+    ReferenceField, ListField, BinaryField, DateTimeField)
 
-from flask.ext.cuddlyrest.marshaller import Marshaller
+from bson.dbref import DBRef
+from bson.objectid import ObjectId
+from bson.son import SON
+from datetime import datetime
+
+from flask_cuddlyrest.marshaller import (
+    Marshaller, get_plan, invalidate_plan, convert)
+from test.helpers import count_queries
 
 
 class EmptyDoc(Document):
@@ -241,3 +250,166 @@ class DictStringFieldMarshallTest(BaseFieldMarshallTest, unittest2.TestCase):
     valid_optional_values = [{}]
     invalid_values = [{'abc': 2}]
     missing_default = {}
+
+
+class MarshalPlanTest(unittest2.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        class Author(Document):
+            name = StringField()
+
+        class Body(EmbeddedDocument):
+            text = StringField()
+
+        class Article(Document):
+            author = ReferenceField(Author)
+            editors = ListField(ReferenceField(Author))
+            body = EmbeddedDocumentField(Body)
+            blob = BinaryField()
+
+        cls.Author = Author
+        cls.Article = Article
+
+    def test_plan_fields(self):
+        plan = get_plan(self.Article)
+        self.assertEqual(plan.related_fields, set(['author']))
+        self.assertEqual(plan.list_related_fields, set(['editors']))
+        self.assertEqual(plan.embedded_fields, set(['body']))
+        self.assertEqual(list(plan.binary_fields), ['blob'])
+
+    def test_plan_is_shared(self):
+        first = Marshaller(self.Article())
+        second = Marshaller(self.Article())
+        self.assertIs(first.plan, second.plan)
+        self.assertIsNot(first.plan, Marshaller(self.Author()).plan)
+
+    def test_plan_invalidation(self):
+        plan = get_plan(self.Article)
+        invalidate_plan(self.Article)
+        self.assertIsNot(get_plan(self.Article), plan)
+
+    def test_plan_rebuilt_when_fields_change(self):
+        plan = get_plan(self.Author)
+        fields = dict(self.Author._fields)
+        fields['nick'] = StringField()
+        original = self.Author._fields
+        self.Author._fields = fields
+        try:
+            self.assertIsNot(get_plan(self.Author), plan)
+        finally:
+            self.Author._fields = original
+
+
+class Person(Document):
+    name = StringField()
+
+
+class Team(Document):
+    lead = ReferenceField(Person)
+    members = ListField(ReferenceField(Person))
+
+
+class ReferenceLoadsTest(unittest2.TestCase):
+
+    def setUp(self):
+        Person.drop_collection()
+        self.people = [Person(name='p%d' % i).save() for i in range(500)]
+        self.ids = [str(p.pk) for p in self.people]
+
+    def test_references_loaded_in_one_query(self):
+        team = Team()
+        with count_queries() as queries:
+            Marshaller(team).loads({'lead': self.ids[0],
+                                    'members': self.ids})
+        self.assertEqual(queries.count, 1)
+        self.assertEqual(team.lead, self.people[0])
+        self.assertEqual([p.pk for p in team.members],
+                         [p.pk for p in self.people])
+        team.validate()
+
+    def test_missing_references_reported_together(self):
+        missing = [str(ObjectId()), str(ObjectId())]
+        with self.assertRaises(ValidationError) as ctx:
+            Marshaller(Team()).loads({'lead': missing[0],
+                                      'members': self.ids[:2] + missing})
+        errors = ctx.exception.errors
+        self.assertEqual(sorted(errors), ['lead', 'members'])
+        self.assertIn(missing[0], errors['lead'])
+        self.assertIn(missing[0], errors['members'])
+        self.assertIn(missing[1], errors['members'])
+
+    def test_invalid_reference_reported(self):
+        with self.assertRaises(ValidationError) as ctx:
+            Marshaller(Team()).loads({'members': ['not-an-id']})
+        self.assertIn('not-an-id', ctx.exception.errors['members'])
+
+    def test_unchecked_references(self):
+        team = Team()
+        unknown = str(ObjectId())
+        with count_queries() as queries:
+            Marshaller(team, check_references=False).loads(
+                {'lead': unknown, 'members': self.ids[:3]})
+        self.assertEqual(queries.count, 0)
+        self.assertEqual(team._data['lead'],
+                         DBRef('person', ObjectId(unknown)))
+        team.validate()
+        team.save()
+        self.assertEqual(Marshaller(team).dumps()['lead'], unknown)
+
+
+class Node(EmbeddedDocument):
+    at = DateTimeField()
+    blob = BinaryField()
+    child = EmbeddedDocumentField('self')
+
+
+class Tree(Document):
+    name = StringField()
+    root = EmbeddedDocumentField(Node)
+    labels = ListField(StringField())
+    stamps = ListField(DateTimeField())
+    extra = DictField()
+
+
+class ConvertTest(unittest2.TestCase):
+    at = datetime(2014, 5, 1, 12)
+
+    def test_dumps(self):
+        oid = ObjectId()
+        tree = Tree(id=oid, name='t', labels=['a', 'b'], stamps=[self.at],
+                    extra={'when': self.at, 'ids': [oid], 'n': {'x': 1}},
+                    root=Node(at=self.at, blob='\x00\x01',
+                              child=Node(blob='b')))
+        self.assertEqual(Marshaller(tree).dumps(), {
+            'id': str(oid), 'name': 't', 'labels': ['a', 'b'],
+            'stamps': ['2014-05-01T12:00:00'],
+            'extra': {'when': '2014-05-01T12:00:00', 'ids': [str(oid)],
+                      'n': {'x': 1}},
+            'root': {'at': '2014-05-01T12:00:00', 'blob': '\x00\x01',
+                     'child': {'blob': 'b'}}})
+
+    def test_native_lists_are_not_copied(self):
+        data = Tree(labels=['a', 'b']).to_mongo()
+        self.assertIs(convert(data, get_plan(Tree).spec)['labels'],
+                      data['labels'])
+
+    def test_subclasses(self):
+        class Stamp(datetime):
+            pass
+        value = SON([('at', Stamp(2014, 5, 1)), ('list', [ObjectId()])])
+        converted = convert(value)
+        self.assertIs(type(converted), dict)
+        self.assertEqual(converted['at'], '2014-05-01T00:00:00')
+        self.assertIsInstance(converted['list'][0], str)
+
+    def test_no_recursion_limit(self):
+        depth = sys.getrecursionlimit() * 2
+        son = leaf = {'at': self.at}
+        for _ in range(depth):
+            son = {'child': son, 'blob': 'x'}
+        converted = convert({'root': son}, get_plan(Tree).spec)['root']
+        for _ in range(depth):
+            converted = converted['child']
+        self.assertEqual(converted, {'at': '2014-05-01T12:00:00'})
+        self.assertEqual(leaf, {'at': self.at})
@@ -0,0 +1,137 @@
+from datetime import timedelta
+
+import unittest2
+from mongoengine import Document, StringField, ReferenceField
+from pymongo.monitoring import CommandSucceededEvent
+
+from flask_cuddlyrest.concurrency import ThreadPoolExecutor, run_all
+from flask_cuddlyrest.metrics import (
+    Metrics, Histogram, command_counter, timed, start_timings, stop_timings,
+    current_timings)
+from test.helpers import make_api, get_json
+
+
+class Author(Document):
+    name = StringField()
+
+
+class Book(Document):
+    title = StringField()
+    author = ReferenceField(Author)
+
+
+def command_succeeded(milliseconds):
+    return CommandSucceededEvent(timedelta(milliseconds=milliseconds),
+                                 {'ok': 1}, 'find', 1, ('localhost', 27017),
+                                 1)
+
+
+class TimingsTest(unittest2.TestCase):
+
+    def tearDown(self):
+        stop_timings()
+
+    def test_phases_add_up(self):
+        start_timings()
+        timings = current_timings()
+        with timed('query'):
+            pass
+        with timed('query'):
+            pass
+        with timed('marshal'):
+            pass
+        self.assertEqual(list(timings.phases), ['query', 'marshal'])
+        self.assertGreater(timings.phases['query'], 0)
+
+    def test_not_instrumented(self):
+        with timed('query'):
+            pass
+        command_counter.succeeded(command_succeeded(1))
+
+    def test_commands_counted(self):
+        start_timings()
+        timings = current_timings()
+        command_counter.succeeded(command_succeeded(2))
+        command_counter.succeeded(command_succeeded(3))
+        self.assertEqual(timings.commands, 2)
+        self.assertAlmostEqual(timings.command_seconds, 0.005)
+        self.assertIn('db;dur=5.000;desc="2 commands"',
+                      timings.server_timing())
+
+    def test_executor_threads_accounted(self):
+        start_timings()
+        timings = current_timings()
+        executor = ThreadPoolExecutor(2)
+
+        def query():
+            with timed('query'):
+                command_counter.succeeded(command_succeeded(1))
+        run_all(executor, [query, query, query])
+        executor.shutdown()
+        self.assertEqual(timings.commands, 3)
+        self.assertIn('query', timings.phases)
+
+
+class HistogramTest(unittest2.TestCase):
+
+    def test_render(self):
+        histogram = Histogram('h', 'help', ('endpoint', ), (1, 2))
+        for value in (0.5, 1, 1.5, 3):
+            histogram.observe(('e"1', ), value)
+        self.assertEqual(list(histogram.samples()), [
+            ('_bucket', '{endpoint="e\\"1",le="1"}', 2),
+            ('_bucket', '{endpoint="e\\"1",le="2"}', 3),
+            ('_bucket', '{endpoint="e\\"1",le="+Inf"}', 4),
+            ('_sum', '{endpoint="e\\"1"}', 6.0),
+            ('_count', '{endpoint="e\\"1"}', 4)])
+
+
+class InstrumentedApiTest(unittest2.TestCase):
+
+    def setUp(self):
+        for document in (Author, Book):
+            document.drop_collection()
+        self.book = Book(title='b', author=Author(name='a').save()).save()
+
+    def test_server_timing(self):
+        app, api = make_api((Book, 'books'), server_timing=True)
+        client = app.test_client()
+        response = client.get('/books')
+        self.assertEqual(get_json(response)[0]['author']['name'], 'a')
+        phases = [metric.split(';')[0] for metric in
+                  response.headers['Server-Timing'].split(', ')]
+        self.assertEqual(phases, ['args', 'query', 'references', 'etag',
+                                  'marshal', 'encode', 'db', 'total'])
+        self.assertIsNone(api.metrics)
+
+    def test_off_by_default(self):
+        app, api = make_api((Book, 'books'))
+        response = app.test_client().get('/books')
+        self.assertNotIn('Server-Timing', response.headers)
+        self.assertIsNone(api.metrics)
+
+    def test_metrics(self):
+        metrics = Metrics()
+        app, api = make_api((Book, 'books'), metrics=metrics)
+        client = app.test_client()
+        client.get('/books')
+        client.get('/books/%s' % self.book.pk)
+        client.get('/books/%s' % self.book.pk)
+        client.get('/books/000000000000000000000000')
+        self.assertIs(api.metrics, metrics)
+        self.assertNotIn('Server-Timing',
+                         client.get('/books').headers)
+        text = metrics.render()
+        self.assertIn('# TYPE cuddlyrest_request_duration_seconds histogram',
+                      text)
+        self.assertIn('cuddlyrest_request_duration_seconds_count'
+                      '{endpoint="books_multiple",method="GET"} 2', text)
+        self.assertIn('cuddlyrest_phase_duration_seconds_count'
+                      '{endpoint="books_single",method="GET",'
+                      'phase="marshal"} 2', text)
+        self.assertIn('cuddlyrest_responses_total{endpoint="books_single",'
+                      'method="GET",code="404"} 1', text)
+        self.assertIn('cuddlyrest_mongo_commands_count'
+                      '{endpoint="books_single",method="GET"} 3', text)
+        self.assertIn('cuddlyrest_identity_map_lookups_total'
+                      '{kind="document",result="miss"} 4', text)
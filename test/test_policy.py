@@ -0,0 +1,139 @@
+import warnings
+from datetime import datetime
+
+import mongomock.collection
+import unittest2
+from mongoengine import (Document, StringField, IntField, DateTimeField,
+                         ReferenceField)
+
+from flask_cuddlyrest.policy import Indexes, split_filter
+from flask_cuddlyrest.views import UnindexedQueryWarning
+from test.helpers import make_api, get_json
+
+
+class Writer(Document):
+    name = StringField()
+
+
+class Article(Document):
+    title = StringField()
+    slug = StringField()
+    views = IntField()
+    created = DateTimeField()
+    writer = ReferenceField(Writer)
+    meta = {'indexes': ['slug', ('writer', '-created')]}
+
+
+class PolicyTest(unittest2.TestCase):
+
+    def setUp(self):
+        for document in (Writer, Article):
+            document.drop_collection()
+        Indexes.forget()
+        self.writer = Writer(name='w').save()
+        for i in range(3):
+            Article(title='article %d' % i, slug='a%d' % i, views=i,
+                    created=datetime(2020, 1, i + 1),
+                    writer=self.writer).save()
+
+    def client(self, **options):
+        app, api = make_api((Article, 'articles', options))
+        return app.test_client()
+
+    def assertStatus(self, client, url, status):
+        response = client.get(url)
+        self.assertEqual(response.status_code, status, response.data)
+        return get_json(response)
+
+    def test_split_filter(self):
+        self.assertEqual(split_filter(Article, 'title__not__startswith'),
+                         ('title', 'not__startswith'))
+        self.assertEqual(split_filter(Article, 'writer'), ('writer', 'eq'))
+        self.assertEqual(split_filter(Article, 'pk__in'), ('_id', 'in'))
+
+    def test_allowed_filters(self):
+        client = self.client(allowed_filters=['title', 'slug'])
+        self.assertEqual(len(self.assertStatus(
+            client, '/articles?title__startswith=article', 200)), 3)
+        self.assertStatus(client, '/articles?views__gt=1', 400)
+        self.assertStatus(client, '/articles/count?views=1', 400)
+        self.assertStatus(client, '/articles/aggregate?sum=views&views=1',
+                          400)
+        self.assertEqual(self.assertStatus(
+            client, '/articles/aggregate?sum=views&slug=a2', 200)['sum'],
+            {'views': 2})
+
+    def test_allowed_operators(self):
+        client = self.client(allowed_filters={'title': ['eq', 'startswith'],
+                                              'slug': None})
+        self.assertStatus(client, '/articles?title=article%201', 200)
+        self.assertStatus(client, '/articles?slug__icontains=a', 200)
+        error = self.assertStatus(client, '/articles?title__icontains=a',
+                                  400)
+        self.assertIn('icontains', error['error'])
+
+    def test_allowed_ordering(self):
+        client = self.client(allowed_ordering=['created'])
+        articles = self.assertStatus(client, '/articles?order_by=-created',
+                                     200)
+        self.assertEqual(articles[0]['slug'], 'a2')
+        self.assertStatus(client, '/articles?order_by=views', 400)
+        self.assertStatus(client, '/articles?order_by=id', 200)
+
+    def test_checked_when_registered(self):
+        make_api((Article, 'articles', dict(
+            allowed_filters=['slug', 'writer'], allowed_ordering=['created'],
+            unindexed='reject')))
+        with self.assertRaises(ValueError) as raised:
+            make_api((Article, 'articles', dict(
+                allowed_filters={'slug': ['eq', 'iexact'], 'views': None},
+                unindexed='reject')))
+        self.assertIn('filtering on views', str(raised.exception))
+        self.assertIn('iexact', str(raised.exception))
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            make_api((Article, 'articles', dict(
+                allowed_ordering=['created'], unindexed='warn')))
+        self.assertEqual([w.category for w in caught],
+                         [UnindexedQueryWarning])
+        self.assertIn('ordering by created', str(caught[0].message))
+
+    def test_unindexed_rejected(self):
+        client = self.client(unindexed='reject')
+        self.assertStatus(client, '/articles', 200)
+        self.assertStatus(client, '/articles?slug=a1', 200)
+        self.assertStatus(client, '/articles?slug=a1&views=1', 200)
+        self.assertStatus(client, '/articles?writer=%s&order_by=-created'
+                          % self.writer.pk, 200)
+        self.assertStatus(client, '/articles?views=1', 400)
+        self.assertStatus(client, '/articles?slug__iexact=a1', 400)
+        error = self.assertStatus(client, '/articles?order_by=created', 400)
+        self.assertIn('ordering by created', error['error'])
+
+    def test_unindexed_warned(self):
+        client = self.client(unindexed='warn')
+        self.assertEqual(len(self.assertStatus(client, '/articles?views=1',
+                                               200)), 1)
+
+    def test_explain(self):
+        self.assertStatus(self.client(), '/articles?explain=1', 400)
+        original = getattr(mongomock.collection.Cursor, 'explain', None)
+        # mongomock has no query planner
+        mongomock.collection.Cursor.explain = lambda cursor: {
+            'queryPlanner': {'winningPlan': {'stage': 'IXSCAN'},
+                             'rejectedPlans': []}}
+        try:
+            plan = self.assertStatus(
+                self.client(explain=True, unindexed='warn'),
+                '/articles?explain=1&views=1&limit=2', 200)
+        finally:
+            if original is None:
+                del mongomock.collection.Cursor.explain
+            else:
+                mongomock.collection.Cursor.explain = original
+        self.assertEqual(plan['winning_plan'], {'stage': 'IXSCAN'})
+        self.assertEqual(plan['query'], {'views': 1})
+        self.assertEqual(plan['sort'], [['_id', 1]])
+        self.assertEqual(plan['unindexed'], 'no index for filtering on views')
+        self.assertEqual(plan['indexes'],
+                         ['_id_', 'slug_1', 'writer_1_created_-1'])
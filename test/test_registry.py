@@ -0,0 +1,83 @@
+import sys
+
+import unittest2
+from mongoengine import (Document, EmbeddedDocument, StringField,
+                         ReferenceField)
+
+from flask_cuddlyrest import collection_documents
+from flask_cuddlyrest.views import MongoResource
+from test.helpers import make_api, get_json
+
+
+class Writer(Document):
+    name = StringField()
+
+
+class Book(Document):
+    title = StringField()
+    writer = ReferenceField(Writer)
+
+
+class Named(Document):
+    meta = {'abstract': True}
+    name = StringField()
+
+
+class Animal(Named):
+    meta = {'allow_inheritance': True}
+
+
+class Dog(Animal):
+    pass
+
+
+class Chapter(EmbeddedDocument):
+    title = StringField()
+
+
+class RegistryTest(unittest2.TestCase):
+
+    def setUp(self):
+        for document in (Writer, Book, Animal):
+            document.drop_collection()
+
+    def test_collection_documents(self):
+        self.assertEqual(collection_documents(sys.modules[__name__]),
+                         [Animal, Book, Writer])
+
+    def test_register_many(self):
+        app, api = make_api()
+        names = api.register_many(sys.modules[__name__], page_size=1)
+        self.assertEqual(names, ['animal', 'book', 'writer'])
+        self.assertEqual(list(api.registry), names)
+        self.assertEqual(api.registry['book'].references,
+                         frozenset([Writer]))
+        Dog(name='d').save()
+        Animal(name='a').save()
+        response = app.test_client().get('/animal')
+        self.assertEqual(len(get_json(response)), 1)
+        api.register_many([(Writer, 'authors')])
+        self.assertIn('authors_single', app.view_functions)
+        self.assertRaises(ValueError, api.register, Book, 'book')
+
+    def test_resources_reused(self):
+        app, api = make_api((Book, 'books'))
+        client = app.test_client()
+        created = []
+        original = MongoResource.__init__
+
+        def init(resource, *args, **kwargs):
+            created.append(resource)
+            original(resource, *args, **kwargs)
+        MongoResource.__init__ = init
+        try:
+            book = get_json(client.post('/books', data='{"title": "t"}',
+                                        content_type='application/json'))
+            for url in ('/books', '/books/%s' % book['id'], '/books/count'):
+                self.assertEqual(client.get(url).status_code, 200)
+        finally:
+            MongoResource.__init__ = original
+        self.assertEqual(created, [])
+        view = app.view_functions['books_single']
+        self.assertEqual(view.methods, api.registry['books']
+                         .resources['single'].methods)
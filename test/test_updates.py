@@ -0,0 +1,278 @@
+import json
+
+import unittest2
+from mongoengine import (Document, EmbeddedDocument, StringField, IntField,
+                         FloatField, ListField, ReferenceField,
+                         EmbeddedDocumentField)
+from mongoengine.errors import ValidationError
+
+from flask_cuddlyrest.updates import Update
+from test.helpers import count_queries, make_api, get_json
+
+
+class Owner(Document):
+    name = StringField()
+
+
+class Note(EmbeddedDocument):
+    text = StringField()
+
+
+class Item(Document):
+    title = StringField(required=True)
+    body = StringField()
+    views = IntField(default=0)
+    score = FloatField()
+    tags = ListField(StringField())
+    watchers = ListField(ReferenceField(Owner))
+    owner = ReferenceField(Owner)
+    note = EmbeddedDocumentField(Note)
+    version = IntField()
+
+
+class Pet(Document):
+    meta = {'allow_inheritance': True}
+    name = StringField()
+
+
+class Dog(Pet):
+    tricks = IntField()
+
+
+class Cat(Pet):
+    pass
+
+
+class UpdateTest(unittest2.TestCase):
+
+    def setUp(self):
+        Owner.drop_collection()
+        self.owner = Owner(name='o').save()
+
+    def test_operators(self):
+        update = Update.parse(Item, {
+            'title': 't', 'body': None, 'owner': str(self.owner.pk),
+            'note': {'text': 'n'}, '$inc': {'views': 2, 'score': 0.5},
+            '$push': {'tags': 'a', 'watchers': {
+                '$each': [str(self.owner.pk)]}}})
+        operators = update.mongo()
+        self.assertEqual(operators['$set']['title'], 't')
+        self.assertEqual(operators['$set']['owner'], self.owner.pk)
+        self.assertEqual(dict(operators['$set']['note']), {'text': 'n'})
+        self.assertEqual(operators['$unset'], {'body': ''})
+        self.assertEqual(operators['$inc'], {'views': 2, 'score': 0.5})
+        self.assertEqual(operators['$push'], {
+            'tags': {'$each': ['a']},
+            'watchers': {'$each': [self.owner.pk]}})
+
+    def test_invalid(self):
+        for body, name in (({'nope': 1}, 'nope'),
+                           ({'id': 'x'}, 'id'),
+                           ({'title': None}, 'title'),
+                           ({'$unset': {'title': 1}}, 'title'),
+                           ({'views': 'many'}, 'views'),
+                           ({'$inc': {'title': 1}}, 'title'),
+                           ({'$inc': {'views': '1'}}, 'views'),
+                           ({'$push': {'views': 1}}, 'views'),
+                           ({'$rename': {'views': 'x'}}, '$rename'),
+                           ({'views': 1, '$inc': {'views': 1}}, 'views'),
+                           ({'version': 1}, 'version')):
+            with self.assertRaises(ValidationError) as raised:
+                Update.parse(Item, body, readonly=['version'])
+            self.assertIn(name, raised.exception.errors)
+        self.assertRaises(ValidationError, Update.parse, Item, [])
+
+    def test_apply(self):
+        item = Item(title='t', views=1, tags=['a'], body='b')
+        Update.parse(Item, {'title': 'u', 'body': None,
+                            '$inc': {'views': 2},
+                            '$push': {'tags': 'b'}}).apply(item)
+        self.assertEqual((item.title, item.body, item.views, item.tags),
+                         ('u', None, 3, ['a', 'b']))
+
+
+class PatchTest(unittest2.TestCase):
+
+    def setUp(self):
+        for document in (Owner, Item):
+            document.drop_collection()
+        self.owner = Owner(name='o').save()
+        self.item = Item(title='t', body='b', tags=['a'],
+                         owner=self.owner).save()
+        self.url = '/items/%s' % self.item.pk
+        self.make_client()
+
+    def make_client(self, **options):
+        self.app, self.api = make_api((Item, 'items', options))
+        self.client = self.app.test_client()
+
+    def send(self, method, data, url=None, **headers):
+        return getattr(self.client, method)(
+            url or self.url, data=json.dumps(data),
+            content_type='application/json', headers=headers)
+
+    def test_patch(self):
+        with count_queries() as queries:
+            response = self.send('patch', {'body': None, '$inc': {'views': 3},
+                                           '$push': {'tags': 'b'}})
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(queries.collections.count('owner'), 1)
+        item = get_json(response)
+        self.assertEqual((item['title'], item['views'], item['tags']),
+                         ('t', 3, ['a', 'b']))
+        self.assertNotIn('body', item)
+        self.assertEqual(item['owner']['name'], 'o')
+        self.assertEqual(response.headers['ETag'],
+                         self.client.get(self.url).headers['ETag'])
+        stored = Item.objects.get()
+        self.assertEqual((stored.body, stored.views), (None, 3))
+
+    def test_writes_ignore_query_arguments(self):
+        response = self.send('post', {'title': 'n'}, url='/items?foo=1')
+        self.assertEqual(response.status_code, 201, response.data)
+        for method in ('put', 'patch'):
+            response = self.send(method, {'title': method,
+                                          'owner': str(self.owner.pk)},
+                                 url=self.url + '?foo=1&expand=0')
+            self.assertEqual(response.status_code, 200, response.data)
+            self.assertEqual(get_json(response)['owner'], str(self.owner.pk))
+        self.assertEqual(self.send('patch', {'views': 1},
+                                   url=self.url + '?expand=nope')
+                         .status_code, 400)
+
+    def test_patch_errors(self):
+        response = self.send('patch', {'views': 'x'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('views', get_json(response)['field-errors'])
+        response = self.send('patch', {'owner': '000000000000000000000000'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.send('patch', {'views': 1},
+                                   url='/items/000000000000000000000000')
+                         .status_code, 404)
+        response = self.send('patch', ['views'])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(get_json(response), {'error': 'Expected an object'})
+        self.assertEqual(Item.objects.get().views, 0)
+
+    def test_patch_versioned(self):
+        self.make_client(version_field='version')
+        etag = self.client.get(self.url).headers['ETag']
+        self.assertEqual(self.send('patch', {'views': 1}).status_code, 200)
+        self.assertEqual(Item.objects.get().version, 1)
+        self.assertEqual(self.send('patch', {'views': 2},
+                                   **{'If-Match': etag}).status_code, 412)
+        etag = self.client.get(self.url).headers['ETag']
+        self.assertEqual(self.send('patch', {'views': 2},
+                                   **{'If-Match': etag}).status_code, 200)
+        self.assertEqual(Item.objects.get().version, 2)
+        self.assertEqual(self.send('patch', {'version': 5}).status_code, 400)
+
+    def test_patch_versioned_after_post(self):
+        self.make_client(version_field='version')
+        response = self.send('post', {'title': 'n'}, url='/items')
+        url = '/items/%s' % get_json(response)['id']
+        etag = self.client.get(url).headers['ETag']
+        response = self.send('patch', {'views': 1}, url=url,
+                             **{'If-Match': etag})
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(get_json(response)['version'], 1)
+        self.assertEqual(self.send('patch', {'views': 2}, url=url,
+                                   **{'If-Match': etag}).status_code, 412)
+
+    def test_subclass_fields(self):
+        Pet.drop_collection()
+        dog = Dog(name='d', tricks=1).save()
+        app, _ = make_api((Pet, 'pets'))
+        self.client = app.test_client()
+        url = '/pets/%s' % dog.pk
+        response = self.send('patch', {'tricks': 7}, url=url)
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(get_json(response)['tricks'], 7)
+        self.assertEqual(self.send('patch', {'nope': 1}, url=url)
+                         .status_code, 400)
+        response = self.send('put', {'name': 'e', 'tricks': 2}, url=url)
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(get_json(self.client.get(url))['tricks'], 2)
+        self.assertEqual(self.client.get('/pets').status_code, 200)
+        stored = Pet.objects.get()
+        self.assertIsInstance(stored, Dog)
+        self.assertEqual((stored.name, stored.tricks), ('e', 2))
+
+    def test_patch_other_subclass(self):
+        Pet.drop_collection()
+        cat = Cat(name='c').save()
+        app, _ = make_api((Dog, 'dogs'))
+        self.client = app.test_client()
+        url = '/dogs/%s' % cat.pk
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(self.send('patch', {'name': 'd'}, url=url)
+                         .status_code, 404)
+        self.assertEqual(Pet.objects.get().name, 'c')
+
+    def test_put_replaces(self):
+        response = self.send('put', {'title': 'u', 'tags': ['c']})
+        self.assertEqual(response.status_code, 200, response.data)
+        item = get_json(response)
+        self.assertEqual((item['title'], item['tags'], item['views']),
+                         ('u', ['c'], 0))
+        self.assertNotIn('body', item)
+        self.assertIsNone(item.get('owner'))
+        self.assertEqual(self.send('put', {'body': 'b'}).status_code, 400)
+        self.assertEqual(Item.objects.get().title, 'u')
+
+    def test_put_missing(self):
+        url = '/items/000000000000000000000000'
+        self.assertEqual(self.send('put', {'title': 'u'}, url=url)
+                         .status_code, 404)
+        self.assertEqual(Item.objects.count(), 1)
+
+    def test_post_once(self):
+        with count_queries() as queries:
+            response = self.send('post', {'title': 'n', 'owner': str(
+                self.owner.pk)}, url='/items')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(get_json(response)['owner']['name'], 'o')
+        self.assertEqual(queries.collections.count('owner'), 1)
+        self.assertEqual(queries.collections.count('item'), 0)
+
+    def test_put_no_refetch(self):
+        with count_queries() as queries:
+            response = self.send('put', {'title': 'u',
+                                         'owner': str(self.owner.pk)})
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(get_json(response)['owner']['name'], 'o')
+        self.assertEqual(queries.collections.count('item'), 1)
+
+    def test_post_minimal(self):
+        response = self.send('post', {'title': 'n'}, url='/items',
+                             Prefer='return=minimal')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.headers['Preference-Applied'],
+                         'return=minimal')
+        created = Item.objects.get(title='n')
+        self.assertTrue(response.headers['Location'].endswith(
+            '/items/%s' % created.pk))
+
+    def test_put_minimal(self):
+        self.make_client(version_field='version')
+        with count_queries() as queries:
+            response = self.send('put', {'title': 'u'},
+                                 Prefer='respond-async, return=minimal')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(queries.collections.count('owner'), 0)
+        self.assertEqual(response.headers['ETag'],
+                         self.client.get(self.url).headers['ETag'])
+        self.assertEqual(Item.objects.get().title, 'u')
+
+    def test_patch_minimal(self):
+        self.make_client(version_field='version')
+        with count_queries() as queries:
+            response = self.send('patch', {'$inc': {'views': 2}},
+                                 Prefer='return=minimal')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(queries.collections.count('owner'), 0)
+        self.assertEqual(get_json(response), {
+            'id': str(self.item.pk), 'views': 2, 'version': 1})
+        self.assertEqual(response.headers['ETag'],
+                         self.client.get(self.url).headers['ETag'])
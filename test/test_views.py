@@ -0,0 +1,483 @@
+import gc
+import json
+import re
+from datetime import datetime
+
+import unittest2
+from mongoengine import (Document, EmbeddedDocument, StringField,
+                         ReferenceField, ListField, EmbeddedDocumentField,
+                         BinaryField, IntField, DateTimeField, FloatField,
+                         BooleanField)
+
+from mongoengine.errors import SaveConditionError
+from werkzeug.http import http_date
+
+from flask_cuddlyrest.views import SingleMongoResource
+from test.helpers import count_queries, make_api, get_json
+
+
+class Author(Document):
+    name = StringField()
+
+
+class Tag(Document):
+    label = StringField()
+
+
+class Post(Document):
+    title = StringField()
+    author = ReferenceField(Author)
+    tags = ListField(ReferenceField(Tag))
+
+
+class ListReferencesTest(unittest2.TestCase):
+
+    def setUp(self):
+        for document in (Author, Tag, Post):
+            document.drop_collection()
+        self.app, self.api = make_api((Post, 'posts'))
+        self.client = self.app.test_client()
+
+    def create_posts(self, count):
+        tags = [Tag(label='tag %d' % i).save() for i in range(3)]
+        for i in range(count):
+            author = Author(name='author %d' % (i % 4)).save()
+            Post(title='post %d' % i, author=author, tags=tags).save()
+
+    def test_references_are_expanded(self):
+        self.create_posts(2)
+        posts = get_json(self.client.get('/posts'))
+        self.assertEqual(len(posts), 2)
+        self.assertEqual(posts[0]['author']['name'], 'author 0')
+        self.assertEqual([t['label'] for t in posts[0]['tags']],
+                         ['tag 0', 'tag 1', 'tag 2'])
+
+    def test_filter(self):
+        self.create_posts(3)
+        posts = get_json(self.client.get('/posts?title=post 1'))
+        self.assertEqual([p['title'] for p in posts], ['post 1'])
+
+    def test_query_count_does_not_grow_with_page_size(self):
+        for count in (5, 50):
+            self.setUp()
+            self.create_posts(count)
+            with count_queries() as queries:
+                response = self.client.get('/posts')
+            self.assertEqual(response.status_code, 200)
+            # posts, then one query for authors and one for tags
+            self.assertEqual(queries.count, 3)
+            self.assertEqual(sorted(queries.collections),
+                             ['author', 'post', 'tag'])
+
+
+class StreamingListTest(unittest2.TestCase):
+    chunk_size = 20
+
+    def setUp(self):
+        for document in (Author, Tag, Post):
+            document.drop_collection()
+        self.app, self.api = make_api(
+            (Post, 'posts', {'stream': True,
+                             'stream_chunk_size': self.chunk_size}))
+        self.client = self.app.test_client()
+
+    def live_posts(self):
+        gc.collect()
+        return sum(1 for o in gc.get_objects() if isinstance(o, Post))
+
+    def stream_posts(self, count):
+        author = Author(name='author').save()
+        if count:
+            Post.objects.insert([Post(title='post %d' % i, author=author)
+                                 for i in range(count)], load_bulk=False)
+        response = self.client.get('/posts')
+        self.assertEqual(response.status_code, 200)
+        body, peak = [], 0
+        for chunk in response.response:
+            body.append(chunk)
+            peak = max(peak, self.live_posts())
+        # one chunk per stream_chunk_size documents plus the closing bracket
+        self.assertEqual(len(body), count // self.chunk_size + 1)
+        return json.loads(''.join(body)), peak
+
+    def test_empty(self):
+        self.assertEqual(self.stream_posts(0)[0], [])
+
+    def test_streamed_body(self):
+        posts, _ = self.stream_posts(40)
+        self.assertEqual([p['title'] for p in posts],
+                         ['post %d' % i for i in range(40)])
+        self.assertEqual(posts[0]['author']['name'], 'author')
+
+    def test_memory_stays_flat(self):
+        for count in (60, 600):
+            self.setUp()
+            _, peak = self.stream_posts(count)
+            self.assertLessEqual(peak, self.chunk_size)
+
+
+class Body(EmbeddedDocument):
+    text = StringField()
+    lang = StringField()
+
+
+class Writer(Document):
+    name = StringField()
+    email = StringField()
+
+
+class Article(Document):
+    title = StringField()
+    body = EmbeddedDocumentField(Body)
+    writer = ReferenceField(Writer)
+    blob = BinaryField()
+
+
+class ProjectionTest(unittest2.TestCase):
+
+    def setUp(self):
+        for document in (Writer, Article):
+            document.drop_collection()
+        self.app, self.api = make_api((Article, 'articles'))
+        self.client = self.app.test_client()
+        writer = Writer(name='w', email='w@example.com').save()
+        self.article = Article(title='t', body=Body(text='x', lang='en'),
+                               writer=writer, blob=b'data').save()
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return get_json(response)
+
+    def test_fields(self):
+        for article in (self.get('/articles?fields=title')[0],
+                        self.get('/articles/%s?fields=title'
+                                 % self.article.pk)):
+            self.assertEqual(article, {'id': str(self.article.pk),
+                                       'title': 't'})
+
+    def test_single_ignores_other_arguments(self):
+        article = self.get('/articles/%s?fields=title&_=1400000000&foo=1'
+                           % self.article.pk)
+        self.assertEqual(article['title'], 't')
+
+    def test_nested_fields(self):
+        article = self.get('/articles?fields=body.text,writer.email')[0]
+        self.assertEqual(sorted(article), ['body', 'id', 'writer'])
+        self.assertEqual(article['body'], {'text': 'x'})
+        self.assertEqual(sorted(article['writer']), ['email', 'id'])
+
+    def test_exclude(self):
+        article = self.get('/articles?exclude=blob,body.lang,writer.email')[0]
+        self.assertEqual(sorted(article), ['body', 'id', 'title', 'writer'])
+        self.assertEqual(article['body'], {'text': 'x'})
+        self.assertEqual(sorted(article['writer']), ['id', 'name'])
+
+    def test_projection_sent_to_mongo(self):
+        with count_queries() as queries:
+            self.get('/articles?fields=title,body.text,writer.email')
+        name, args, kwargs = queries.calls[0]
+        self.assertEqual(name, 'article')
+        projection = kwargs.get('projection') or args[1]
+        self.assertEqual(sorted(k for k, v in projection.items() if v),
+                         ['_id', 'body.text', 'title', 'writer'])
+
+    def test_unknown_field(self):
+        for url in ('/articles?fields=nope', '/articles?exclude=title.x',
+                    '/articles?fields=writer.nope'):
+            self.assertEqual(self.client.get(url).status_code, 400)
+
+
+class Entry(Document):
+    rank = IntField()
+
+
+class PaginationTest(unittest2.TestCase):
+
+    def setUp(self):
+        Entry.drop_collection()
+        Entry.objects.insert([Entry(rank=i % 7) for i in range(25)])
+        self.app, self.api = make_api(
+            (Entry, 'entries', {'max_page_size': 20}))
+        self.client = self.app.test_client()
+
+    def walk(self, url):
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            pages.append(get_json(response))
+            link = response.headers.get('Link')
+            url = link and re.match('<(.*)>; rel="next"', link).group(1)
+        return pages
+
+    def test_pages_by_id(self):
+        pages = self.walk('/entries?limit=10')
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        ids = [entry['id'] for page in pages for entry in page]
+        self.assertEqual(ids, sorted(str(e.pk) for e in Entry.objects))
+
+    def test_pages_by_key(self):
+        for order, reverse in (('rank', False), ('-rank', True)):
+            pages = self.walk('/entries?limit=4&order_by=%s' % order)
+            entries = [entry for page in pages for entry in page]
+            self.assertEqual(len(set(e['id'] for e in entries)), 25)
+            keys = [(e['rank'], e['id']) for e in entries]
+            self.assertEqual(keys, sorted(keys, reverse=reverse))
+
+    def test_pages_with_missing_keys(self):
+        Entry.objects(rank__in=[0, 3]).update(unset__rank=True)
+        for order, reverse in (('rank', False), ('-rank', True)):
+            pages = self.walk('/entries?limit=4&order_by=%s' % order)
+            entries = [entry for page in pages for entry in page]
+            self.assertEqual(len(set(e['id'] for e in entries)), 25)
+            keys = [(e.get('rank', -1), e['id']) for e in entries]
+            self.assertEqual(keys, sorted(keys, reverse=reverse))
+
+    def test_max_page_size(self):
+        pages = self.walk('/entries')
+        self.assertEqual([len(page) for page in pages], [20, 5])
+        pages = self.walk('/entries?limit=100')
+        self.assertEqual([len(page) for page in pages], [20, 5])
+
+    def test_page_size(self):
+        self.app, self.api = make_api((Entry, 'entries', {'page_size': 15}))
+        self.client = self.app.test_client()
+        pages = self.walk('/entries')
+        self.assertEqual([len(page) for page in pages], [15, 10])
+
+    def test_bad_cursor(self):
+        link = self.client.get('/entries?limit=5').headers['Link']
+        cursor = re.search('cursor=([^&>]*)', link).group(1)
+        for url in ('/entries?cursor=nonsense',
+                    '/entries?cursor=%s&skip=5' % cursor,
+                    '/entries?cursor=%s&order_by=rank' % cursor):
+            self.assertEqual(self.client.get(url).status_code, 400)
+
+
+class Revision(Document):
+    text = StringField()
+    author = ReferenceField(Author)
+    version = IntField()
+    changed = DateTimeField()
+
+
+class ConditionalTest(unittest2.TestCase):
+
+    def setUp(self):
+        for document in (Author, Revision):
+            document.drop_collection()
+        self.author = Author(name='a').save()
+        self.doc = Revision(text='one', author=self.author,
+                            changed=datetime(2014, 5, 1, 12)).save()
+        self.url = '/revisions/%s' % self.doc.pk
+        self.make_client()
+
+    def make_client(self, **options):
+        self.app, self.api = make_api((Revision, 'revisions', options))
+        self.client = self.app.test_client()
+
+    def put(self, data, **headers):
+        return self.client.put(self.url, data=json.dumps(data),
+                               content_type='application/json',
+                               headers=headers)
+
+    def test_if_none_match(self):
+        for url in (self.url, '/revisions'):
+            etag = self.client.get(url).headers['ETag']
+            response = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, '')
+            self.assertEqual(response.headers['ETag'], etag)
+
+    def test_etag_changes(self):
+        etag = self.client.get(self.url).headers['ETag']
+        self.assertNotEqual(
+            self.client.get(self.url + '?fields=text').headers['ETag'], etag)
+        self.author.name = 'b'
+        self.author.save()
+        response = self.client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_if_match(self):
+        etag = self.client.get(self.url).headers['ETag']
+        self.assertEqual(self.put({'text': 'two'}, **{'If-Match': etag})
+                         .status_code, 200)
+        response = self.put({'text': 'three'}, **{'If-Match': etag})
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(Revision.objects.get().text, 'two')
+        response = self.client.delete(self.url, headers={'If-Match': etag})
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(Revision.objects.count(), 1)
+
+    def test_version_field(self):
+        self.make_client(version_field='version')
+        etag = self.client.get(self.url).headers['ETag']
+        self.put({'text': 'two'})
+        self.assertEqual(Revision.objects.get().version, 1)
+        self.assertEqual(self.put({'text': 'x'}, **{'If-Match': etag})
+                         .status_code, 412)
+        self.author.name = 'b'
+        self.author.save()
+        etag = self.client.get(self.url).headers['ETag']
+        self.assertEqual(self.put({'text': 'three'}, **{'If-Match': etag})
+                         .status_code, 200)
+        self.assertEqual(Revision.objects.get().version, 2)
+
+    def test_stale_version(self):
+        self.make_client(version_field='version')
+        stale = Revision.objects.get()
+        self.put({'text': 'two'})
+        resource = SingleMongoResource(Revision, version_field='version')
+        self.assertRaises(SaveConditionError, stale.save,
+                          save_condition=resource.bump_version(stale))
+
+    def test_if_modified_since(self):
+        self.make_client(last_modified_field='changed')
+        response = self.client.get(self.url)
+        self.assertEqual(response.headers['Last-Modified'],
+                         'Thu, 01 May 2014 12:00:00 GMT')
+        for since, status in ((datetime(2014, 5, 1, 12), 304),
+                              (datetime(2014, 5, 1, 11), 200)):
+            response = self.client.get(self.url, headers={
+                'If-Modified-Since': http_date(since)})
+            self.assertEqual(response.status_code, status)
+
+    def test_disabled(self):
+        self.make_client(conditional=False)
+        self.assertNotIn('ETag', self.client.get(self.url).headers)
+
+
+class Address(EmbeddedDocument):
+    city = StringField(default='Paris')
+    zip = IntField()
+
+
+class Profile(Document):
+    name = StringField()
+    score = FloatField()
+    active = BooleanField(default=True)
+    nick = StringField(null=True)
+    joined = DateTimeField()
+    avatar = BinaryField()
+    address = EmbeddedDocumentField(Address)
+    previous = ListField(EmbeddedDocumentField(Address))
+    labels = ListField(StringField())
+    author = ReferenceField(Author)
+    tags = ListField(ReferenceField(Tag))
+    entry = ReferenceField(Entry)
+
+
+class RawReadsTest(unittest2.TestCase):
+
+    def setUp(self):
+        for document in (Author, Tag, Entry, Profile):
+            document.drop_collection()
+        author = Author(name='a').save()
+        tags = [Tag(label='t%d' % i).save() for i in range(2)]
+        entry = Entry(rank=1).save()
+        Profile(name='full', score=1.5, nick='n',
+                joined=datetime(2014, 5, 1, 12), avatar=b'\x00\x01',
+                address=Address(zip=1), previous=[Address(city='Oslo')],
+                labels=['x'], author=author, tags=tags, entry=entry).save()
+        collection = Profile._get_collection()
+        # Written behind mongoengine's back: missing defaults, an int in a
+        # FloatField and a dangling reference
+        collection.insert_one({'name': 'sparse', 'score': 2,
+                               'address': {}, 'author': Author().pk})
+        entry.delete()
+        self.raw_app, _ = make_api((Profile, 'profiles',
+                                    {'raw_reads': True}))
+        self.app, _ = make_api((Profile, 'profiles'))
+
+    def compare(self, url, etag=True):
+        hydrated = self.app.test_client().get(url)
+        raw = self.raw_app.test_client().get(url)
+        self.assertEqual(raw.status_code, hydrated.status_code)
+        self.assertEqual(get_json(raw), get_json(hydrated))
+        if etag:
+            self.assertEqual(raw.headers.get('ETag'),
+                             hydrated.headers.get('ETag'))
+        return get_json(raw)
+
+    def test_identical_lists(self):
+        profiles = self.compare('/profiles')
+        self.assertEqual(len(profiles), 2)
+        self.assertEqual(profiles[1]['score'], 2.0)
+        self.assertTrue(profiles[1]['active'])
+        self.compare('/profiles?order_by=-name&limit=1')
+        self.compare('/profiles?fields=name,address.city,author.name')
+        self.compare('/profiles?exclude=avatar,tags')
+
+    def test_identical_documents(self):
+        for profile in Profile.objects:
+            url = '/profiles/%s' % profile.pk
+            self.compare(url)
+            self.compare(url + '?fields=nick,active')
+
+    def test_not_found(self):
+        self.compare('/profiles/%s' % Author().pk)
+
+    def test_stored_nulls(self):
+        # Fields with a default get it for a stored null, unless null=True
+        Profile._get_collection().insert_one({
+            'name': 'nulls', 'active': None, 'nick': None,
+            'address': {'city': None}})
+        profile = self.compare('/profiles?name=nulls')[0]
+        self.assertTrue(profile['active'])
+        self.assertIsNone(profile['nick'])
+        self.assertEqual(profile['address']['city'], 'Paris')
+        self.compare('/profiles/%s' % Profile.objects.get(name='nulls').pk)
+
+    def test_streaming(self):
+        self.raw_app, _ = make_api((Profile, 'profiles', {
+            'raw_reads': True, 'stream': True, 'stream_chunk_size': 1}))
+        self.compare('/profiles', etag=False)
+
+    def test_no_documents_built(self):
+        original = Profile._from_son
+        Profile._from_son = classmethod(lambda *args, **kwargs: self.fail())
+        try:
+            client = self.raw_app.test_client()
+            self.assertEqual(client.get('/profiles').status_code, 200)
+        finally:
+            Profile._from_son = original
+
+
+class RequestIdentityMapTest(unittest2.TestCase):
+
+    def setUp(self):
+        for document in (Author, Tag, Post):
+            document.drop_collection()
+        self.app, self.api = make_api((Post, 'posts'))
+        self.client = self.app.test_client()
+        self.authors = [Author(name='a%d' % i).save() for i in range(2)]
+        self.tags = [Tag(label='t%d' % i).save() for i in range(3)]
+        for i in range(10):
+            Post(title='p%d' % i, author=self.authors[i % 2],
+                 tags=self.tags).save()
+
+    def test_referenced_documents_dumped_once(self):
+        posts = get_json(self.client.get('/posts'))
+        self.assertEqual(len(posts), 10)
+        self.assertEqual(posts[3]['author']['name'], 'a1')
+        stats = self.api.identity_map_stats()
+        # 2 authors and 3 tags are fetched and dumped once each
+        self.assertEqual(stats['misses'], 5)
+        self.assertEqual(stats['hits'], 10 + 30 - 5)
+        self.assertEqual(stats['dump_misses'], 5)
+        self.assertEqual(stats['dump_hits'], 10 + 30 - 5)
+        self.assertAlmostEqual(stats['dump_hit_rate'], 35 / 40.0)
+
+    def test_write_then_read_shares_references(self):
+        post = Post.objects.first()
+        url = '/posts/%s' % post.pk
+        with count_queries() as queries:
+            response = self.client.put(
+                url, data=json.dumps({'author': str(self.authors[1].pk)}),
+                content_type='application/json')
+        self.assertEqual(get_json(response)['author']['name'], 'a1')
+        self.assertEqual(queries.collections.count('author'), 1)
+        self.assertEqual(response.headers['ETag'],
+                         self.client.get(url).headers['ETag'])